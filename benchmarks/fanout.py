@@ -0,0 +1,90 @@
+"""Wake-up latency of Fanout with many waiting coroutines.
+
+    python -m benchmarks.fanout --waiters 100000
+
+Compares the sequence numbered Fanout against the asyncio.Condition based
+implementation it replaced, which is kept here as ConditionFanout.
+"""
+import argparse
+import asyncio
+import gc
+import time
+from typing import Any, Optional
+
+import orjson
+
+from unchanging_ink.fanout import Fanout
+
+
+class ConditionFanout:
+    def __init__(self):
+        self._data: Optional[Any] = None
+        self._cond = asyncio.Condition()
+
+    async def wait(self, timeout=None) -> Optional[Any]:
+        async with self._cond:
+            await asyncio.wait_for(self._cond.wait(), timeout)
+            return self._data
+
+    async def trigger(self, data: Optional[Any] = None):
+        async with self._cond:
+            self._data = data
+            self._cond.notify_all()
+
+
+async def measure(fanout, waiters: int, timeout: Optional[float] = None) -> dict:
+    woken = []
+    done = asyncio.Event()
+
+    async def waiter():
+        await fanout.wait(timeout)
+        woken.append(time.perf_counter())
+        if len(woken) == waiters:
+            done.set()
+
+    tasks = [asyncio.ensure_future(waiter()) for _ in range(waiters)]
+    # Let every waiter reach its wait()
+    await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    await fanout.trigger("head")
+    await done.wait()
+    await asyncio.gather(*tasks)
+
+    latencies = [t - start for t in woken]
+    return {
+        "implementation": type(fanout).__name__,
+        "waiters": waiters,
+        "timeout": timeout,
+        "p50": latencies[len(latencies) // 2],
+        "p99": latencies[int(len(latencies) * 0.99) - 1],
+        "max": latencies[-1],
+    }
+
+
+async def main_inner(args):
+    results = []
+    # Warm up the allocator, the first run is otherwise noticeably slower
+    await measure(Fanout(), args.waiters)
+    for cls in (Fanout, ConditionFanout):
+        for _ in range(args.repeat):
+            gc.collect()
+            results.append(await measure(cls(), args.waiters, args.timeout))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--waiters", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--timeout", type=float, default=None, help="timeout passed to wait()"
+    )
+    args = parser.parse_args()
+
+    for result in asyncio.run(main_inner(args)):
+        print(orjson.dumps(result).decode())
+
+
+if __name__ == "__main__":
+    main()
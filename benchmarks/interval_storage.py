@@ -0,0 +1,155 @@
+"""Storage taken and time needed by the INTERVAL_PROOF_STORAGEs.
+
+    python -m benchmarks.interval_storage --widths 100,10000,100000
+
+Seals one interval of --width timestamps into a SQLite database with each
+storage, like the worker does, and then reads --reads of them back like
+GET /v1/ts/<id> does. Reported are the time sealing took after the interval
+tree was built, the bytes stored per timestamp for its proof (the proof
+column, or the position plus its share of the interval tree and tile rows,
+without the database's own overhead) and the mean time to read a timestamp
+with its proof.
+"""
+import argparse
+import asyncio
+import logging
+import random
+import tempfile
+import time
+import uuid
+
+import orjson
+import sqlalchemy
+import structlog
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from unchanging_ink.crypto import DictCachingMerkleTree
+from unchanging_ink.itree import STORAGE_ROWS, STORAGE_TREE, with_proofs
+from unchanging_ink.models import (interval, interval_tile, interval_tree,
+                                   metadata, timestamp)
+from unchanging_ink.schemas import Interval, MainTreeInclusionProof
+from unchanging_ink.worker import store_interval_tree, store_proofs
+
+NOW = "2022-01-01T00:00:00.000000Z"
+MTH = "dev.unchanging.ink/0#v1:" + "A" * 43
+# A main tree of a million intervals
+INCLUSION = MainTreeInclusionProof(head=0, leaf=None, a=0, nodes=[bytes(32)] * 20)
+
+
+async def stored_bytes(conn, storage: str) -> int:
+    length = sqlalchemy.func.length
+    if storage == STORAGE_ROWS:
+        query = sqlalchemy.select(sqlalchemy.func.sum(length(timestamp.c.proof)))
+        return await conn.scalar(query)
+    tiles = sqlalchemy.select(
+        sqlalchemy.func.sum(
+            length(interval_tile.c.nodes)
+            # interval, level, index
+            + 16
+        )
+    )
+    trees = sqlalchemy.select(
+        sqlalchemy.func.sum(
+            length(interval_tree.c.main_path)
+            + length(interval_tree.c.mth)
+            # interval, width, tile_height, main_a
+            + 24
+        )
+    )
+    positions = sqlalchemy.select(sqlalchemy.func.count()).select_from(timestamp)
+    return (
+        await conn.scalar(tiles)
+        + await conn.scalar(trees)
+        + 4 * await conn.scalar(positions)
+    )
+
+
+async def measure(storage: str, width: int, reads: int) -> dict:
+    with tempfile.NamedTemporaryFile(suffix=".sqlite") as f:
+        engine = create_async_engine(f"sqlite+aiosqlite:///{f.name}")
+        try:
+            async with engine.begin() as conn:
+                await conn.run_sync(metadata.create_all)
+                sealed = Interval(0, NOW, bytes(32))
+                await conn.execute(
+                    interval.insert(), {"id": 0, "timestamp": NOW, "ith": sealed.ith}
+                )
+                rows = [
+                    {
+                        "id": uuid.uuid4(),
+                        "timestamp": NOW,
+                        "hash": i.to_bytes(32, "big"),
+                        "tag": None,
+                    }
+                    for i in range(width)
+                ]
+                await conn.execute(timestamp.insert(), rows)
+
+            # Built by the worker with either storage, for the ith
+            tree = await DictCachingMerkleTree.from_sequence(
+                row["hash"] for row in rows
+            )
+            start = time.perf_counter()
+            async with engine.begin() as conn:
+                if storage == STORAGE_TREE:
+                    await store_interval_tree(conn, rows, sealed, MTH, INCLUSION)
+                else:
+                    await store_proofs(conn, rows, tree, sealed, MTH, INCLUSION)
+            seal_seconds = time.perf_counter() - start
+
+            async with engine.connect() as conn:
+                size = await stored_bytes(conn, storage)
+
+            ids = [row["id"] for row in random.sample(rows, min(reads, width))]
+            start = time.perf_counter()
+            for id_ in ids:
+                async with engine.connect() as conn:
+                    result = await conn.execute(timestamp.select(timestamp.c.id == id_))
+                    (row,) = await with_proofs(conn, [result.first()])
+                    assert row["proof"]
+            read_seconds = (time.perf_counter() - start) / len(ids)
+        finally:
+            await engine.dispose()
+    return {
+        "storage": storage,
+        "width": width,
+        "seal_seconds": seal_seconds,
+        "bytes_per_timestamp": size / width,
+        "read_seconds": read_seconds,
+    }
+
+
+async def main_inner(args):
+    return [
+        await measure(storage, width, args.reads)
+        for width in args.widths
+        for storage in args.storages
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--widths",
+        type=lambda s: [int(w) for w in s.split(",")],
+        default=[100, 10_000],
+        help="comma separated numbers of timestamps per interval",
+    )
+    parser.add_argument(
+        "--storages",
+        type=lambda s: s.split(","),
+        default=[STORAGE_ROWS, STORAGE_TREE],
+        help="comma separated INTERVAL_PROOF_STORAGEs",
+    )
+    parser.add_argument("--reads", type=int, default=200)
+    args = parser.parse_args()
+
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(logging.INFO)
+    )
+    for result in asyncio.run(main_inner(args)):
+        print(orjson.dumps(result).decode())
+
+
+if __name__ == "__main__":
+    main()
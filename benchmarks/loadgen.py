@@ -0,0 +1,357 @@
+"""End-to-end load test of the API and the worker.
+
+    python -m benchmarks.loadgen --clients 50 --subscribers 20 --duration 60
+
+Starts the Sanic app from unchanging_ink.server and the worker loop from
+unchanging_ink.worker as subprocesses, against --db-url (a fresh SQLite
+database if not given) and --redis-url (a redis-server on a free port if not
+given), and drives them with a weighted mix of requests from closed-loop
+clients:
+
+post          POST /v1/ts/
+post_wait     POST /v1/ts/?wait, its latency is the time from submission to proof
+post_compact  POST /v1/ts/?compact
+get           GET /v1/ts/<id> of an earlier submission
+mth           GET /v1/mth/<interval> of an interval sealed so far
+
+Websocket subscribers on /v1/mth/live measure how long after sealing a head
+reaches them. At the end the per operation throughput and latencies, and
+the worker's mean time per sealing stage (from its /metrics) are printed as
+one JSON object per line.
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import httpx
+import orjson
+import websockets
+
+OPERATIONS = ("post", "post_wait", "post_compact", "get", "mth")
+STAGE_RE = re.compile(
+    r'^unchanging_ink_seal_stage_seconds_(sum|count)\{stage="(\w+)"\} (\S+)$', re.M
+)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def parse_time(value: str) -> float:
+    return datetime.datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+class LoadGenerator:
+    def __init__(self, base_url: str, mix: Dict[str, float], seed: int):
+        self.base_url = base_url
+        self.operations = list(mix)
+        self.weights = [mix[op] for op in self.operations]
+        self.rng = random.Random(seed)
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.head_delays: List[float] = []
+        self.ids: List[str] = []
+        self.latest_interval = -1
+
+    def _remember(self, response: httpx.Response):
+        data = response.json()
+        self.ids.append(data["id"])
+        if data.get("interval") is not None:
+            self.latest_interval = max(self.latest_interval, data["interval"])
+
+    async def post(self, client: httpx.AsyncClient):
+        response = await client.post(
+            "/v1/ts/",
+            json={"data": uuid.uuid4().hex},
+            headers={"accept": "application/json"},
+        )
+        response.raise_for_status()
+        self._remember(response)
+
+    async def post_wait(self, client: httpx.AsyncClient):
+        response = await client.post(
+            "/v1/ts/?wait",
+            json={"data": uuid.uuid4().hex},
+            headers={"accept": "application/json"},
+        )
+        response.raise_for_status()
+        self._remember(response)
+
+    async def post_compact(self, client: httpx.AsyncClient):
+        response = await client.post("/v1/ts/?compact", content=uuid.uuid4().hex)
+        response.raise_for_status()
+
+    async def get(self, client: httpx.AsyncClient):
+        if not self.ids:
+            return await self.post(client)
+        id_ = self.rng.choice(self.ids)
+        response = await client.get(
+            f"/v1/ts/{id_}", headers={"accept": "application/json"}
+        )
+        response.raise_for_status()
+
+    async def mth(self, client: httpx.AsyncClient):
+        if self.latest_interval < 2:
+            return await self.post(client)
+        interval = self.rng.randint(2, self.latest_interval)
+        response = await client.get(
+            f"/v1/mth/{interval}", headers={"accept": "application/json"}
+        )
+        response.raise_for_status()
+
+    async def client(self, client: httpx.AsyncClient, deadline: float):
+        while (start := time.perf_counter()) < deadline:
+            operation = self.rng.choices(self.operations, self.weights)[0]
+            try:
+                await getattr(self, operation)(client)
+            except (httpx.HTTPError, ValueError):
+                self.errors[operation] += 1
+            else:
+                self.latencies[operation].append(time.perf_counter() - start)
+
+    async def subscriber(self, deadline: float):
+        url = self.base_url.replace("http", "ws", 1) + "/v1/mth/live"
+        async with websockets.connect(url) as ws:
+            while (remaining := deadline - time.perf_counter()) > 0:
+                try:
+                    message = await asyncio.wait_for(ws.recv(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                head = orjson.loads(message)
+                interval = head["interval"]
+                self.latest_interval = max(self.latest_interval, interval["index"])
+                self.head_delays.append(time.time() - parse_time(interval["timestamp"]))
+
+    async def run(self, clients: int, subscribers: int, duration: float):
+        deadline = time.perf_counter() + duration
+        limits = httpx.Limits(max_connections=clients)
+        async with httpx.AsyncClient(
+            base_url=self.base_url, limits=limits, timeout=None
+        ) as client:
+            await asyncio.gather(
+                *(self.subscriber(deadline) for _ in range(subscribers)),
+                *(self.client(client, deadline) for _ in range(clients)),
+            )
+
+    def report(self, duration: float) -> List[dict]:
+        def summary(name: str, values: List[float], errors: int = 0) -> dict:
+            return {
+                "operation": name,
+                "count": len(values),
+                "errors": errors,
+                "throughput": len(values) / duration,
+                "p50": percentile(values, 0.5),
+                "p99": percentile(values, 0.99),
+                "max": max(values, default=None),
+            }
+
+        results = [
+            summary(op, self.latencies[op], self.errors[op]) for op in self.operations
+        ]
+        results.append(
+            summary(
+                "submission_to_proof",
+                self.latencies["post_wait"] + self.latencies["post_compact"],
+            )
+        )
+        results.append(summary("head_delivery", self.head_delays))
+        return results
+
+
+def stage_totals(metrics: str) -> Dict[str, Dict[str, float]]:
+    totals: Dict[str, Dict[str, float]] = defaultdict(dict)
+    for kind, stage, value in STAGE_RE.findall(metrics):
+        totals[stage][kind] = float(value)
+    return totals
+
+
+def stage_report(before: str, after: str) -> List[dict]:
+    old, new = stage_totals(before), stage_totals(after)
+    results = []
+    for stage, totals in new.items():
+        count = totals.get("count", 0) - old.get(stage, {}).get("count", 0)
+        seconds = totals.get("sum", 0) - old.get(stage, {}).get("sum", 0)
+        results.append(
+            {
+                "stage": stage,
+                "count": int(count),
+                "mean": seconds / count if count else None,
+            }
+        )
+    return results
+
+
+async def wait_for_http(url: str, process: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                sys.exit(f"{process.args} exited with status {process.returncode}")
+            try:
+                (await client.get(url)).raise_for_status()
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.2)
+    sys.exit(f"Timed out waiting for {url}")
+
+
+async def fetch(url: str) -> str:
+    async with httpx.AsyncClient() as client:
+        return (await client.get(url)).text
+
+
+def start(args: List[str], env: Dict[str, str], log) -> subprocess.Popen:
+    return subprocess.Popen(args, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def stop(process: Optional[subprocess.Popen]):
+    if process is None or process.poll() is not None:
+        return
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+async def main_inner(args) -> List[dict]:
+    repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    processes: List[subprocess.Popen] = []
+    with tempfile.TemporaryDirectory() as tmp, open(args.log, "ab") as log:
+        try:
+            redis_url = args.redis_url
+            if redis_url is None:
+                if (redis_server := shutil.which("redis-server")) is None:
+                    sys.exit("Either pass --redis-url or install redis-server")
+                redis_port = free_port()
+                processes.append(
+                    start(
+                        [redis_server, "--port", str(redis_port), "--save", ""],
+                        os.environ.copy(),
+                        log,
+                    )
+                )
+                redis_url = f"redis://127.0.0.1:{redis_port}/0"
+
+            api_port, metrics_port = free_port(), free_port()
+            env = dict(
+                os.environ,
+                PYTHONPATH=os.pathsep.join(
+                    [os.path.join(repository, "src"), os.environ.get("PYTHONPATH", "")]
+                ),
+                SANIC_DB_URL=args.db_url
+                or f"sqlite+aiosqlite:///{os.path.join(tmp, 'loadgen.db')}",
+                SANIC_REDIS_URL=redis_url,
+                SANIC_INTERVAL_SECONDS=str(args.interval),
+                SANIC_WORKER_METRICS_HOST="127.0.0.1",
+                SANIC_WORKER_METRICS_PORT=str(metrics_port),
+                # All clients come from the same address
+                SANIC_THROTTLE_RATE="0",
+            )
+
+            # The worker creates the database schema, start it first
+            worker = start([sys.executable, "-m", "unchanging_ink.worker"], env, log)
+            processes.append(worker)
+            metrics_url = f"http://127.0.0.1:{metrics_port}/metrics"
+            await wait_for_http(metrics_url, worker)
+
+            api = start(
+                [
+                    sys.executable,
+                    "-m",
+                    "sanic",
+                    "unchanging_ink.server:app",
+                    "--host",
+                    "127.0.0.1",
+                    "--port",
+                    str(api_port),
+                    "--workers",
+                    str(args.workers),
+                ],
+                env,
+                log,
+            )
+            processes.append(api)
+            base_url = f"http://127.0.0.1:{api_port}"
+            await wait_for_http(base_url + "/hello", api)
+
+            generator = LoadGenerator(base_url, args.mix, args.seed)
+            metrics_before = await fetch(metrics_url)
+            started = time.perf_counter()
+            await generator.run(args.clients, args.subscribers, args.duration)
+            duration = time.perf_counter() - started
+            metrics_after = await fetch(metrics_url)
+
+            return generator.report(duration) + stage_report(
+                metrics_before, metrics_after
+            )
+        finally:
+            for process in reversed(processes):
+                stop(process)
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    mix = {}
+    for item in value.split(","):
+        operation, _, weight = item.partition("=")
+        if operation not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation {operation}")
+        mix[operation] = float(weight or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--subscribers", type=int, default=5)
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument(
+        "--mix",
+        type=parse_mix,
+        default=parse_mix("post=4,post_wait=2,post_compact=1,get=2,mth=1"),
+        help="comma separated operation=weight, from " + ",".join(OPERATIONS),
+    )
+    parser.add_argument("--workers", type=int, default=1, help="Sanic worker processes")
+    parser.add_argument(
+        "--interval", type=float, default=3, help="seconds between intervals"
+    )
+    parser.add_argument(
+        "--db-url", help="e.g. postgresql+asyncpg://..., default a new SQLite file"
+    )
+    parser.add_argument(
+        "--redis-url", help="default a redis-server started on a free port"
+    )
+    parser.add_argument(
+        "--log", default="loadgen.log", help="output of the started processes"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for result in asyncio.run(main_inner(args)):
+        print(orjson.dumps(result).decode())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,386 @@
+"""Speed of the Merkle tree engine across tree widths and storage backends.
+
+    python -m benchmarks.merkle --widths 10,1000,100000 --output results.json
+    python -m benchmarks.merkle --baseline results.json
+
+Backends:
+
+dict      DictCachingMerkleTree built with from_sequence
+redis     AbstractRedisAsyncCachingMerkleTree with leaves computed on the fly,
+          against --redis-url or, if that is not given, fakeredis
+sqlite    MainMerkleTree over an in-memory SQLite interval table, with the
+          same Redis as the redis backend
+
+The memory taken by a tree built with from_sequence (dict backend, bytes
+per leaf) and by inclusion proofs made of nodes read from Redis (redis
+backend, bytes per proof) is recorded as the *_memory operations.
+
+Every result is printed as one JSON object per line. With --baseline, the
+per operation times and sizes are compared against an earlier --output and the exit
+status is 1 if any of them got slower by more than --tolerance.
+"""
+import argparse
+import asyncio
+import gc
+import logging
+import random
+import sys
+import time
+import tracemalloc
+from typing import Awaitable, Callable, List, Optional
+
+import aioredis
+import orjson
+import structlog
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from unchanging_ink.cache import (AbstractRedisAsyncCachingMerkleTree,
+                                  MainMerkleTree)
+from unchanging_ink.crypto import (AbstractAsyncMerkleTree,
+                                   DictCachingMerkleTree, MerkleNode)
+from unchanging_ink.models import interval, metadata
+
+BACKENDS = ("dict", "redis", "sqlite")
+
+
+def leaf(position: int) -> bytes:
+    return str(position).encode()
+
+
+def redis_tree_class(redis):
+    class RedisMerkleTree(AbstractRedisAsyncCachingMerkleTree):
+        def __init__(self, *args, **kwargs):
+            super().__init__(redis, *args, **kwargs)
+
+        async def fetch_leaf_data(self, position: int) -> bytes:
+            return leaf(position)
+
+    return RedisMerkleTree
+
+
+class MerkleBenchmark:
+    def __init__(
+        self, samples: int, repeat: int, seed: int, redis=None, concurrency: int = 0
+    ):
+        self.samples = samples
+        self.repeat = repeat
+        self.rng = random.Random(seed)
+        self.redis = redis
+        self.concurrency = concurrency
+        self.results: List[dict] = []
+
+    async def timed(
+        self,
+        backend: str,
+        operation: str,
+        width: int,
+        function: Callable[[], Awaitable],
+        n: int = 1,
+        repeat: Optional[int] = None,
+    ):
+        """Run `function` `repeat` times and record the fastest run."""
+        best = None
+        for _ in range(repeat or self.repeat):
+            gc.collect()
+            start = time.perf_counter()
+            retval = await function()
+            total = time.perf_counter() - start
+            best = total if best is None else min(best, total)
+        self.record(backend, operation, width, n, best)
+        return retval
+
+    async def allocated(
+        self,
+        backend: str,
+        operation: str,
+        width: int,
+        function: Callable[[], Awaitable],
+        n: int = 1,
+    ):
+        """Run `function` once and record the memory its result holds on to."""
+        gc.collect()
+        tracemalloc.start()
+        try:
+            retval = await function()
+            gc.collect()
+            size, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.record(backend, operation, width, n, size, unit="bytes")
+        return retval
+
+    def record(
+        self,
+        backend: str,
+        operation: str,
+        width: int,
+        n: int,
+        total: float,
+        unit: str = "s",
+    ):
+        result = {
+            "backend": backend,
+            "operation": operation,
+            "width": width,
+            "n": n,
+            "total": total,
+            "per_op": total / n,
+        }
+        if unit != "s":
+            result["unit"] = unit
+        print(orjson.dumps(result).decode(), flush=True)
+        self.results.append(result)
+
+    async def proofs(self, backend: str, tree: AbstractAsyncMerkleTree):
+        width = tree.width
+        positions = [self.rng.randrange(width) for _ in range(self.samples)]
+        old_widths = [self.rng.randrange(1, width + 1) for _ in range(self.samples)]
+
+        async def inclusion_proofs():
+            return [await tree.compute_inclusion_proof(p) for p in positions]
+
+        async def consistency_proofs():
+            return [await tree.compute_consistency_proof(w) for w in old_widths]
+
+        inclusion = await self.timed(
+            backend, "compute_inclusion_proof", width, inclusion_proofs, self.samples
+        )
+        consistency = await self.timed(
+            backend,
+            "compute_consistency_proof",
+            width,
+            consistency_proofs,
+            self.samples,
+        )
+
+        # Verifiers only know the tree heads
+        verifier = DictCachingMerkleTree.from_root_value(width, tree.root.value)
+        leaves = [
+            MerkleNode.from_leaf(p, await tree.fetch_leaf_data(p)) for p in positions
+        ]
+        old_trees = [
+            DictCachingMerkleTree.from_root_value(
+                w, (await tree.calculate_node(0, w)).value
+            )
+            for w in old_widths
+        ]
+
+        async def verify_inclusion():
+            assert all(
+                verifier.verify_inclusion_proof(node, path, proof)
+                for node, (path, proof) in zip(leaves, inclusion)
+            )
+
+        async def verify_consistency():
+            assert all(
+                verifier.verify_consistency_proof(old_tree, proof)
+                for old_tree, proof in zip(old_trees, consistency)
+            )
+
+        await self.timed(
+            backend, "verify_inclusion_proof", width, verify_inclusion, self.samples
+        )
+        await self.timed(
+            backend,
+            "verify_consistency_proof",
+            width,
+            verify_consistency,
+            self.samples,
+        )
+
+    async def recalculate(self, backend: str, tree: AbstractAsyncMerkleTree, width):
+        # Only the first run starts from an empty cache
+        await self.timed(
+            backend,
+            "recalculate_root_cold",
+            width,
+            lambda: tree.recalculate_root(width),
+            repeat=1,
+        )
+        await self.timed(
+            backend, "recalculate_root", width, lambda: tree.recalculate_root(width)
+        )
+
+    async def bench_dict(self, width: int):
+        tree = await self.timed(
+            "dict",
+            "from_sequence",
+            width,
+            lambda: DictLeaves.from_sequence(leaf(i) for i in range(width)),
+            width,
+        )
+        await self.timed(
+            "dict", "recalculate_root", width, lambda: tree.recalculate_root(width)
+        )
+        await self.proofs("dict", tree)
+
+        await self.allocated(
+            "dict",
+            "from_sequence_memory",
+            width,
+            lambda: DictLeaves.from_sequence(leaf(i) for i in range(width)),
+            width,
+        )
+
+    async def bench_redis(self, width: int):
+        await self.redis.flushdb()
+        tree = redis_tree_class(self.redis)(width=width, concurrency=self.concurrency)
+        await self.recalculate("redis", tree, width)
+        await self.proofs("redis", tree)
+
+        positions = [self.rng.randrange(width) for _ in range(self.samples)]
+
+        async def inclusion_proofs():
+            return [await tree.compute_inclusion_proof(p) for p in positions]
+
+        await self.allocated(
+            "redis", "inclusion_proof_memory", width, inclusion_proofs, self.samples
+        )
+
+    async def bench_sqlite(self, width: int):
+        await self.redis.flushdb()
+        engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+        try:
+            async with engine.connect() as conn:
+                await conn.run_sync(metadata.create_all)
+                await conn.execute(
+                    interval.insert(),
+                    [
+                        {
+                            "id": i,
+                            "timestamp": "2022-01-01T00:00:00.000000Z",
+                            "ith": leaf(i).rjust(32, b"\0"),
+                        }
+                        for i in range(width)
+                    ],
+                )
+                tree = MainMerkleTree(self.redis, conn, concurrency=self.concurrency)
+                await self.recalculate("sqlite", tree, width)
+                await self.proofs("sqlite", tree)
+        finally:
+            await engine.dispose()
+
+    async def run(self, backend: str, width: int):
+        await getattr(self, f"bench_{backend}")(width)
+
+
+class DictLeaves(DictCachingMerkleTree):
+    async def fetch_leaf_data(self, position: int) -> bytes:
+        return leaf(position)
+
+
+def connect_redis(url: Optional[str]):
+    if url:
+        return aioredis.from_url(url)
+    try:
+        import fakeredis
+    except ImportError:
+        sys.exit("Either pass --redis-url or install fakeredis")
+    return fakeredis.FakeAsyncRedis()
+
+
+def compare(results: List[dict], baseline: List[dict], tolerance: float) -> bool:
+    """Print every operation that got slower than the baseline, return True if any."""
+    key = lambda r: (r["backend"], r["operation"], r["width"])  # noqa: E731
+    before = {key(r): r["per_op"] for r in baseline}
+    regressed = False
+    for result in results:
+        if (old := before.get(key(result))) is None or old <= 0:
+            continue
+        ratio = result["per_op"] / old
+        if ratio > 1 + tolerance:
+            regressed = True
+            unit = "B" if result.get("unit") == "bytes" else "s"
+            print(
+                "REGRESSION {} {} width={}: {:.3g}{u} -> {:.3g}{u} ({:+.0%})".format(
+                    *key(result), old, result["per_op"], ratio - 1, u=unit
+                ),
+                file=sys.stderr,
+            )
+    return regressed
+
+
+async def main_inner(args) -> List[dict]:
+    redis = None
+    if set(args.backends) & {"redis", "sqlite"}:
+        redis = connect_redis(args.redis_url)
+    benchmark = MerkleBenchmark(
+        args.samples, args.repeat, args.seed, redis, args.concurrency
+    )
+    try:
+        for width in args.widths:
+            for backend in args.backends:
+                if width <= args.max_width.get(backend, width):
+                    await benchmark.run(backend, width)
+    finally:
+        if redis is not None:
+            await redis.flushdb()
+            await redis.close()
+    return benchmark.results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--widths",
+        type=lambda s: [int(w) for w in s.split(",")],
+        default=[10, 1000, 100_000],
+        help="comma separated tree widths, up to 10000000",
+    )
+    parser.add_argument(
+        "--backends",
+        type=lambda s: s.split(","),
+        default=list(BACKENDS),
+        help="comma separated subset of " + ",".join(BACKENDS),
+    )
+    parser.add_argument(
+        "--max-width",
+        type=lambda s: {
+            b: int(w) for (b, w) in (item.split("=") for item in s.split(","))
+        },
+        default={"redis": 100_000, "sqlite": 100_000},
+        help="skip larger widths per backend, e.g. redis=100000,sqlite=100000",
+    )
+    parser.add_argument(
+        "--samples", type=int, default=100, help="proofs computed per width"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="runs per operation, the fastest counts"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=0,
+        help="MERKLE_CONCURRENCY for the redis and sqlite backends",
+    )
+    parser.add_argument("--redis-url", help="use this Redis instead of fakeredis")
+    parser.add_argument("--output", help="also write all results to this file")
+    parser.add_argument("--baseline", help="compare against an earlier --output")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="relative slowdown tolerated against the baseline",
+    )
+    args = parser.parse_args()
+    if unknown := set(args.backends) - set(BACKENDS):
+        parser.error(f"unknown backends {', '.join(unknown)}")
+
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(logging.INFO)
+    )
+    results = asyncio.run(main_inner(args))
+
+    if args.output:
+        with open(args.output, "wb") as f:
+            f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
+
+    if args.baseline:
+        with open(args.baseline, "rb") as f:
+            if compare(results, orjson.loads(f.read()), args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Redis memory taken by the main tree node cache, per node layout.
+
+    python -m benchmarks.redis_memory --redis-url redis://localhost/15
+
+Seals --intervals intervals one after the other like the worker does: the
+main tree root is recalculated after every one of them, caching the nodes
+MainMerkleTree caches. This is done once for every REDIS_NODE_LAYOUT, and
+the memory Redis reports in INFO memory is extrapolated to the number of
+intervals that fit in --maxmemory (150mb, as in redis.conf).
+
+The database is flushed before and after every layout. Without --redis-url
+fakeredis is used, which only reports the number of keys.
+"""
+import argparse
+import asyncio
+import logging
+from typing import Optional
+
+import orjson
+import structlog
+
+from unchanging_ink.cache import (LAYOUT_KEYS, LAYOUT_PACKED, MAX_CACHE_WIDTH,
+                                  AbstractRedisAsyncCachingMerkleTree)
+
+from .merkle import connect_redis, leaf
+
+
+class WorkerMerkleTree(AbstractRedisAsyncCachingMerkleTree):
+    """Caches like MainMerkleTree, with the leaves computed on the fly."""
+
+    async def _getc(self, key):
+        if key[1] - key[0] <= MAX_CACHE_WIDTH:
+            return None
+        return await super()._getc(key)
+
+    async def _setc(self, key, value):
+        if key[1] - key[0] > MAX_CACHE_WIDTH:
+            await super()._setc(key, value)
+
+    async def fetch_leaf_data(self, position: int) -> bytes:
+        return leaf(position)
+
+
+async def used_memory(redis) -> Optional[int]:
+    try:
+        return (await redis.info("memory"))["used_memory"]
+    except Exception:
+        # fakeredis does not implement INFO
+        return None
+
+
+async def measure(redis, layout: str, intervals: int, maxmemory: int) -> dict:
+    await redis.flushdb()
+    before = await used_memory(redis)
+    tree = WorkerMerkleTree(redis, layout=layout)
+    for width in range(1, intervals + 1):
+        await tree.recalculate_root(width)
+    after = await used_memory(redis)
+    result = {
+        "layout": layout,
+        "intervals": intervals,
+        "keys": await redis.dbsize(),
+        "used_memory": None,
+        "bytes_per_interval": None,
+        "intervals_in_maxmemory": None,
+    }
+    if before is not None and after is not None:
+        result["used_memory"] = after - before
+        result["bytes_per_interval"] = (after - before) / intervals
+        if after > before:
+            result["intervals_in_maxmemory"] = int(
+                maxmemory / result["bytes_per_interval"]
+            )
+    await redis.flushdb()
+    return result
+
+
+async def main_inner(args):
+    redis = connect_redis(args.redis_url)
+    try:
+        return [
+            await measure(redis, layout, args.intervals, args.maxmemory)
+            for layout in args.layouts
+        ]
+    finally:
+        await redis.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--intervals", type=int, default=100_000)
+    parser.add_argument(
+        "--layouts",
+        type=lambda s: s.split(","),
+        default=[LAYOUT_KEYS, LAYOUT_PACKED],
+        help="comma separated REDIS_NODE_LAYOUTs",
+    )
+    parser.add_argument(
+        "--maxmemory", type=int, default=150 * 1024 * 1024, help="in bytes"
+    )
+    parser.add_argument("--redis-url", help="use this Redis instead of fakeredis")
+    args = parser.parse_args()
+
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(logging.INFO)
+    )
+    for result in asyncio.run(main_inner(args)):
+        print(orjson.dumps(result).decode())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+"""interval timestamp index
+
+Revision ID: 3a9e51c0b7d4
+Revises: d41b07c6e2f5
+Create Date: 2026-10-19 16:40:03.118254
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "3a9e51c0b7d4"
+down_revision = "d41b07c6e2f5"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        op.f("ix_interval_timestamp"), "interval", ["timestamp"], unique=False
+    )
+
+
+def downgrade():
+    op.drop_index(op.f("ix_interval_timestamp"), table_name="interval")
@@ -0,0 +1,47 @@
+"""interval tree storage
+
+Revision ID: 8c2e4b7d19a3
+Revises: 5f4731f6220b
+Create Date: 2026-10-19 10:12:44.208113
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "8c2e4b7d19a3"
+down_revision = "5f4731f6220b"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "interval_tree",
+        sa.Column("interval", sa.BigInteger(), nullable=False),
+        sa.Column("width", sa.Integer(), nullable=False),
+        sa.Column("tile_height", sa.Integer(), nullable=False),
+        sa.Column("mth", sa.String(), nullable=False),
+        sa.Column("main_a", sa.BigInteger(), nullable=False),
+        sa.Column("main_path", sa.LargeBinary(), nullable=False),
+        sa.ForeignKeyConstraint(["interval"], ["interval.id"], deferrable=True),
+        sa.PrimaryKeyConstraint("interval"),
+    )
+    op.create_table(
+        "interval_tile",
+        sa.Column("interval", sa.BigInteger(), nullable=False),
+        sa.Column("level", sa.Integer(), nullable=False),
+        sa.Column("index", sa.Integer(), nullable=False),
+        sa.Column("nodes", sa.LargeBinary(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["interval"], ["interval_tree.interval"], deferrable=True
+        ),
+        sa.PrimaryKeyConstraint("interval", "level", "index"),
+    )
+    op.add_column("timestamp", sa.Column("position", sa.Integer(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("timestamp", "position")
+    op.drop_table("interval_tile")
+    op.drop_table("interval_tree")
@@ -0,0 +1,28 @@
+"""tag prefix index
+
+Revision ID: b6f2d8e4a1c9
+Revises: 3a9e51c0b7d4
+Create Date: 2026-10-19 17:21:45.603117
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "b6f2d8e4a1c9"
+down_revision = "3a9e51c0b7d4"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        "ix_timestamp_tag_prefix",
+        "timestamp",
+        ["tag"],
+        unique=False,
+        postgresql_ops={"tag": "varchar_pattern_ops"},
+    )
+
+
+def downgrade():
+    op.drop_index("ix_timestamp_tag_prefix", table_name="timestamp")
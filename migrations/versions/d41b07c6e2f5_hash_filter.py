@@ -0,0 +1,33 @@
+"""hash index and filter
+
+Revision ID: d41b07c6e2f5
+Revises: 8c2e4b7d19a3
+Create Date: 2026-10-19 15:02:17.530941
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "d41b07c6e2f5"
+down_revision = "8c2e4b7d19a3"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(op.f("ix_timestamp_hash"), "timestamp", ["hash"], unique=False)
+    op.create_table(
+        "hash_filter",
+        sa.Column("first_interval", sa.BigInteger(), nullable=False),
+        sa.Column("last_interval", sa.BigInteger(), nullable=False),
+        sa.Column("entries", sa.BigInteger(), nullable=False),
+        sa.Column("closed", sa.Boolean(), nullable=False),
+        sa.Column("bits", sa.LargeBinary(), nullable=False),
+        sa.PrimaryKeyConstraint("first_interval"),
+    )
+
+
+def downgrade():
+    op.drop_table("hash_filter")
+    op.drop_index(op.f("ix_timestamp_hash"), table_name="timestamp")
@@ -0,0 +1,36 @@
+"""webhook
+
+Revision ID: e7c3a95f2b18
+Revises: b6f2d8e4a1c9
+Create Date: 2026-10-19 18:05:37.840126
+
+"""
+import sqlalchemy as sa
+import sqlalchemy_utils
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "e7c3a95f2b18"
+down_revision = "b6f2d8e4a1c9"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "webhook",
+        sa.Column("id", sqlalchemy_utils.types.uuid.UUIDType(), nullable=False),
+        sa.Column("url", sa.String(length=2048), nullable=False),
+        sa.Column("attempts", sa.Integer(), nullable=False),
+        sa.Column("next_attempt", sa.Float(), nullable=False),
+        sa.ForeignKeyConstraint(["id"], ["timestamp.id"]),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        op.f("ix_webhook_next_attempt"), "webhook", ["next_attempt"], unique=False
+    )
+
+
+def downgrade():
+    op.drop_index(op.f("ix_webhook_next_attempt"), table_name="webhook")
+    op.drop_table("webhook")
@@ -0,0 +1,30 @@
+"""epoch
+
+Revision ID: f2a8c6d4b9e1
+Revises: e7c3a95f2b18
+Create Date: 2026-10-19 19:12:08.415290
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "f2a8c6d4b9e1"
+down_revision = "e7c3a95f2b18"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "epoch",
+        sa.Column("id", sa.BigInteger(), nullable=False),
+        sa.Column("first_interval", sa.BigInteger(), nullable=False),
+        sa.Column("last_interval", sa.BigInteger(), nullable=False),
+        sa.Column("head", sa.LargeBinary(length=64), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+
+
+def downgrade():
+    op.drop_table("epoch")
@@ -1,21 +1,66 @@
+import asyncio
 from abc import ABC
 from dataclasses import dataclass
-from typing import Dict, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import structlog
 from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
 
 from unchanging_ink.crypto import AbstractAsyncCachingMerkleTree, MerkleNode
+from unchanging_ink.epochs import EpochHeads
+from unchanging_ink.metrics import NODE_CACHE
 from unchanging_ink.models import interval
+from unchanging_ink.nodestore import NodeStore
 from unchanging_ink.schemas import Interval
 
 MAX_CACHE_WIDTH = 128
+NODE_TTL = 60 * 60 * 24
+HASH_SIZE = 32
+
+# Layouts of the nodes in Redis, see AbstractRedisAsyncCachingMerkleTree
+LAYOUT_KEYS = "keys"
+LAYOUT_PACKED = "packed"
+PACKED_TILE_BITS = 8
+
 logger = structlog.getLogger(__name__)
 
+_preload_hit = NODE_CACHE.labels(tier="preload", result="hit")
+_preload_miss = NODE_CACHE.labels(tier="preload", result="miss")
+_mmap_hit = NODE_CACHE.labels(tier="mmap", result="hit")
+_epoch_hit = NODE_CACHE.labels(tier="epoch", result="hit")
+
+
+def packed_address(start: int, end: int) -> Optional[Tuple[bytes, int]]:
+    """Redis key and offset of the node (start, end) in the packed layout,
+    None if it is not a perfect subtree."""
+    size = end - start
+    if size & (size - 1) or start & (size - 1):
+        return None
+    level = size.bit_length() - 1
+    index = start >> level
+    offset = (index & ((1 << PACKED_TILE_BITS) - 1)) * HASH_SIZE
+    return f"n{level}:{index >> PACKED_TILE_BITS}".encode(), offset
+
 
 class AbstractRedisAsyncCachingMerkleTree(AbstractAsyncCachingMerkleTree, ABC):
-    def __init__(self, aiorediconn, *args, **kwargs):
+    """Caches nodes in Redis, with one of two layouts:
+
+    keys    Every node is a string of its own, named "start,end". Costs Redis
+            about 100 bytes of overhead per 32 byte node.
+    packed  Only perfect subtrees are cached: the values of 2**PACKED_TILE_BITS
+            neighbouring ones of the same size are one string "n<level>:<n>",
+            read and written with GETRANGE and SETRANGE. Never written parts
+            read as zeros. Other nodes are computed from the perfect subtrees
+            they are made of.
+    """
+
+    CACHE_TIER = "redis"
+
+    def __init__(self, aiorediconn, *args, layout: str = LAYOUT_KEYS, **kwargs):
+        if layout not in (LAYOUT_KEYS, LAYOUT_PACKED):
+            raise ValueError(f"Unknown Redis node layout {layout!r}")
         self._aiorc = aiorediconn
+        self._layout = layout
         super().__init__(*args, **kwargs)
 
     async def seed(self, data: Dict[Tuple[int, int], MerkleNode]):
@@ -23,18 +68,32 @@ class AbstractRedisAsyncCachingMerkleTree(AbstractAsyncCachingMerkleTree, ABC):
             await self._setc(k, v)
 
     async def _getc(self, key: Tuple[int, int]) -> Optional[MerkleNode]:
-        bkey = "{},{}".format(*key).encode()
-        value = await self._aiorc.get(bkey)
-        logger.debug("_getc", key=key, value=value)
-        if value is None:
-            return None
+        if self._layout == LAYOUT_PACKED:
+            if (address := packed_address(*key)) is None:
+                return None
+            bkey, offset = address
+            value = await self._aiorc.getrange(bkey, offset, offset + HASH_SIZE - 1)
+            if len(value) < HASH_SIZE or not any(value):
+                return None
+        else:
+            bkey = "{},{}".format(*key).encode()
+            value = await self._aiorc.get(bkey)
+            if value is None:
+                return None
         return MerkleNode(key[0], key[1], value)
 
     async def _setc(self, key: Tuple[int, int], value: MerkleNode):
-        logger.debug("_setc", key=key, value=value)
-        key = "{},{}".format(*key).encode()
-        a = await self._aiorc.set(key, value.value, ex=60 * 60 * 24)
-        logger.debug("set response", a=a)
+        if self._layout == LAYOUT_PACKED:
+            if (address := packed_address(*key)) is None:
+                return
+            bkey, offset = address
+            pipe = self._aiorc.pipeline(transaction=False)
+            pipe.setrange(bkey, offset, value.value)
+            pipe.expire(bkey, NODE_TTL)
+            await pipe.execute()
+        else:
+            key = "{},{}".format(*key).encode()
+            await self._aiorc.set(key, value.value, ex=NODE_TTL)
 
 
 @dataclass
@@ -45,14 +104,42 @@ class PreloadCache:
 
 
 class MainMerkleTree(AbstractRedisAsyncCachingMerkleTree):
-    def __init__(self, aioredisconn, conn: AsyncConnection, *args, **kwargs):
+    def __init__(
+        self,
+        aioredisconn,
+        conn: AsyncConnection,
+        *args,
+        node_store: Optional[NodeStore] = None,
+        epochs: Optional[EpochHeads] = None,
+        **kwargs,
+    ):
         self._conn = conn
-        self._preload_cache: Optional[PreloadCache] = None
+        # One per concurrently evaluated branch, see evaluate_concurrently()
+        self._preload_caches: List[PreloadCache] = []
+        self._node_store = node_store
+        self._epochs = epochs
+        # The connection can only run one query at a time
+        self._conn_lock = asyncio.Lock()
         super().__init__(aioredisconn, *args, **kwargs)
 
+    def evaluate_concurrently(self, start: int, end: int) -> bool:
+        # Smaller subtrees are computed from one preload query anyway
+        return end - start > MAX_CACHE_WIDTH
+
+    def _preload_cache(self, start: int, end: int) -> Optional[PreloadCache]:
+        for preload_cache in self._preload_caches:
+            if preload_cache.start <= start < end <= preload_cache.end:
+                return preload_cache
+        if not self.concurrency:
+            self._preload_caches.clear()
+        return None
+
+    async def _execute(self, query):
+        async with self._conn_lock:
+            return await self._conn.execute(query)
+
     async def _setc(self, key: Tuple[int, int], value: MerkleNode):
         if key[1] - key[0] <= MAX_CACHE_WIDTH:
-            logger.debug("_setc noop", key=key)
             return
         return await super()._setc(key, value)
 
@@ -60,17 +147,25 @@ class MainMerkleTree(AbstractRedisAsyncCachingMerkleTree):
         # If preload_cache is set and keys fall within it, do not hit the redis cache,
         # instead don't return intermediate cached nodes, and let fetch_leaf data return
         # the cached data.
-        # If preload cache is set and key falls outside, delete preload cache
+        # If preload cache is set and key falls outside, delete preload cache (with
+        # concurrency, the oldest one is dropped when there are too many)
         # If preload cache is not set, node is not cached, and end-start is within
         # cache_size, fetch and fill preload cache
 
-        if self._preload_cache:
-            if self._preload_cache.start <= key[0] < key[1] <= self._preload_cache.end:
-                logger.debug("preload cache hit", start=self._preload_cache.start, end=self._preload_cache.end)
-                return None
-            else:
-                logger.debug("preload cache cleared1")
-                self._preload_cache = None
+        # Nodes made of complete epochs are fixed, see epochs.py
+        if self._epochs is not None:
+            if (value := self._epochs.get_node(*key)) is not None:
+                _epoch_hit.inc()
+                return MerkleNode(key[0], key[1], value)
+
+        # Perfect subtrees come from the node store first, if there is one
+        if self._node_store is not None:
+            if (value := self._node_store.get_node(*key)) is not None:
+                _mmap_hit.inc()
+                return MerkleNode(key[0], key[1], value)
+
+        if self._preload_cache(*key):
+            return None
 
         retval = await super()._getc(key)
 
@@ -80,30 +175,29 @@ class MainMerkleTree(AbstractRedisAsyncCachingMerkleTree):
                     interval.c.id >= key[0], interval.c.id < key[1]
                 )
 
-                result = await self._conn.execute(query)
+                result = await self._execute(query)
                 rows = result.all()
 
-                self._preload_cache = PreloadCache(
-                    start=key[0], end=key[1], data={row.id: row for row in rows}
+                self._preload_caches.append(
+                    PreloadCache(
+                        start=key[0], end=key[1], data={row.id: row for row in rows}
+                    )
                 )
-                logger.debug("preload cache set", start=key[0], end=key[1])
+                del self._preload_caches[: -(self.concurrency + 1)]
 
         return retval
 
     async def fetch_leaf_data(self, position: int) -> bytes:
         row = None
-        if self._preload_cache:
-            if self._preload_cache.start <= position < self._preload_cache.end:
-                row = self._preload_cache.data[position]
-                logger.debug("preload cache used", position=position)
-            else:
-                self._preload_cache = None
-                logger.debug("preload cache cleared2")
+        if preload_cache := self._preload_cache(position, position + 1):
+            row = preload_cache.data[position]
+            _preload_hit.inc()
 
         if row is None:
+            _preload_miss.inc()
             query = interval.select().where(interval.c.id == position)
 
-            result = await self._conn.execute(query)
+            result = await self._execute(query)
             row = result.first()
 
         ith = Interval.from_row(row)
@@ -5,7 +5,8 @@ from nacl.signing import SigningKey
 from sanic import Sanic
 
 from .merkle import (AbstractAsyncCachingMerkleTree, AbstractAsyncMerkleTree,
-                     DictCachingMerkleTree, MerkleNode)
+                     DictCachingMerkleTree, MerkleNode, build_levels,
+                     leaf_values)
 
 
 class Signer:
@@ -1,29 +1,38 @@
 from __future__ import annotations
 
+import asyncio
 import math
 from abc import ABC, abstractmethod
-from dataclasses import dataclass, field
+from bisect import bisect_left
+from dataclasses import dataclass
 from hashlib import sha3_256
 from typing import Dict, Iterable, List, Optional, Sequence, Tuple
 
 import structlog
 
+from ..metrics import NODE_CACHE
+
 logger = structlog.getLogger(__name__)
 
+HASH_SIZE = 32
+
 
 @dataclass
 class MerkleNode:
+    # No __dict__, the caches and proofs hold many of these
+    __slots__ = ("start", "end", "value")
+
     start: int
     end: int
     value: bytes
-    height: Optional[int] = field(init=False)
     hash_function = sha3_256
 
-    def __post_init__(self):
-        if self.end == self.start:
-            self.height = 0
-        else:
-            self.height = int(math.ceil(math.log2(self.end - self.start))) + 1
+    @property
+    def height(self) -> int:
+        """1 + ceil(log2(end - start)), 0 for the empty tree."""
+        if self.end <= self.start:
+            return 0
+        return (self.end - self.start - 1).bit_length() + 1
 
     def __add__(self, other):
         assert isinstance(other, self.__class__)
@@ -32,24 +41,67 @@ class MerkleNode:
     @classmethod
     def combine(cls: MerkleNode, n1: MerkleNode, n2: MerkleNode) -> MerkleNode:
         assert n1.end == n2.start
-        return MerkleNode(
-            n1.start, n2.end, cls.hash_function(b"\x01" + n1.value + n2.value).digest()
-        )
+        return MerkleNode(n1.start, n2.end, cls.combine_digests(n1.value, n2.value))
 
     @classmethod
     def from_leaf(cls: MerkleNode, index: int, value: bytes) -> MerkleNode:
-        return MerkleNode(index, index + 1, cls.hash_function(b"\x00" + value).digest())
+        return MerkleNode(index, index + 1, cls.leaf_digest(value))
+
+    @classmethod
+    def combine_digests(cls, left: bytes, right: bytes) -> bytes:
+        """Value of the node with children of the values `left` and `right`,
+        for hot paths that do not need the nodes."""
+        return cls.hash_function(b"\x01" + left + right).digest()
+
+    @classmethod
+    def leaf_digest(cls, value: bytes) -> bytes:
+        """Value of the leaf node for `value`, without creating the node."""
+        return cls.hash_function(b"\x00" + value).digest()
+
+
+def _hash_all(prefix: bytes, data: bytes, size: int) -> bytes:
+    """Concatenated hashes of `prefix` + every `size` bytes of `data`.
+
+    Same as MerkleNode.from_leaf() and combine(), without creating nodes."""
+    data = bytes(data)
+    return b"".join(
+        [
+            MerkleNode.hash_function(prefix + data[i : i + size]).digest()
+            for i in range(0, len(data) - size + 1, size)
+        ]
+    )
+
+
+def leaf_values(ihashes: bytes) -> bytes:
+    return _hash_all(b"\x00", ihashes, HASH_SIZE)
+
+
+def build_levels(leaves: bytes) -> List[bytes]:
+    """All levels of perfect subtrees, from the concatenated leaf node values."""
+    levels = [bytes(leaves)]
+    while len(levels[-1]) >= 2 * HASH_SIZE:
+        levels.append(_hash_all(b"\x01", levels[-1], 2 * HASH_SIZE))
+    return levels
 
 
 class AbstractAsyncMerkleTree(ABC):
     NODE_CLASS = MerkleNode
-    __slots__ = ("root", "width")
+    __slots__ = ("root", "width", "concurrency", "_spare")
 
     def __init__(
-        self, *, root: Optional[MerkleNode] = None, width: Optional[int] = None
+        self,
+        *,
+        root: Optional[MerkleNode] = None,
+        width: Optional[int] = None,
+        concurrency: int = 0,
     ):
+        """With `concurrency`, up to that many subtrees are evaluated in
+        parallel to their siblings, for backends where fetching a node is a
+        round trip. 0 evaluates everything one after the other."""
         self.root: Optional[MerkleNode] = root
         self.width = self.root.end if self.root else width
+        self.concurrency = concurrency
+        self._spare = concurrency
 
     @abstractmethod
     async def fetch_leaf_data(self, position: int) -> bytes:
@@ -83,19 +135,48 @@ class AbstractAsyncMerkleTree(ABC):
                 )
                 yield _o + 0, _o + k
 
+    @staticmethod
+    def split(start: int, end: int) -> int:
+        """Start of the right child of the node (start, end)."""
+        mask_length = (start ^ (end - 1)).bit_length()
+        return start + (1 << (mask_length - 1))
+
+    def evaluate_concurrently(self, start: int, end: int) -> bool:
+        """Whether the children of the node (start, end) may be evaluated
+        concurrently, if there is spare concurrency."""
+        return True
+
     async def calculate_node(self, start: int, end: int) -> MerkleNode:
         assert start < end
 
         if start + 1 == end:
-            logger.debug("calculate_node from leaf", start=start, end=end)
             item = MerkleNode.from_leaf(start, await self.fetch_leaf_data(start))
         else:
-            mask_length = (start ^ (end - 1)).bit_length()
-            middle = start + (1 << (mask_length - 1))
-
-            logger.debug("calculate_node recurse", start=start, middle=middle, end=end)
-            item = await self.calculate_node(start, middle) + await self.calculate_node(
-                middle, end
+            middle = self.split(start, end)
+            if self._spare > 0 and self.evaluate_concurrently(start, end):
+                # Taken for the whole evaluation of both children, so that
+                # at most `concurrency` branches run next to each other
+                self._spare -= 1
+                children = [
+                    asyncio.ensure_future(self.calculate_node(start, middle)),
+                    asyncio.ensure_future(self.calculate_node(middle, end)),
+                ]
+                try:
+                    left, right = await asyncio.gather(*children)
+                except BaseException:
+                    for child in children:
+                        child.cancel()
+                    # Leave nothing running behind the failed branch
+                    await asyncio.gather(*children, return_exceptions=True)
+                    raise
+                finally:
+                    self._spare += 1
+            else:
+                left = await self.calculate_node(start, middle)
+                right = await self.calculate_node(middle, end)
+            # Adjacent by construction, no need for the checks in combine()
+            item = MerkleNode(
+                start, end, MerkleNode.combine_digests(left.value, right.value)
             )
 
         return item
@@ -163,14 +244,81 @@ class AbstractAsyncMerkleTree(ABC):
             path >>= 1
         return current_node.value == self.root.value
 
-    async def compute_consistency_proof(self, old_width: int) -> Sequence[MerkleNode]:
+    @classmethod
+    def multiproof_node_addresses(
+        cls, width: int, positions: Iterable[int]
+    ) -> Iterable[Tuple[int, int]]:
+        """Nodes needed, in addition to the leaves at `positions`, to calculate the
+        root of a tree of `width` leaves. Each node is only listed once, even if it
+        is on the path of several leaves."""
+        positions = sorted(set(positions))
+        assert positions and 0 <= positions[0] and positions[-1] < width
+
+        def walk(start: int, end: int, lo: int, hi: int):
+            # positions[lo:hi] are the leaves below (start, end)
+            if lo == hi:
+                yield start, end
+            elif end - start > 1:
+                middle = cls.split(start, end)
+                mid = bisect_left(positions, middle, lo, hi)
+                yield from walk(start, middle, lo, mid)
+                yield from walk(middle, end, mid, hi)
+
+        yield from walk(0, width, 0, len(positions))
+
+    async def compute_multiproof(
+        self, positions: Iterable[int]
+    ) -> Sequence[MerkleNode]:
         return [
             await self.calculate_node(*node_address)
-            for node_address in self.consistency_proof_node_addresses(
-                old_width, self.width
-            )
+            for node_address in self.multiproof_node_addresses(self.width, positions)
         ]
 
+    def verify_multiproof(
+        self, leaf_nodes: Sequence[MerkleNode], proof: Sequence[MerkleNode]
+    ) -> bool:
+        leaves = sorted(leaf_nodes, key=lambda node: node.start)
+        positions = [node.start for node in leaves]
+        if (
+            not leaves
+            or any(node.end != node.start + 1 for node in leaves)
+            or len(set(positions)) != len(positions)
+            or positions[0] < 0
+            or positions[-1] >= self.width
+        ):
+            return False
+
+        proof_values = iter(node.value for node in proof)
+
+        def walk(start: int, end: int, lo: int, hi: int) -> Optional[MerkleNode]:
+            if lo == hi:
+                value = next(proof_values, None)
+                return None if value is None else MerkleNode(start, end, value)
+            if end - start == 1:
+                return leaves[lo]
+            middle = self.split(start, end)
+            mid = bisect_left(positions, middle, lo, hi)
+            left = walk(start, middle, lo, mid)
+            right = walk(middle, end, mid, hi)
+            if left is None or right is None:
+                return None
+            return left + right
+
+        root = walk(0, self.width, 0, len(leaves))
+        return (
+            root is not None
+            and next(proof_values, None) is None
+            and root.value == self.root.value
+        )
+
+    async def compute_consistency_proof(self, old_width: int) -> Sequence[MerkleNode]:
+        addresses = self.consistency_proof_node_addresses(old_width, self.width)
+        if self.concurrency:
+            return await asyncio.gather(
+                *(self.calculate_node(*node_address) for node_address in addresses)
+            )
+        return [await self.calculate_node(*node_address) for node_address in addresses]
+
     def verify_consistency_proof(
         self, old_tree: AbstractAsyncMerkleTree, proof: Sequence[MerkleNode]
     ) -> bool:
@@ -260,6 +408,19 @@ class AbstractAsyncMerkleTree(ABC):
 
 
 class AbstractAsyncCachingMerkleTree(AbstractAsyncMerkleTree):
+    # Label of the node cache lookups in the metrics, set per subclass
+    CACHE_TIER = "memory"
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._cache_hit = NODE_CACHE.labels(tier=cls.CACHE_TIER, result="hit")
+        cls._cache_miss = NODE_CACHE.labels(tier=cls.CACHE_TIER, result="miss")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Nodes being calculated, so that concurrent branches share the result
+        self._inflight: Dict[Tuple[int, int], asyncio.Future] = {}
+
     @abstractmethod
     async def _getc(self, key: Tuple[int, int]) -> Optional[MerkleNode]:
         raise NotImplementedError()  # pragma: no cover
@@ -287,12 +448,43 @@ class AbstractAsyncCachingMerkleTree(AbstractAsyncMerkleTree):
         return root
 
     async def calculate_node(self, start: int, end: int) -> MerkleNode:
+        if not self.concurrency:
+            return await self._calculate_node_cached(start, end)
+
+        key = (start, end)
+        if (pending := self._inflight.get(key)) is not None:
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise
+                # Only the branch that was calculating it was cancelled
+                return await self.calculate_node(start, end)
+
+        pending = self._inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            retval = await self._calculate_node_cached(start, end)
+        except asyncio.CancelledError:
+            pending.cancel()
+            raise
+        except Exception as e:
+            pending.set_exception(e)
+            # Only raised to the other waiters, if there are any
+            pending.exception()
+            raise
+        else:
+            pending.set_result(retval)
+        finally:
+            del self._inflight[key]
+        return retval
+
+    async def _calculate_node_cached(self, start: int, end: int) -> MerkleNode:
         key = (start, end)
         if (retval := await self._getc(key)) is not None:
-            logger.debug("calculate_node cache hit", key=key)
+            self._cache_hit.inc()
             return retval
 
-        logger.debug("calculate_node cache miss", key=key)
+        self._cache_miss.inc()
         retval = await super().calculate_node(start, end)
         await self._setc(key, retval)
         return retval
@@ -0,0 +1,124 @@
+"""Database engines with bounded connection pools.
+
+Every process (each API worker process, the worker) has one pool of at most
+DB_POOL_SIZE + DB_POOL_MAX_OVERFLOW connections. Requests beyond that queue
+for a connection for up to DB_POOL_TIMEOUT seconds, after which the API
+answers 503. The time spent getting a connection and the connections in use
+are exported as metrics.
+
+asyncpg prepares every statement, SQLAlchemy keeps up to
+DB_STATEMENT_CACHE_SIZE of them per connection. Since pooled connections
+live on, the fixed hot queries (inserting a timestamp, selecting one by id,
+selecting a range of intervals) are only prepared once per connection.
+
+Read-only API handlers can use the replicas in DB_REPLICA_URLS instead of
+the primary, see ReplicaSet. The pool metrics are those of the primary, the
+time spent getting a connection and the timeouts are counted over all pools.
+"""
+import time
+from typing import List, Optional, Sequence
+
+import sqlalchemy
+from sqlalchemy import exc
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from .metrics import (DB_POOL_CAPACITY, DB_POOL_CONNECTIONS, DB_POOL_TIMEOUTS,
+                      DB_POOL_WAIT_SECONDS, DB_REPLICA_READS)
+from .models import interval
+
+_wait = DB_POOL_WAIT_SECONDS.labels()
+_timeouts = DB_POOL_TIMEOUTS.labels()
+_replica_read = DB_REPLICA_READS.labels(result="replica")
+_replica_stale = DB_REPLICA_READS.labels(result="stale")
+
+
+class MeteredPool(AsyncAdaptedQueuePool):
+    def _do_get(self):
+        # Includes opening a new connection, if the pool may
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            _timeouts.inc()
+            raise
+        finally:
+            _wait.observe(time.perf_counter() - start)
+
+
+def watch_pool(engine: AsyncEngine):
+    """Export the connections of the pool of `engine` as metrics."""
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        # SQLite, without a bounded pool
+        return
+    DB_POOL_CONNECTIONS.labels(state="checked_out").set_function(pool.checkedout)
+    DB_POOL_CONNECTIONS.labels(state="idle").set_function(pool.checkedin)
+    DB_POOL_CAPACITY.set(pool.size() + max(pool._max_overflow, 0))
+
+
+def create_engine(
+    url: str,
+    pool_size: int,
+    max_overflow: int,
+    timeout: float,
+    statement_cache_size: int,
+) -> AsyncEngine:
+    if url.startswith("sqlite"):
+        # SQLite uses a pool without size limits
+        return create_async_engine(url)
+    connect_args = {}
+    if url.startswith("postgresql+asyncpg"):
+        connect_args["prepared_statement_cache_size"] = statement_cache_size
+    engine = create_async_engine(
+        url,
+        poolclass=MeteredPool,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=timeout,
+        connect_args=connect_args,
+    )
+    return engine
+
+
+class ReplicaSet:
+    """Read-only replicas of the primary database, used in turn.
+
+    The worker seals an interval and writes all its proofs in one
+    transaction, and never changes them after. A replica that has replayed
+    interval n therefore answers everything about intervals up to n like
+    the primary would. How far each replica got is remembered, and only
+    looked up again when a request needs a later interval.
+    """
+
+    def __init__(self, primary: AsyncEngine, replicas: Sequence[AsyncEngine] = ()):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self._replayed: List[int] = [-1] * len(self.replicas)
+        self._next = 0
+
+    async def replayed(self, index: int) -> int:
+        """Last interval that replica `index` has replayed, -1 if none."""
+        query = sqlalchemy.select(sqlalchemy.func.max(interval.c.id))
+        async with self.replicas[index].connect() as conn:
+            last = await conn.scalar(query)
+        self._replayed[index] = -1 if last is None else last
+        return self._replayed[index]
+
+    async def engine(self, needed: Optional[int] = None) -> AsyncEngine:
+        """Engine to read from: the next replica, unless it has not replayed
+        interval `needed` yet, then the primary."""
+        if not self.replicas:
+            return self.primary
+        index = self._next
+        self._next = (index + 1) % len(self.replicas)
+        if needed is not None and self._replayed[index] < needed:
+            if await self.replayed(index) < needed:
+                _replica_stale.inc()
+                return self.primary
+        _replica_read.inc()
+        return self.replicas[index]
+
+    async def dispose(self):
+        for engine in self.replicas:
+            await engine.dispose()
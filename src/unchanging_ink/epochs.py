@@ -0,0 +1,137 @@
+"""Epochs of the main tree, runs of 2**EPOCH_BITS intervals whose head is
+frozen once they are complete.
+
+The main tree is not split up: as an epoch starts at a multiple of its size,
+it is a perfect subtree of every main tree that contains all of it, and every
+main tree is made of the heads of the complete epochs and one subtree of the
+current epoch. A tree over the epoch heads is therefore the same as the main
+tree of the complete epochs, and the main tree hashes and proofs do not
+change. The first EPOCH_BITS nodes of the inclusion proof of an interval in a
+complete epoch lead up to the epoch head, and the rest are the inclusion
+proof of the epoch head, which GET /v1/epoch/<n>/in/<width> also returns.
+
+When the worker seals the last interval of an epoch, it stores the head in
+the epoch table, in the same transaction. MainMerkleTree then takes every
+node made of complete epochs from EpochHeads, in memory, instead of the node
+store, redis or the database. Recalculating a head only needs the nodes of
+the current epoch, and the nodes inside complete epochs are only needed for
+the proofs of their own intervals, which do not change any more.
+"""
+import asyncio
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from .crypto import AbstractAsyncMerkleTree, MerkleNode
+from .models import epoch
+
+
+class EpochError(Exception):
+    pass
+
+
+class EpochHeads:
+    """The heads of the complete epochs, as stored in the epoch table."""
+
+    def __init__(self, bits: int):
+        self.bits = bits
+        self.heads: List[bytes] = []
+        # Nodes made of more than one epoch, by (first epoch, end epoch)
+        self._nodes: Dict[Tuple[int, int], bytes] = {}
+        self._lock = asyncio.Lock()
+
+    @property
+    def size(self) -> int:
+        return 1 << self.bits
+
+    @property
+    def covered(self) -> int:
+        """Intervals in the complete epochs."""
+        return len(self.heads) << self.bits
+
+    async def refresh(self, conn: AsyncConnection, width: Optional[int] = None):
+        """Fetch the epochs completed since, unless all those complete in a main
+        tree of `width` intervals are known already."""
+        async with self._lock:
+            if width is not None and width >> self.bits <= len(self.heads):
+                return
+            query = (
+                epoch.select().where(epoch.c.id >= len(self.heads)).order_by(epoch.c.id)
+            )
+            for row in await conn.execute(query):
+                if row.id != len(self.heads) or row.first_interval != self.covered:
+                    raise EpochError(
+                        f"Epoch {row.id} starts at interval {row.first_interval},"
+                        f" not with EPOCH_BITS={self.bits}"
+                    )
+                self.heads.append(row.head)
+
+    def get_node(self, start: int, end: int) -> Optional[bytes]:
+        """Value of the main tree node (start, end), if it is made of complete
+        epochs."""
+        mask = self.size - 1
+        if start & mask or end & mask or end > self.covered or start >= end:
+            return None
+        return self._node(start >> self.bits, end >> self.bits)
+
+    def _node(self, start: int, end: int) -> bytes:
+        if start + 1 == end:
+            return self.heads[start]
+        if (value := self._nodes.get((start, end))) is None:
+            # Scaled down by EPOCH_BITS, the main tree splits at the same place
+            middle = AbstractAsyncMerkleTree.split(start, end)
+            value = self._nodes[start, end] = MerkleNode.combine_digests(
+                self._node(start, middle), self._node(middle, end)
+            )
+        return value
+
+
+async def epoch_inclusion_proof(
+    tree: AbstractAsyncMerkleTree, bits: int, width: int, index: int
+) -> Tuple[int, List[MerkleNode]]:
+    """Inclusion proof of the head of epoch `index` in the main `tree` of
+    `width` intervals: the node address and path of a tree with the epochs as
+    its leaves, the complete ones and what there is of the current one. The
+    leaves are the epoch heads, not hashed again, so that the path is that of
+    the main tree from the epoch head up, with nodes addressed in epochs."""
+    start, end = 0, -(-width >> bits)
+    siblings = []
+    # Scaled down by EPOCH_BITS, the main tree splits at the same place
+    while end - start > 1:
+        middle = AbstractAsyncMerkleTree.split(start, end)
+        if index < middle:
+            siblings.append((middle, end))
+            end = middle
+        else:
+            siblings.append((start, middle))
+            start = middle
+    a, path = 0, []
+    for (start, end) in reversed(siblings):
+        if end <= index:
+            a |= 1 << len(path)
+        node = await tree.calculate_node(start << bits, min(end << bits, width))
+        path.append(MerkleNode(start, end, node.value))
+    return a, path
+
+
+async def store_epochs(
+    conn: AsyncConnection,
+    tree: AbstractAsyncMerkleTree,
+    epochs: EpochHeads,
+    width: int,
+):
+    """Store the heads of the epochs that are complete in the main `tree` of
+    `width` intervals, and not stored yet."""
+    await epochs.refresh(conn, width)
+    for index in range(len(epochs.heads), width >> epochs.bits):
+        first = index << epochs.bits
+        node = await tree.calculate_node(first, first + epochs.size)
+        await conn.execute(
+            epoch.insert(),
+            {
+                "id": index,
+                "first_interval": first,
+                "last_interval": first + epochs.size - 1,
+                "head": node.value,
+            },
+        )
@@ -1,42 +1,190 @@
 import asyncio
-import os
+import random
+import time
 from asyncio import wait_for
-from typing import Any, Optional
+from collections import deque
+from typing import (Any, Deque, Dict, Iterator, List, NamedTuple, Optional,
+                    Tuple, Union)
+
+import aioredis
+import orjson
+import structlog
+
+logger = structlog.getLogger(__name__)
 
 
 class Fanout:
-    def __init__(self):
-        self._data: Optional[Any] = None
-        self._cond = asyncio.Condition()
+    """Broadcast of a sequence of values to any number of waiting coroutines.
+
+    Every trigger() starts a new generation with the next sequence number and
+    resolves all waiters in one pass, without them having to re-acquire a
+    lock. A short history of recent generations lets a waiter that was busy in
+    between catch up on what it missed instead of losing it."""
+
+    def __init__(self, history: int = 16):
+        self._seq = 0
+        self._history: Deque[Tuple[int, Any]] = deque(maxlen=history)
+        self._waiters: Dict[asyncio.Future, None] = {}
+
+    @property
+    def seq(self) -> int:
+        return self._seq
+
+    @property
+    def waiters(self) -> int:
+        return len(self._waiters)
+
+    def _since(self, seq: int) -> List[Tuple[int, Any]]:
+        items = []
+        for item in reversed(self._history):
+            if item[0] <= seq:
+                break
+            items.append(item)
+        items.reverse()
+        return items
+
+    async def wait_after(self, seq: int, timeout=None) -> List[Tuple[int, Any]]:
+        """All (seq, data) after `seq`, oldest first, waiting for the next trigger
+        if there are none yet.
+
+        If the history does not reach back to `seq`, the result starts with the
+        oldest generation that is still retained."""
+        if seq >= self._seq:
+            waiter = asyncio.get_event_loop().create_future()
+            self._waiters[waiter] = None
+            try:
+                if timeout is None:
+                    await waiter
+                else:
+                    await wait_for(waiter, timeout)
+            finally:
+                self._waiters.pop(waiter, None)
+        return self._since(seq)
 
     async def wait(self, timeout=None) -> Optional[Any]:
-        async with self._cond:
-            await wait_for(self._cond.wait(), timeout)
-            return self._data
+        """Wait for the next trigger and return the most recent data."""
+        return (await self.wait_after(self._seq, timeout))[-1][1]
 
     async def trigger(self, data: Optional[Any] = None):
-        async with self._cond:
-            self._data = data
-            self._cond.notify_all()
+        self._seq += 1
+        self._history.append((self._seq, data))
+        waiters, self._waiters = self._waiters, {}
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+
+class HeadFrame(NamedTuple):
+    index: int
+    data: str
+    event: bytes
+
+
+class HeadHistory:
+    """Bounded ring of the most recent main tree heads, as announced on mth-live.
+
+    Every head is encoded once into the frames sent to live stream clients,
+    and those frames are shared between all connections."""
+
+    def __init__(self, maxlen: int):
+        self._frames: Deque[HeadFrame] = deque(maxlen=maxlen)
+        # Monotonic time the latest head arrived, or the history was created
+        self.updated = time.monotonic()
+
+    @property
+    def latest(self) -> Optional[HeadFrame]:
+        return self._frames[-1] if self._frames else None
+
+    def append(self, data: Union[str, bytes]) -> Optional[HeadFrame]:
+        """Add a head, as published on mth-live, unless it is older than the
+        latest one. A head that cannot be decoded is logged and skipped, it
+        must not stop whatever is relaying the heads."""
+        try:
+            if isinstance(data, bytes):
+                data = data.decode()
+            index = orjson.loads(data)["interval"]["index"]
+            if type(index) is not int:
+                raise TypeError(f"interval index {index!r}")
+        except (ValueError, LookupError, TypeError) as e:
+            logger.warning("Skipping malformed head", error=e)
+            return None
+        if self._frames and index <= self._frames[-1].index:
+            return None
+        frame = HeadFrame(index, data, f"id: {index}\ndata: {data}\n\n".encode())
+        self._frames.append(frame)
+        self.updated = time.monotonic()
+        return frame
+
+    def since(self, index: int) -> List[HeadFrame]:
+        """Frames for all heads after interval `index`, oldest first.
+
+        If the history does not reach back far enough, the result starts with
+        the oldest head that is still retained."""
+        frames = []
+        for frame in reversed(self._frames):
+            if frame.index <= index:
+                break
+            frames.append(frame)
+        frames.reverse()
+        return frames
+
+
+def backoff_delays(initial: float = 0.5, maximum: float = 30.0) -> Iterator[float]:
+    """Exponentially growing delays with full jitter."""
+    delay = initial
+    while True:
+        yield random.uniform(0, delay)
+        delay = min(delay * 2, maximum)
+
+
+async def announce(app, data: Union[str, bytes]):
+    if (frame := app.ctx.mth_history.append(data)) is not None:
+        await app.ctx.fanout.trigger(frame.data)
 
 
 async def redis_fanout(app):
+    """Subscribe to mth-live directly, one subscription per worker process."""
+    delays = backoff_delays()
     while True:
+        pubsub = app.ctx.redis.pubsub()
         try:
-            pubsub = app.ctx.redis.pubsub()
             await pubsub.subscribe("mth-live")
+            # Subscribe before seeding, so that no head falls between the two
+            for data in await app.ctx.redis.lrange("mth-history", 0, -1):
+                await announce(app, data)
+            delays = backoff_delays()
             while True:
                 message = await pubsub.get_message(
                     ignore_subscribe_messages=True, timeout=11
                 )
                 if message:
-                    await app.ctx.fanout.trigger(message["data"].decode())
-        except GeneratorExit:
-            raise
-        except:
-            import traceback
-
-            bt = traceback.format_exc()
-            prf = str(os.getpid()) + ": "
-            print(prf + ("\n" + prf).join(bt.splitlines()))
-            await asyncio.sleep(1)
+                    await announce(app, message["data"])
+        except (aioredis.RedisError, OSError) as e:
+            delay = next(delays)
+            logger.warning("Redis subscription failed", error=e, retry=delay)
+            await asyncio.sleep(delay)
+        finally:
+            await pubsub.close()
+
+
+async def relay_fanout(app):
+    """Receive heads from the host-local relay, see relay.py"""
+    delays = backoff_delays()
+    while True:
+        writer = None
+        try:
+            reader, writer = await asyncio.open_unix_connection(
+                app.config.FANOUT_SOCKET, limit=2**20
+            )
+            latest = app.ctx.mth_history.latest
+            writer.write(b"%d\n" % (-1 if latest is None else latest.index))
+            delays = backoff_delays()
+            while line := await reader.readline():
+                await announce(app, line.rstrip(b"\n"))
+            logger.warning("Fanout relay closed the connection")
+        except (OSError, ValueError) as e:
+            logger.warning("Fanout relay connection failed", error=e)
+        finally:
+            if writer is not None:
+                writer.close()
+        await asyncio.sleep(next(delays))
@@ -0,0 +1,256 @@
+"""Bloom filters of the hashes of all sealed timestamps, in front of the
+lookup of timestamps by hash.
+
+The filters are kept in blocks, one row of hash_filter each, that cover
+consecutive intervals. The worker adds the hashes of every interval it seals
+to the newest block, in the same transaction, until the block is full. It
+then folds the block down to the number of hashes it got and starts a new
+one. API processes cache the blocks, fetch the ones that changed when a new
+head is announced, and only look a hash up in the database if one of the
+blocks may contain it.
+
+A timestamp hash is uniformly distributed already, the bit positions are
+taken from it directly: (h1 + i * h2) mod size for i < HASHES, with h1 and h2
+its first two 64 bit words. Filter sizes are powers of two, so that a filter
+can be folded in half by OR-ing its halves.
+"""
+import asyncio
+import zlib
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import sqlalchemy
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from .models import hash_filter, timestamp
+
+HASHES = 7
+# About 1% false positives with HASHES
+BITS_PER_ENTRY = 10
+MIN_BYTES = 8
+# Rows sync_hash_filter() reads from the database at once
+SYNC_BATCH = 10000
+
+
+class BloomFilter:
+    __slots__ = ("bits", "mask")
+
+    def __init__(self, bits: bytearray):
+        self.bits = bits
+        self.mask = len(bits) * 8 - 1
+
+    @classmethod
+    def empty(cls, size: int) -> "BloomFilter":
+        """A filter of at least `size` bits."""
+        return cls(bytearray(max(1 << (size - 1).bit_length(), MIN_BYTES * 8) // 8))
+
+    @property
+    def capacity(self) -> int:
+        return len(self.bits) * 8 // BITS_PER_ENTRY
+
+    def _positions(self, hash_: bytes) -> Iterable[int]:
+        h1 = int.from_bytes(hash_[:8], "little")
+        h2 = int.from_bytes(hash_[8:16], "little") | 1
+        return ((h1 + i * h2) & self.mask for i in range(HASHES))
+
+    def add(self, hash_: bytes):
+        bits = self.bits
+        for position in self._positions(hash_):
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, hash_: bytes) -> bool:
+        bits = self.bits
+        return all(
+            bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(hash_)
+        )
+
+    def fit(self, entries: int) -> "BloomFilter":
+        """The same filter, folded in half while it stays large enough for
+        `entries` hashes."""
+        bits = self.bits
+        while len(bits) > MIN_BYTES and len(bits) * 4 >= entries * BITS_PER_ENTRY:
+            half = len(bits) // 2
+            folded = int.from_bytes(bits[:half], "little") | int.from_bytes(
+                bits[half:], "little"
+            )
+            bits = bytearray(folded.to_bytes(half, "little"))
+        return BloomFilter(bits)
+
+    def to_bytes(self) -> bytes:
+        return zlib.compress(bytes(self.bits), 1)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "BloomFilter":
+        return cls(bytearray(zlib.decompress(data)))
+
+
+@dataclass
+class FilterBlock:
+    first_interval: int
+    last_interval: int
+    entries: int
+    closed: bool
+    filter: BloomFilter
+    # Whether `filter` changed since the block was loaded
+    dirty: bool = True
+    stored: bool = False
+
+    @classmethod
+    def from_row(cls, row) -> "FilterBlock":
+        return cls(
+            first_interval=row.first_interval,
+            last_interval=row.last_interval,
+            entries=row.entries,
+            closed=row.closed,
+            filter=BloomFilter.from_bytes(row.bits),
+            dirty=False,
+            stored=True,
+        )
+
+
+def extend(
+    block: Optional[FilterBlock], interval: int, hashes: Sequence[bytes], size: int
+) -> List[FilterBlock]:
+    """Add the `hashes` of `interval` to the open `block`, or to a new block of
+    `size` bits if there is none or they do not fit. Returns the blocks that
+    changed, the open one last."""
+    changed = []
+    # Blocks cover all intervals, a new one starts after the previous one
+    first = interval if block is None else block.last_interval + 1
+    if block is not None and not block.closed:
+        if block.entries and block.entries + len(hashes) > block.filter.capacity:
+            block.filter = block.filter.fit(block.entries)
+            block.closed = block.dirty = True
+            changed.append(block)
+            block = None
+    else:
+        block = None
+    if block is None:
+        block = FilterBlock(
+            first_interval=first,
+            last_interval=interval,
+            entries=0,
+            closed=False,
+            filter=BloomFilter.empty(max(size, len(hashes) * BITS_PER_ENTRY)),
+        )
+    for hash_ in hashes:
+        block.filter.add(hash_)
+    block.last_interval = interval
+    block.entries += len(hashes)
+    block.dirty = block.dirty or bool(hashes)
+    changed.append(block)
+    return changed
+
+
+async def open_block(conn: AsyncConnection) -> Optional[FilterBlock]:
+    """The newest block, if there is one."""
+    query = hash_filter.select().order_by(hash_filter.c.first_interval.desc()).limit(1)
+    row = (await conn.execute(query)).first()
+    return None if row is None else FilterBlock.from_row(row)
+
+
+async def save(conn: AsyncConnection, blocks: Iterable[FilterBlock]):
+    for block in blocks:
+        values = {
+            "last_interval": block.last_interval,
+            "entries": block.entries,
+            "closed": block.closed,
+        }
+        if block.dirty:
+            values["bits"] = block.filter.to_bytes()
+        if block.stored:
+            await conn.execute(
+                hash_filter.update()
+                .where(hash_filter.c.first_interval == block.first_interval)
+                .values(**values)
+            )
+        else:
+            await conn.execute(
+                hash_filter.insert().values(
+                    first_interval=block.first_interval, **values
+                )
+            )
+        block.dirty, block.stored = False, True
+
+
+async def add_interval(
+    conn: AsyncConnection, interval: int, hashes: Sequence[bytes], size: int
+):
+    """Add the hashes of `interval`, which is being sealed in the transaction
+    of `conn`, to the filters."""
+    await save(conn, extend(await open_block(conn), interval, hashes, size))
+
+
+async def sync_hash_filter(conn: AsyncConnection, last_interval: int, size: int):
+    """Add all intervals up to `last_interval` that the filters do not cover
+    yet, e.g. those sealed before they were enabled. The hashes are streamed,
+    SYNC_BATCH at a time."""
+    block = await open_block(conn)
+    covered = -1 if block is None else block.last_interval
+    if covered >= last_interval:
+        return
+    query = (
+        sqlalchemy.select(timestamp.c.interval, timestamp.c.hash)
+        .where(timestamp.c.interval > covered, timestamp.c.interval <= last_interval)
+        .order_by(timestamp.c.interval)
+        .execution_options(yield_per=SYNC_BATCH)
+    )
+    changed: Dict[int, FilterBlock] = {}
+
+    def add(interval, hashes):
+        nonlocal block
+        for block in extend(block, interval, hashes, size):
+            changed[block.first_interval] = block
+
+    if block is None:
+        # From the first interval on, even if it is empty
+        add(0, [])
+    current, hashes = None, []
+    async for row in await conn.stream(query):
+        if row.interval != current:
+            if current is not None:
+                add(current, hashes)
+            current, hashes = row.interval, []
+        hashes.append(row.hash)
+    if current is not None:
+        add(current, hashes)
+    # Up to the end, even if the last intervals are empty
+    add(last_interval, [])
+    await save(conn, changed.values())
+
+
+class HashFilterCache:
+    """The filter blocks, as cached by an API process."""
+
+    def __init__(self):
+        self.blocks: Dict[int, FilterBlock] = {}
+        # All intervals up to this one are in the blocks
+        self.covered = -1
+        self._lock = asyncio.Lock()
+
+    async def refresh(self, conn: AsyncConnection, needed: int):
+        """Fetch the blocks that changed, unless they cover `needed` already."""
+        async with self._lock:
+            if self.covered >= needed:
+                return
+            open_blocks = [
+                b.first_interval for b in self.blocks.values() if not b.closed
+            ]
+            query = hash_filter.select().where(
+                sqlalchemy.or_(
+                    hash_filter.c.last_interval > self.covered,
+                    hash_filter.c.first_interval.in_(open_blocks),
+                )
+            )
+            async for row in await conn.stream(query):
+                self.blocks[row.first_interval] = FilterBlock.from_row(row)
+            covered = -1
+            for first in sorted(self.blocks):
+                if first != covered + 1:
+                    break
+                covered = self.blocks[first].last_interval
+            self.covered = covered
+
+    def may_contain(self, hash_: bytes) -> bool:
+        return any(hash_ in block.filter for block in self.blocks.values())
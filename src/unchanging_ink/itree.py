@@ -0,0 +1,205 @@
+"""Interval trees stored once per interval, instead of a proof per timestamp.
+
+With INTERVAL_PROOF_STORAGE "rows" the worker writes the complete proof into
+the row of every timestamp it seals: O(log n) hashes of the interval tree and
+the parts all timestamps of the interval share, again in every row. With
+"tree" it stores the interval tree once instead, and only sets the position
+in the tree in every timestamp row:
+
+interval_tree  one row per interval, with the number of timestamps in it
+               (`width`), the tile height, the mth it was sealed with and
+               its inclusion proof in the main tree (`main_a`, `main_path`
+               with the concatenated node values)
+interval_tile  the tiles of the interval tree, laid out like those of the
+               main tree in tiles.py: tile (level, index) holds the values
+               of the nodes of size 2**(level * height) with indices
+               index * 2**height up to (index + 1) * 2**height. The tile at
+               the right edge of each level has as many as there are.
+
+The proof of a timestamp is derived when it is read: all tiles it needs are
+fetched in one query, O(log n) rows of at most 2**TILE_HEIGHT node values,
+and the nodes between the tile levels are recomputed. It is the same proof
+that "rows" stores, byte for byte. Both storages can be read at the same
+time, so switching only applies to the intervals sealed after.
+"""
+from typing import Dict, Iterable, List, Sequence, Set, Tuple
+
+import sqlalchemy
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from .crypto import MerkleNode, build_levels
+from .models import interval as interval_model
+from .models import interval_tile, interval_tree
+from .schemas import (CompactRepr, Interval, IntervalProofStructure,
+                      MainTreeInclusionProof)
+from .tiles import HASH_SIZE, TileMerkleTree
+
+STORAGE_ROWS = "rows"
+STORAGE_TREE = "tree"
+
+# Tile height of the interval trees sealed from now on, stored with each
+TILE_HEIGHT = 4
+
+
+def tree_levels(hashes: Iterable[bytes]) -> List[bytes]:
+    """All levels of perfect subtrees of the interval tree of `hashes`."""
+    return build_levels(b"".join(MerkleNode.leaf_digest(hash_) for hash_ in hashes))
+
+
+def interval_tree_row(
+    interval: Interval,
+    width: int,
+    mth: CompactRepr,
+    inclusion_proof: MainTreeInclusionProof,
+    height: int = TILE_HEIGHT,
+) -> dict:
+    return {
+        "interval": interval.index,
+        "width": width,
+        "tile_height": height,
+        "mth": mth,
+        "main_a": inclusion_proof.a,
+        "main_path": b"".join(inclusion_proof.nodes),
+    }
+
+
+def tile_rows(
+    interval: Interval, levels: List[bytes], height: int = TILE_HEIGHT
+) -> List[dict]:
+    """The tiles of the tree with the perfect subtrees `levels`."""
+    size = HASH_SIZE << height
+    return [
+        {
+            "interval": interval.index,
+            "level": level // height,
+            "index": index,
+            "nodes": levels[level][offset : offset + size],
+        }
+        for level in range(0, len(levels), height)
+        for (index, offset) in enumerate(range(0, len(levels[level]), size))
+    ]
+
+
+class IntervalTileMerkleTree(TileMerkleTree):
+    """Interval tree of which the tiles in `tiles` are known.
+
+    Tiles that are not are added to `missing` and taken to be all zeroes.
+    The addresses of the nodes in a proof do not depend on their values, so
+    a first pass finds the tiles the proof needs."""
+
+    def __init__(self, tiles: Dict[Tuple[int, int], bytes], width: int, height: int):
+        super().__init__(width=width, height=height)
+        self.tiles = tiles
+        self.missing: Set[Tuple[int, int]] = set()
+
+    async def fetch_tile(self, path: str) -> bytes:
+        # The tile at the right edge is partial, and stays that way
+        level, _, index = path.partition("/")
+        key = int(level), int(index.partition(".")[0])
+        if (data := self.tiles.get(key)) is None:
+            self.missing.add(key)
+            data = bytes(HASH_SIZE << self.height)
+        return data
+
+
+class StoredIntervalTree:
+    """The stored tree of one interval, with the tiles fetched so far."""
+
+    def __init__(self, row):
+        self.interval: int = row.interval
+        self.width: int = row.width
+        self.height: int = row.tile_height
+        self.ith: bytes = row.ith
+        self.mth: CompactRepr = row.mth
+        self.interval_timestamp = row.timestamp
+        self.main_a: int = row.main_a
+        self.main_path = [
+            bytes(row.main_path[i : i + HASH_SIZE])
+            for i in range(0, len(row.main_path), HASH_SIZE)
+        ]
+        self.tiles: Dict[Tuple[int, int], bytes] = {}
+
+    @classmethod
+    async def load(cls, conn: AsyncConnection, interval: int) -> "StoredIntervalTree":
+        query = (
+            sqlalchemy.select(
+                interval_tree,
+                interval_model.c.timestamp,
+                interval_model.c.ith,
+            )
+            .select_from(interval_tree.join(interval_model))
+            .where(interval_tree.c.interval == interval)
+        )
+        return cls((await conn.execute(query)).one())
+
+    def _tree(self) -> IntervalTileMerkleTree:
+        return IntervalTileMerkleTree(self.tiles, self.width, self.height)
+
+    async def _fetch(self, conn: AsyncConnection, compute):
+        """Fetch the tiles that `compute`, called with an
+        IntervalTileMerkleTree, needs, in one query."""
+        tree = self._tree()
+        await compute(tree)
+        if not tree.missing:
+            return
+        query = sqlalchemy.select(
+            interval_tile.c.level, interval_tile.c.index, interval_tile.c.nodes
+        ).where(
+            interval_tile.c.interval == self.interval,
+            sqlalchemy.tuple_(interval_tile.c.level, interval_tile.c.index).in_(
+                sorted(tree.missing)
+            ),
+        )
+        for row in await conn.execute(query):
+            self.tiles[row.level, row.index] = bytes(row.nodes)
+
+    async def proofs(
+        self, conn: AsyncConnection, positions: Sequence[int]
+    ) -> Dict[int, IntervalProofStructure]:
+        async def compute(tree):
+            return {
+                position: await tree.compute_inclusion_proof(position)
+                for position in positions
+            }
+
+        await self._fetch(conn, compute)
+        return {
+            position: IntervalProofStructure(
+                a=a,
+                path=[node.value for node in path],
+                mth=self.mth,
+                ith=self.ith,
+                interval_timestamp=self.interval_timestamp,
+                main_a=self.main_a,
+                main_path=self.main_path,
+            )
+            for (position, (a, path)) in (await compute(self._tree())).items()
+        }
+
+    async def multiproof(
+        self, conn: AsyncConnection, positions: Sequence[int]
+    ) -> List[bytes]:
+        async def compute(tree):
+            return await tree.compute_multiproof(positions)
+
+        await self._fetch(conn, compute)
+        return [node.value for node in await compute(self._tree())]
+
+
+async def with_proofs(conn: AsyncConnection, rows: Iterable) -> List[dict]:
+    """`rows` of the timestamp table as dicts, with the proofs of those sealed
+    with the "tree" storage derived from their interval trees."""
+    rows = [row._asdict() for row in rows]
+    positions: Dict[int, List[int]] = {}
+    for row in rows:
+        if row["proof"] is None and row["position"] is not None:
+            positions.setdefault(row["interval"], []).append(row["position"])
+    proofs = {}
+    for interval, interval_positions in positions.items():
+        tree = await StoredIntervalTree.load(conn, interval)
+        for (position, proof) in (await tree.proofs(conn, interval_positions)).items():
+            proofs[interval, position] = proof.to_cbor()
+    for row in rows:
+        if row["proof"] is None and row["position"] is not None:
+            row["proof"] = proofs[row["interval"], row["position"]]
+    return rows
@@ -0,0 +1,289 @@
+"""Minimal in-process metrics, rendered in the Prometheus text exposition format.
+
+Hot paths should fetch the labelled child once (at import or class creation
+time) and only call inc()/observe() on it: updating a metric then is a plain
+attribute increment.
+
+Every process has a registry of its own. With several API workers, a scrape
+of /metrics reaches one of them, so each worker labels all its samples with
+its name (see Registry.set_labels()) and Prometheus keeps a series per
+worker. Sum over the `worker` label for the totals.
+"""
+import asyncio
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List["Metric"] = []
+        self._labels: Tuple[Tuple[str, str], ...] = ()
+
+    def register(self, metric: "Metric"):
+        self._metrics.append(metric)
+
+    def set_labels(self, **labels):
+        """Labels added to every sample, e.g. the process it comes from."""
+        self._labels = tuple((k, str(v)) for (k, v) in labels.items())
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.typ}")
+            for name, labels, value in metric.samples():
+                labels = self._labels + labels
+                if labels:
+                    label_str = ",".join(f'{k}="{v}"' for (k, v) in labels)
+                    lines.append(f"{name}{{{label_str}}} {value!r}")
+                else:
+                    lines.append(f"{name} {value!r}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class GaugeChild:
+    __slots__ = ("value", "function")
+
+    def __init__(self):
+        self.value = 0
+        self.function: Optional[Callable[[], float]] = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set_function(self, function: Callable[[], float]):
+        """Determine the value by calling `function` whenever it is rendered."""
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function else self.value
+
+
+class HistogramChild:
+    __slots__ = ("buckets", "counts", "sum")
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Metric:
+    typ = "untyped"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        registry: Registry = REGISTRY,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        registry.register(self)
+
+    def _new_child(self):
+        raise NotImplementedError()  # pragma: no cover
+
+    def labels(self, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        if (child := self._children.get(key)) is None:
+            child = self._children[key] = self._new_child()
+        return child
+
+    def _label_pairs(self, key) -> Tuple[Tuple[str, str], ...]:
+        return tuple(zip(self.labelnames, key))
+
+    def samples(self):
+        for key, child in self._children.items():
+            yield self.name, self._label_pairs(key), child.value
+
+
+class Counter(Metric):
+    typ = "counter"
+
+    def _new_child(self):
+        return CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    typ = "gauge"
+
+    def _new_child(self):
+        return GaugeChild()
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def set_function(self, function: Callable[[], float]):
+        self.labels().set_function(function)
+
+    def samples(self):
+        for key, child in self._children.items():
+            yield self.name, self._label_pairs(key), child.get()
+
+
+class Histogram(Metric):
+    typ = "histogram"
+
+    def __init__(self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kwargs):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(*args, **kwargs)
+
+    def _new_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def samples(self):
+        for key, child in self._children.items():
+            labels = self._label_pairs(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                yield self.name + "_bucket", labels + (("le", le),), cumulative
+            yield self.name + "_sum", labels, child.sum
+            yield self.name + "_count", labels, cumulative
+
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+async def serve_metrics(host: str, port: int, registry: Registry = REGISTRY):
+    """Serve GET /metrics over plain HTTP, for processes that are not sanic apps."""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            if request_line.split(b" ")[:2] == [b"GET", b"/metrics"]:
+                body = registry.render().encode()
+                status = b"200 OK"
+            else:
+                body = b"Not Found\n"
+                status = b"404 Not Found"
+            writer.write(
+                b"HTTP/1.1 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n"
+                b"Connection: close\r\n\r\n%s"
+                % (status, CONTENT_TYPE.encode(), len(body), body)
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+# Metrics shared by the API and the worker
+
+SEAL_STAGE_SECONDS = Histogram(
+    "unchanging_ink_seal_stage_seconds",
+    "Duration of each stage of sealing an interval",
+    ["stage"],
+)
+INTERVALS_SEALED = Counter(
+    "unchanging_ink_intervals_sealed_total", "Intervals sealed by the worker"
+)
+PENDING_TIMESTAMPS = Gauge(
+    "unchanging_ink_pending_timestamps",
+    "Timestamps that were waiting to be sealed into the latest interval",
+)
+NODE_CACHE = Counter(
+    "unchanging_ink_node_cache_total",
+    "Merkle tree node cache lookups",
+    ["tier", "result"],
+)
+FANOUT_WAITERS = Gauge(
+    "unchanging_ink_fanout_waiters",
+    "Coroutines waiting for the next main tree head",
+)
+DB_POOL_WAIT_SECONDS = Histogram(
+    "unchanging_ink_db_pool_wait_seconds",
+    "Time spent getting a database connection from the pool",
+)
+DB_POOL_TIMEOUTS = Counter(
+    "unchanging_ink_db_pool_timeouts_total",
+    "Requests for a database connection that timed out waiting for the pool",
+)
+DB_POOL_CONNECTIONS = Gauge(
+    "unchanging_ink_db_pool_connections",
+    "Database connections of the pool, in use or idle",
+    ["state"],
+)
+DB_POOL_CAPACITY = Gauge(
+    "unchanging_ink_db_pool_capacity",
+    "Most database connections the pool opens at the same time",
+)
+DB_REPLICA_READS = Counter(
+    "unchanging_ink_db_replica_reads_total",
+    "Reads routed to a database replica, or to the primary because it was stale",
+    ["result"],
+)
+THROTTLED = Counter(
+    "unchanging_ink_throttled_total",
+    "Requests refused by admission control, by the limit that applied",
+    ["reason"],
+)
+
+WEBHOOK_DELIVERIES = Counter(
+    "unchanging_ink_webhook_deliveries_total",
+    "Timestamps POSTed to their callback URL, by outcome",
+    ["result"],
+)
+HASH_LOOKUPS = Counter(
+    "unchanging_ink_hash_lookups_total",
+    "Lookups of timestamps by hash, answered by the filter or the database",
+    ["result"],
+)
@@ -8,7 +8,9 @@ timestamp = sqlalchemy.Table(
     metadata,
     sqlalchemy.Column("id", uuid.UUIDType, primary_key=True),
     sqlalchemy.Column("timestamp", sqlalchemy.String(length=32), nullable=False),
-    sqlalchemy.Column("hash", sqlalchemy.LargeBinary(length=64), nullable=False),
+    sqlalchemy.Column(
+        "hash", sqlalchemy.LargeBinary(length=64), nullable=False, index=True
+    ),
     sqlalchemy.Column(
         "tag",
         sqlalchemy.String(length=36),
@@ -23,12 +25,90 @@ timestamp = sqlalchemy.Table(
         index=True,
     ),
     sqlalchemy.Column("proof", sqlalchemy.LargeBinary(), nullable=True),
+    # Position in the interval tree, instead of the proof, see itree.py
+    sqlalchemy.Column("position", sqlalchemy.Integer, nullable=True),
+)
+# For tag prefixes, LIKE 'prefix%' can only use an index in C collation order
+sqlalchemy.Index(
+    "ix_timestamp_tag_prefix",
+    timestamp.c.tag,
+    postgresql_ops={"tag": "varchar_pattern_ops"},
 )
 
 interval = sqlalchemy.Table(
     "interval",
     metadata,
     sqlalchemy.Column("id", sqlalchemy.BigInteger, primary_key=True),
-    sqlalchemy.Column("timestamp", sqlalchemy.String(length=32), nullable=False),
+    # Always UTC, with microseconds: sorts like the times it stands for
+    sqlalchemy.Column(
+        "timestamp", sqlalchemy.String(length=32), nullable=False, index=True
+    ),
     sqlalchemy.Column("ith", sqlalchemy.LargeBinary(length=64), nullable=False),
 )
+
+interval_tree = sqlalchemy.Table(
+    "interval_tree",
+    metadata,
+    sqlalchemy.Column(
+        "interval",
+        sqlalchemy.BigInteger,
+        sqlalchemy.ForeignKey("interval.id", deferrable=True),
+        primary_key=True,
+    ),
+    sqlalchemy.Column("width", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("tile_height", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("mth", sqlalchemy.String(), nullable=False),
+    sqlalchemy.Column("main_a", sqlalchemy.BigInteger, nullable=False),
+    sqlalchemy.Column("main_path", sqlalchemy.LargeBinary(), nullable=False),
+)
+
+interval_tile = sqlalchemy.Table(
+    "interval_tile",
+    metadata,
+    sqlalchemy.Column(
+        "interval",
+        sqlalchemy.BigInteger,
+        sqlalchemy.ForeignKey("interval_tree.interval", deferrable=True),
+        primary_key=True,
+    ),
+    sqlalchemy.Column("level", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("index", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("nodes", sqlalchemy.LargeBinary(), nullable=False),
+)
+
+hash_filter = sqlalchemy.Table(
+    "hash_filter",
+    metadata,
+    sqlalchemy.Column("first_interval", sqlalchemy.BigInteger, primary_key=True),
+    sqlalchemy.Column("last_interval", sqlalchemy.BigInteger, nullable=False),
+    sqlalchemy.Column("entries", sqlalchemy.BigInteger, nullable=False),
+    sqlalchemy.Column("closed", sqlalchemy.Boolean, nullable=False),
+    # zlib compressed, see hashfilter.py
+    sqlalchemy.Column("bits", sqlalchemy.LargeBinary(), nullable=False),
+)
+
+webhook = sqlalchemy.Table(
+    "webhook",
+    metadata,
+    # Deleted once the proof of the timestamp was delivered, see webhooks.py
+    sqlalchemy.Column(
+        "id", uuid.UUIDType, sqlalchemy.ForeignKey("timestamp.id"), primary_key=True
+    ),
+    sqlalchemy.Column("url", sqlalchemy.String(length=2048), nullable=False),
+    sqlalchemy.Column("attempts", sqlalchemy.Integer, nullable=False, default=0),
+    # Unix time of the next attempt
+    sqlalchemy.Column(
+        "next_attempt", sqlalchemy.Float, nullable=False, default=0, index=True
+    ),
+)
+
+epoch = sqlalchemy.Table(
+    "epoch",
+    metadata,
+    # Stored once all 2**EPOCH_BITS intervals are sealed, see epochs.py
+    sqlalchemy.Column("id", sqlalchemy.BigInteger, primary_key=True),
+    sqlalchemy.Column("first_interval", sqlalchemy.BigInteger, nullable=False),
+    sqlalchemy.Column("last_interval", sqlalchemy.BigInteger, nullable=False),
+    # The main tree node of the epoch's intervals
+    sqlalchemy.Column("head", sqlalchemy.LargeBinary(length=64), nullable=False),
+)
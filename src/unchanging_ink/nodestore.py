@@ -0,0 +1,272 @@
+"""Memory-mapped store of the perfect subtrees of the main tree.
+
+The node of size 2**level that starts at leaf index * 2**level is stored at
+offset index * 32 of the file `level-<level>`, so looking a node up is an
+offset into a memory map. Only the worker writes to the store, and it only
+ever appends leaves. Readers in other processes map the files read-only.
+
+The number of leaves covered is kept in the file `width`. It is written only
+after all the nodes it covers have been written, so that anything a crash
+leaves behind it is ignored, and overwritten by the next append.
+
+    unchanging-ink_rebuild_nodes
+
+rebuilds the store in NODE_STORE_DIRECTORY from the interval table, while
+the worker is stopped.
+"""
+import asyncio
+import fcntl
+import mmap
+import os
+import struct
+from typing import (AsyncIterator, Dict, Iterable, List, Optional, Sequence,
+                    Tuple)
+
+import structlog
+from sqlalchemy.engine import Row
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from .crypto import AbstractAsyncCachingMerkleTree, MerkleNode
+from .models import interval
+from .schemas import Interval
+
+HASH_SIZE = 32
+WIDTH_FILE = "width"
+WIDTH_FORMAT = "<Q"
+
+logger = structlog.getLogger(__name__)
+
+
+class NodeStore:
+    def __init__(self, directory: str, writable: bool = False):
+        self.directory = directory
+        self.writable = writable
+        self._fds: Dict[int, int] = {}
+        self._maps: Dict[int, mmap.mmap] = {}
+        self._width_fd: Optional[int] = None
+        self._width_map: Optional[mmap.mmap] = None
+        if writable:
+            os.makedirs(directory, exist_ok=True)
+            self._open_width()
+            try:
+                fcntl.flock(self._width_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise RuntimeError(f"{directory} is already opened for writing")
+
+    def _open_width(self) -> bool:
+        filename = os.path.join(self.directory, WIDTH_FILE)
+        if self.writable:
+            self._width_fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+            if os.fstat(self._width_fd).st_size < struct.calcsize(WIDTH_FORMAT):
+                os.pwrite(self._width_fd, struct.pack(WIDTH_FORMAT, 0), 0)
+        else:
+            try:
+                self._width_fd = os.open(filename, os.O_RDONLY)
+            except FileNotFoundError:
+                # The worker has not created the store yet
+                return False
+        self._width_map = mmap.mmap(
+            self._width_fd, struct.calcsize(WIDTH_FORMAT), access=mmap.ACCESS_READ
+        )
+        return True
+
+    def close(self):
+        for m in self._maps.values():
+            m.close()
+        for fd in self._fds.values():
+            os.close(fd)
+        if self._width_map is not None:
+            self._width_map.close()
+            os.close(self._width_fd)
+        self._maps, self._fds = {}, {}
+        self._width_fd = self._width_map = None
+
+    @property
+    def width(self) -> int:
+        """Number of leaves in the store."""
+        if self._width_map is None and not self._open_width():
+            return 0
+        return struct.unpack_from(WIDTH_FORMAT, self._width_map)[0]
+
+    def _fd(self, level: int) -> Optional[int]:
+        if (fd := self._fds.get(level)) is None:
+            filename = os.path.join(self.directory, f"level-{level}")
+            try:
+                fd = os.open(
+                    filename,
+                    (os.O_RDWR | os.O_CREAT) if self.writable else os.O_RDONLY,
+                    0o644,
+                )
+            except FileNotFoundError:
+                return None
+            self._fds[level] = fd
+        return fd
+
+    def _map(self, level: int, needed: int) -> Optional[mmap.mmap]:
+        """A map of `level` that is at least `needed` bytes long."""
+        if (fd := self._fd(level)) is None:
+            return None
+        size = os.fstat(fd).st_size
+        if size < needed:
+            return None
+        if (old := self._maps.pop(level, None)) is not None:
+            old.close()
+        self._maps[level] = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+        return self._maps[level]
+
+    def get(self, level: int, index: int) -> Optional[bytes]:
+        if (index + 1) << level > self.width:
+            return None
+        offset = index * HASH_SIZE
+        m = self._maps.get(level)
+        if m is None or len(m) < offset + HASH_SIZE:
+            if (m := self._map(level, offset + HASH_SIZE)) is None:
+                return None
+        return m[offset : offset + HASH_SIZE]
+
+    def get_node(self, start: int, end: int) -> Optional[bytes]:
+        """Value of the node (start, end) if it is a perfect subtree in the store."""
+        size = end - start
+        if size <= 0 or size & (size - 1) or start & (size - 1):
+            return None
+        level = size.bit_length() - 1
+        return self.get(level, start >> level)
+
+    def _write(self, level: int, index: int, value: bytes):
+        os.pwrite(self._fd(level), value, index * HASH_SIZE)
+
+    def _read(self, level: int, index: int) -> bytes:
+        return os.pread(self._fd(level), HASH_SIZE, index * HASH_SIZE)
+
+    def append_leaves(self, values: Iterable[bytes], sync: bool = True) -> int:
+        """Append leaf node values, and every parent they complete.
+
+        With `sync`, the nodes are on disk before the new width is written.
+        Returns the new width."""
+        assert self.writable
+        width = self.width
+        for value in values:
+            index, level = width, 0
+            self._write(level, index, value)
+            while index & 1:
+                value = MerkleNode.combine_digests(self._read(level, index - 1), value)
+                index, level = index >> 1, level + 1
+                self._write(level, index, value)
+            width += 1
+        if sync:
+            for fd in self._fds.values():
+                os.fsync(fd)
+        os.pwrite(self._width_fd, struct.pack(WIDTH_FORMAT, width), 0)
+        if sync:
+            os.fsync(self._width_fd)
+        return width
+
+    def load(self, width: int, levels: Sequence[bytes]):
+        """Replace the contents of the store with `levels`, the concatenated
+        node values of each level for a tree of `width` leaves."""
+        assert self.writable
+        self.truncate(0)
+        for level, data in enumerate(levels):
+            assert len(data) == (width >> level) * HASH_SIZE
+            os.pwrite(self._fd(level), data, 0)
+            os.fsync(self._fd(level))
+        os.pwrite(self._width_fd, struct.pack(WIDTH_FORMAT, width), 0)
+        os.fsync(self._width_fd)
+
+    def truncate(self, width: int):
+        """Forget all leaves from `width` on, they are overwritten by the next
+        append."""
+        assert self.writable and width <= self.width
+        os.pwrite(self._width_fd, struct.pack(WIDTH_FORMAT, width), 0)
+        os.fsync(self._width_fd)
+
+
+def leaf_value(row) -> bytes:
+    return MerkleNode.from_leaf(row.id, Interval.from_row(row).calculate_hash()).value
+
+
+async def interval_rows(
+    conn: AsyncConnection, start: int = 0, batch: int = 10000
+) -> AsyncIterator[List[Row]]:
+    """All interval rows from `start` on, in batches in order of their index."""
+    while True:
+        query = (
+            interval.select()
+            .where(interval.c.id >= start)
+            .order_by(interval.c.id)
+            .limit(batch)
+        )
+        rows = (await conn.execute(query)).all()
+        if not rows:
+            break
+        if rows[0].id != start or rows[-1].id != start + len(rows) - 1:
+            raise ValueError(f"Intervals are not contiguous after {start}")
+        yield rows
+        start += len(rows)
+
+
+async def sync_node_store(
+    store: NodeStore, conn: AsyncConnection, check: bool = True, batch: int = 10000
+):
+    """Append all intervals in the database that are not in the store yet.
+
+    With `check`, the store is first rebuilt from scratch if its last leaf
+    does not match the database."""
+    if check and store.width:
+        query = interval.select().where(interval.c.id == store.width - 1)
+        row = (await conn.execute(query)).first()
+        if row is None or leaf_value(row) != store.get(0, store.width - 1):
+            logger.warning("Node store does not match the database, rebuilding")
+            store.truncate(0)
+
+    async for rows in interval_rows(conn, store.width, batch):
+        store.append_leaves(leaf_value(row) for row in rows)
+
+
+class AbstractMmapCachingMerkleTree(AbstractAsyncCachingMerkleTree):
+    """Caches the perfect subtrees in a NodeStore, the other nodes are not cached.
+
+    If the store is writable, leaves computed in order are appended to it."""
+
+    CACHE_TIER = "mmap"
+
+    def __init__(self, node_store: NodeStore, *args, **kwargs):
+        self._node_store = node_store
+        super().__init__(*args, **kwargs)
+
+    async def seed(self, data: Dict[Tuple[int, int], MerkleNode]):
+        for key in sorted(data):
+            await self._setc(key, data[key])
+
+    async def _getc(self, key: Tuple[int, int]) -> Optional[MerkleNode]:
+        if (value := self._node_store.get_node(*key)) is None:
+            return None
+        return MerkleNode(key[0], key[1], value)
+
+    async def _setc(self, key: Tuple[int, int], value: MerkleNode):
+        if self._node_store.writable and key == (
+            self._node_store.width,
+            self._node_store.width + 1,
+        ):
+            self._node_store.append_leaves([value.value], sync=False)
+
+
+async def main_inner():
+    from .server import app, engine
+
+    if not app.config.NODE_STORE_DIRECTORY:
+        raise SystemExit("NODE_STORE_DIRECTORY is not set")
+    store = NodeStore(app.config.NODE_STORE_DIRECTORY, writable=True)
+    store.truncate(0)
+    async with engine.connect() as conn:
+        await sync_node_store(store, conn)
+    logger.info("Node store rebuilt", width=store.width)
+    await engine.dispose()
+
+
+def main():
+    asyncio.run(main_inner())
+
+
+if __name__ == "__main__":
+    main()
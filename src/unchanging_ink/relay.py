@@ -0,0 +1,111 @@
+"""Host-local relay of main tree heads from Redis to the Sanic worker processes.
+
+One relay per host keeps the only subscription to the mth-live channel and
+forwards every head over a Unix socket to the worker processes on that host,
+so that the number of Redis connections and the decoding work do not grow
+with the number of workers.
+
+The protocol on the socket is line based: a connecting worker sends the last
+interval index it knows (-1 if none) and then receives every retained head
+after it, followed by each new head as it is announced. A worker that does
+not keep up is disconnected and will catch up when it reconnects.
+"""
+import asyncio
+import os
+from typing import Set, Union
+
+import aioredis
+import structlog
+
+from .fanout import HeadHistory, backoff_delays
+
+logger = structlog.getLogger(__name__)
+
+# Bytes that may be buffered for a single worker before it is disconnected
+MAX_BUFFERED = 1024 * 1024
+
+
+class Relay:
+    def __init__(self, redis_url: str, history: int):
+        self._redis_url = redis_url
+        self._history = HeadHistory(history)
+        self._clients: Set[asyncio.StreamWriter] = set()
+
+    def _publish(self, data: Union[str, bytes]):
+        if (frame := self._history.append(data)) is None:
+            return
+        line = (frame.data + "\n").encode()
+        for writer in list(self._clients):
+            if writer.transport.get_write_buffer_size() > MAX_BUFFERED:
+                logger.warning("Disconnecting stalled worker")
+                self._clients.discard(writer)
+                writer.close()
+            else:
+                writer.write(line)
+
+    async def handle_client(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        try:
+            since = int((await reader.readline()) or -1)
+            writer.write(
+                b"".join(
+                    (frame.data + "\n").encode() for frame in self._history.since(since)
+                )
+            )
+            self._clients.add(writer)
+            await writer.drain()
+            # Workers never send anything after the greeting, wait for EOF
+            await reader.read()
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            self._clients.discard(writer)
+            writer.close()
+
+    async def subscribe(self):
+        delays = backoff_delays()
+        while True:
+            redis = aioredis.from_url(self._redis_url)
+            pubsub = redis.pubsub()
+            try:
+                await pubsub.subscribe("mth-live")
+                # Subscribe before catching up, so that no head falls between
+                for data in await redis.lrange("mth-history", 0, -1):
+                    self._publish(data)
+                logger.info("Relaying main tree heads")
+                delays = backoff_delays()
+                while True:
+                    message = await pubsub.get_message(
+                        ignore_subscribe_messages=True, timeout=11
+                    )
+                    if message:
+                        self._publish(message["data"])
+            except (aioredis.RedisError, OSError) as e:
+                delay = next(delays)
+                logger.warning("Redis subscription failed", error=e, retry=delay)
+                await asyncio.sleep(delay)
+            finally:
+                await pubsub.close()
+                await redis.close()
+
+    async def serve(self, socket_path: str):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = await asyncio.start_unix_server(self.handle_client, socket_path)
+        async with server:
+            await self.subscribe()
+
+
+def relay_main(socket_path: str, redis_url: str, history: int):
+    asyncio.run(Relay(redis_url, history).serve(socket_path))
+
+
+def main():
+    from .server import app, redis_url
+
+    relay_main(app.config.FANOUT_SOCKET, redis_url, app.config.MTH_HISTORY_LENGTH)
+
+
+if __name__ == "__main__":
+    main()
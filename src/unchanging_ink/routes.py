@@ -1,25 +1,43 @@
+import asyncio
 import base64
 import datetime
 import logging
 import uuid
-from typing import Type, TypeVar
+from typing import List, Optional, Type, TypeVar
+from urllib.parse import unquote
 
 import cbor2
+import sqlalchemy
 from accept_types import get_best_match
 from sanic import Sanic
-from sanic.exceptions import PayloadTooLarge
+from sanic.exceptions import (BadRequest, NotFound, PayloadTooLarge,
+                              ServiceUnavailable)
 from sanic.request import Request
 from sanic.response import HTTPResponse
 from sanic.response import json
 from sanic.response import json as json_response
 from sanic.response import text
+from sqlalchemy.ext.asyncio import AsyncConnection
 
 from .cache import MainMerkleTree
+from .crypto import DictCachingMerkleTree
+from .epochs import epoch_inclusion_proof
+from .fanout import HeadFrame
+from .itree import StoredIntervalTree, with_proofs
+from .metrics import CONTENT_TYPE, HASH_LOOKUPS, render
+from .models import epoch as epoch_model
 from .models import interval as interval_model
-from .models import timestamp
-from .schemas import (Interval, MainHead, MainTreeConsistencyProof,
-                      TimestampRequest, TimestampStructure, TimestampWithId, MainTreeInclusionProof,
-                      MainHeadWithConsistency)
+from .models import timestamp, webhook
+from .schemas import (BulkTimestampRequest, ConcreteTime, Epoch,
+                      EpochInclusionProof, Interval,
+                      IntervalMultiProofStructure, IntervalProofStructure,
+                      MainHead, MainHeadWithConsistency,
+                      MainTreeConsistencyProof, MainTreeInclusionProof,
+                      MultiProofRequest, TimestampList, TimestampLookupRequest,
+                      TimestampRequest, TimestampStructure, TimestampWithId,
+                      b64url_decode)
+from .throttle import throttle
+from .webhooks import WebhookError, check_url
 
 logger = logging.getLogger(__name__)
 
@@ -64,14 +82,89 @@ def data_to_response(
 
 
 def compact_encoding(app: Sanic, response: TimestampWithId):
+    proof = response.proof_structure
+    if proof.main_path is None:
+        head = ""
+        items = [proof.a, proof.path]
+    else:
+        # With the mth and the bundle the receipt verifies without requests
+        head = ":" + proof.mth.partition("#v1:")[2]
+        items = [
+            proof.a,
+            proof.path,
+            proof.interval_timestamp,
+            proof.main_a,
+            proof.main_path,
+        ]
     return (
-        f"{app.config.AUTHORITY}/{response.interval}#v1,{response.timestamp},"
-        + base64.urlsafe_b64encode(cbor2.dumps([response.proof.a, response.proof.path]))
-        .decode()
-        .rstrip("=")
+        f"{app.config.AUTHORITY}/{response.interval}#v1{head},{response.timestamp},"
+        + base64.urlsafe_b64encode(cbor2.dumps(items)).decode().rstrip("=")
     )
 
 
+def parse_time(value: str) -> ConcreteTime:
+    """An ISO 8601 time in the form the worker stores them in, UTC with
+    microseconds. Times without a timezone are taken to be UTC."""
+    try:
+        when = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=datetime.timezone.utc)
+        # Overflows near the ends of the datetime range
+        when = when.astimezone(datetime.timezone.utc)
+    except (ValueError, OverflowError):
+        raise BadRequest("Expected an ISO 8601 time")
+    return when.isoformat(timespec="microseconds").replace("+00:00", "Z")
+
+
+async def interval_at(
+    conn: AsyncConnection, when: ConcreteTime, before: bool = False
+) -> Optional[int]:
+    """The first interval sealed at or after `when`, or with `before` the last
+    one sealed at or before it."""
+    column = interval_model.c.timestamp
+    query = sqlalchemy.select(interval_model.c.id).limit(1)
+    if before:
+        query = query.where(column <= when).order_by(column.desc())
+    else:
+        query = query.where(column >= when).order_by(column)
+    return await conn.scalar(query)
+
+
+def live_cursor(request: Request, last_event_id: Optional[str] = None) -> int:
+    """Interval after which a live stream starts: `since`, or the current head."""
+    since = last_event_id or request.args.get("since")
+    if since is None:
+        latest = request.app.ctx.mth_history.latest
+        return -1 if latest is None else latest.index
+    try:
+        return int(since)
+    except ValueError:
+        raise BadRequest("since must be an interval index")
+
+
+async def next_frames(
+    app: Sanic, since: int, timeout: Optional[float] = None
+) -> List[HeadFrame]:
+    while True:
+        # Taken before looking at the history, so that a head arriving in
+        # between makes wait_after() return immediately
+        seq = app.ctx.fanout.seq
+        if frames := app.ctx.mth_history.since(since):
+            return frames
+        await app.ctx.fanout.wait_after(seq, timeout)
+
+
+def apply_backlog_policy(
+    app: Sanic, frames: List[HeadFrame]
+) -> Optional[List[HeadFrame]]:
+    """Frames to send to a live stream client, or None if it is to be disconnected."""
+    if len(frames) <= app.config.LIVE_MAX_BACKLOG:
+        return frames
+    if app.config.LIVE_SLOW_CONSUMER == "disconnect":
+        return None
+    return frames[-1:]
+
+
 def setup_routes(app: Sanic):
     def prefixed_url_for(*args, **kwargs):
         # FIXME make work for _external=True
@@ -80,28 +173,52 @@ def setup_routes(app: Sanic):
 
     app.ctx.prefixed_url_for = prefixed_url_for
 
-    @app.route("/ts/", version=1, methods=["GET", "POST"])  # FIXME Throttling
+    def main_tree(redisconn, conn, **kwargs) -> MainMerkleTree:
+        return MainMerkleTree(
+            redisconn,
+            conn,
+            node_store=app.ctx.node_store,
+            epochs=app.ctx.epochs,
+            concurrency=app.config.MERKLE_CONCURRENCY,
+            layout=app.config.REDIS_NODE_LAYOUT,
+            **kwargs,
+        )
+
+    async def refresh_epochs(conn: AsyncConnection, width: int):
+        """Before using main_tree() for a main tree of `width` intervals."""
+        if app.ctx.epochs is not None:
+            await app.ctx.epochs.refresh(conn, width)
+
+    @app.route("/ts/", version=1, methods=["GET", "POST"])
     async def request_timestamp(request: Request) -> HTTPResponse:
         if request.method == "GET":  # FIXME Remove
             query = timestamp.select()
 
-            async with app.ctx.engine.begin() as conn:
+            async with (await app.ctx.replicas.engine()).begin() as conn:
                 result = await conn.execute(query)
-                rows = result.all()
+                rows = await with_proofs(conn, result.all())
                 return json_response(
-                    [
-                        TimestampWithId.from_dict(row._asdict()).as_json_data()
-                        for row in rows
-                    ]
+                    [TimestampWithId.from_dict(row).as_json_data() for row in rows]
                 )
 
         elif request.method == "POST":
+            await throttle(request)
+            await app.ctx.admission.check(
+                app.ctx.redis, app.ctx.mth_history, app.config.INTERVAL_SECONDS
+            )
             tag = None
+            callback = None
             wait = False
             compact = False
             for (k, v) in request.get_query_args(keep_blank_values=True):
                 if k == "tag" and len(v) <= 36:
                     tag = v
+                elif k == "callback":
+                    try:
+                        check_url(v, app.config.WEBHOOK_ALLOW_PRIVATE)
+                    except WebhookError as e:
+                        raise BadRequest(str(e)) from e
+                    callback = v
                 elif k == "wait":
                     wait = True
                 elif k == "compact":
@@ -129,18 +246,28 @@ def setup_routes(app: Sanic):
 
             data = {"id": st_id, "timestamp": now, "hash": hash_, "tag": tag}
 
+            seq = request.app.ctx.fanout.seq
             async with app.ctx.engine.begin() as conn:
                 await conn.execute(timestamp.insert(), data)
+                if callback is not None:
+                    await conn.execute(webhook.insert(), {"id": st_id, "url": callback})
+            await app.ctx.admission.added(app.ctx.redis)
 
             if wait:
                 # FIXME Timeout
-                await request.app.ctx.fanout.wait()
-                async with app.ctx.engine.begin() as conn:
-                    result = await conn.execute(
-                        timestamp.select().where(timestamp.c.id == st_id)
-                    )
-                    row = result.first()
-                    response = TimestampWithId.from_dict(row._asdict())
+                row = None
+                while row is None or row.interval is None:
+                    # An interval that was already being sealed during the
+                    # insert will not contain it, keep waiting for the next one
+                    seq = (await request.app.ctx.fanout.wait_after(seq))[-1][0]
+                    async with app.ctx.engine.begin() as conn:
+                        result = await conn.execute(
+                            timestamp.select().where(timestamp.c.id == st_id)
+                        )
+                        row = result.first()
+                        if row.interval is not None:
+                            (sealed,) = await with_proofs(conn, [row])
+                response = TimestampWithId.from_dict(sealed)
 
             else:
                 response = TimestampWithId.from_dict(data)
@@ -157,8 +284,9 @@ def setup_routes(app: Sanic):
             else:
                 return data_to_response(request, response, headers=headers)
 
-    @app.route("/ts/<id_:uuid>", version=1, methods=["GET"])  # FIXME Throttling
+    @app.route("/ts/<id_:uuid>", version=1, methods=["GET"])
     async def request_timestamp_one(request: Request, id_: uuid.UUID) -> HTTPResponse:
+        await throttle(request)
         compact = False
         wait = False
         for (k, v) in request.get_query_args(keep_blank_values=True):
@@ -168,43 +296,383 @@ def setup_routes(app: Sanic):
                 wait = True
 
         query = timestamp.select(timestamp.c.id == id_)
-        async with app.ctx.engine.begin() as conn:
-            result = await conn.execute(query)
-            row = result.first()
-
-            if wait and not row.proof:
-                # FIXME Timeout
-                await request.app.ctx.fanout.wait()
-
+        seq = request.app.ctx.fanout.seq
+        row = None
+        engine = app.ctx.engine if wait else await app.ctx.replicas.engine()
+        if engine is not app.ctx.engine:
+            async with engine.begin() as conn:
                 result = await conn.execute(query)
                 row = result.first()
+                if row is not None and row.interval is None:
+                    # The replica may not have replayed the proof yet
+                    row = None
+                if row is not None:
+                    (row,) = await with_proofs(conn, [row])
+
+        while row is None:
+            # Not holding a connection while waiting, a fresh one for each try
+            async with app.ctx.engine.begin() as conn:
+                row = (await conn.execute(query)).first()
+                if row is None:
+                    raise NotFound("No such timestamp")
+                if wait and row.interval is None:
+                    row = None
+                else:
+                    (row,) = await with_proofs(conn, [row])
+            if row is None:
+                # FIXME Timeout
+                seq = (await request.app.ctx.fanout.wait_after(seq))[-1][0]
 
-        response = TimestampWithId.from_dict(row._asdict())
+        response = TimestampWithId.from_dict(row)
 
         if compact:
             return text(compact_encoding(app, response))
 
         return data_to_response(request, response)
 
+    @app.route("/ts/multiproof", version=1, methods=["POST"])
+    async def request_multiproof(request: Request) -> HTTPResponse:
+        try:
+            ids = [
+                uuid.UUID(id_)
+                for id_ in data_from_request(request, MultiProofRequest).ids
+            ]
+        except (TypeError, ValueError, AttributeError) as e:
+            raise BadRequest("Expected a list of timestamp ids") from e
+
+        if not ids or len(set(ids)) != len(ids):
+            raise BadRequest("Expected a list of distinct timestamp ids")
+        if len(ids) > app.config.MULTIPROOF_MAX_IDS:
+            raise PayloadTooLarge()
+
+        def sealed(rows):
+            return len(rows) == len(ids) and all(
+                row.interval is not None for row in rows.values()
+            )
+
+        query = timestamp.select().where(timestamp.c.id.in_(ids))
+        engine = await app.ctx.replicas.engine()
+        async with engine.begin() as conn:
+            rows = {row.id: row for row in await conn.execute(query)}
+        if not sealed(rows) and engine is not app.ctx.engine:
+            # Or the replica has not replayed all of them yet
+            engine = app.ctx.engine
+            async with engine.begin() as conn:
+                rows = {row.id: row for row in await conn.execute(query)}
+        if not sealed(rows):
+            raise NotFound("Not all timestamps exist and have been sealed")
+        if len({row.interval for row in rows.values()}) != 1:
+            raise BadRequest("All timestamps must be in the same interval")
+
+        interval = next(iter(rows.values())).interval
+        if rows[ids[0]].position is not None:
+            # Sealed with the "tree" storage, which has the positions and nodes
+            positions = [rows[id_].position for id_ in ids]
+            async with engine.begin() as conn:
+                tree = await StoredIntervalTree.load(conn, interval)
+                nodes = await tree.multiproof(conn, positions)
+            response = IntervalMultiProofStructure(
+                width=tree.width,
+                positions=positions,
+                nodes=nodes,
+                ith=tree.ith,
+                mth=tree.mth,
+            )
+            return data_to_response(request, response)
+
+        # The interval tree has the interval's timestamps in the order the
+        # worker sealed them in. Sealed in one transaction with the proofs, so
+        # the engine that has the proofs has all of them. Rebuilding it is
+        # bounded by MULTIPROOF_MAX_INTERVAL, the "tree" storage has no limit.
+        async with engine.begin() as conn:
+            result = await conn.execute(
+                sqlalchemy.select([timestamp.c.id, timestamp.c.hash])
+                .where(timestamp.c.interval == interval)
+                .order_by("timestamp", "hash")
+                .limit(app.config.MULTIPROOF_MAX_INTERVAL + 1)
+            )
+            leaves = result.all()
+        if len(leaves) > app.config.MULTIPROOF_MAX_INTERVAL:
+            raise BadRequest(
+                f"No multiproofs in intervals of more than "
+                f"{app.config.MULTIPROOF_MAX_INTERVAL} timestamps"
+            )
+
+        tree = await DictCachingMerkleTree.from_sequence(row.hash for row in leaves)
+        position_of = {row.id: i for (i, row) in enumerate(leaves)}
+        positions = [position_of[id_] for id_ in ids]
+        nodes = await tree.compute_multiproof(positions)
+
+        proof = IntervalProofStructure.from_cbor(rows[ids[0]].proof)
+        response = IntervalMultiProofStructure(
+            width=tree.width,
+            positions=positions,
+            nodes=[node.value for node in nodes],
+            ith=proof.ith,
+            mth=proof.mth,
+        )
+        return data_to_response(request, response)
+
+    async def bulk_timestamps(
+        request: Request, query, ids: Optional[List[uuid.UUID]] = None
+    ) -> HTTPResponse:
+        """All timestamps `query` selects, in the order of `ids` if given.
+        With `wait`, once all of them are sealed, or a 503 after BULK_WAIT_TIMEOUT
+        seconds."""
+        wait = False
+        for (k, v) in request.get_query_args(keep_blank_values=True):
+            if k == "wait":
+                wait = True
+
+        def complete(rows):
+            if len(rows) > app.config.BULK_MAX_TIMESTAMPS:
+                raise BadRequest(
+                    f"More than {app.config.BULK_MAX_TIMESTAMPS} timestamps match"
+                )
+            return ids is None or len(rows) == len(ids)
+
+        def sealed(rows):
+            return all(row.interval is not None for row in rows)
+
+        seq = request.app.ctx.fanout.seq
+        deadline = asyncio.get_running_loop().time() + app.config.BULK_WAIT_TIMEOUT
+        rows = None
+        if wait or ids is None:
+            # A replica that has not replayed a timestamp yet would leave it out
+            # of the timestamps with a tag without notice, tags are always
+            # looked up on the primary
+            engine = app.ctx.engine
+        else:
+            engine = await app.ctx.replicas.engine()
+        if engine is not app.ctx.engine:
+            async with engine.begin() as conn:
+                rows = (await conn.execute(query)).all()
+                if complete(rows) and sealed(rows):
+                    rows = await with_proofs(conn, rows)
+                else:
+                    # The replica may not have replayed all of them yet
+                    rows = None
+
+        while rows is None:
+            async with app.ctx.engine.begin() as conn:
+                rows = (await conn.execute(query)).all()
+                if not complete(rows):
+                    raise NotFound("Not all timestamps exist")
+                if wait and not sealed(rows):
+                    rows = None
+                else:
+                    rows = await with_proofs(conn, rows)
+            if rows is None:
+                timeout = deadline - asyncio.get_running_loop().time()
+                try:
+                    seq = (
+                        await request.app.ctx.fanout.wait_after(seq, max(timeout, 0))
+                    )[-1][0]
+                except asyncio.TimeoutError:
+                    raise ServiceUnavailable("Not all timestamps sealed yet")
+
+        if ids is not None:
+            order = {id_: i for (i, id_) in enumerate(ids)}
+            rows.sort(key=lambda row: order[row["id"]])
+        response = TimestampList([TimestampWithId.from_dict(row) for row in rows])
+        return data_to_response(request, response)
+
+    @app.route("/ts/bulk", version=1, methods=["POST"])
+    async def request_timestamp_bulk(request: Request) -> HTTPResponse:
+        try:
+            ids = [
+                uuid.UUID(id_)
+                for id_ in data_from_request(request, BulkTimestampRequest).ids
+            ]
+        except (TypeError, ValueError, AttributeError) as e:
+            raise BadRequest("Expected a list of timestamp ids") from e
+
+        if not ids or len(set(ids)) != len(ids):
+            raise BadRequest("Expected a list of distinct timestamp ids")
+        if len(ids) > app.config.BULK_MAX_TIMESTAMPS:
+            raise PayloadTooLarge()
+        query = timestamp.select().where(timestamp.c.id.in_(ids))
+        return await bulk_timestamps(request, query, ids)
+
+    def tagged(condition):
+        return (
+            timestamp.select()
+            .where(condition)
+            .order_by(timestamp.c.timestamp, timestamp.c.id)
+            # One more, to tell that there are too many
+            .limit(app.config.BULK_MAX_TIMESTAMPS + 1)
+        )
+
+    @app.route("/ts/tag/<tag:str>", version=1, methods=["GET"])
+    async def request_timestamp_tag(request: Request, tag: str) -> HTTPResponse:
+        query = tagged(timestamp.c.tag == unquote(tag))
+        return await bulk_timestamps(request, query)
+
+    @app.route("/ts/tag-prefix/<prefix:str>", version=1, methods=["GET"])
+    async def request_timestamp_tag_prefix(
+        request: Request, prefix: str
+    ) -> HTTPResponse:
+        prefix = unquote(prefix)
+        query = tagged(
+            sqlalchemy.and_(
+                timestamp.c.tag.startswith(prefix, autoescape=True),
+                # LIKE ignores case in SQLite
+                sqlalchemy.func.substr(timestamp.c.tag, 1, len(prefix)) == prefix,
+            )
+        )
+        return await bulk_timestamps(request, query)
+
+    lookup_filtered = HASH_LOOKUPS.labels(result="filtered")
+    lookup_found = HASH_LOOKUPS.labels(result="found")
+    lookup_not_found = HASH_LOOKUPS.labels(result="not_found")
+
+    async def lookup_hashes(request: Request, hashes: List[bytes]) -> HTTPResponse:
+        """The sealed timestamp with one of `hashes`, if there is one."""
+        latest = app.ctx.mth_history.latest
+        needed = None if latest is None else latest.index
+        hash_filter = app.ctx.hash_filter
+        if app.config.HASH_FILTER_BITS and needed is not None:
+            if hash_filter.covered < needed:
+                async with (await app.ctx.replicas.engine(needed)).connect() as conn:
+                    await hash_filter.refresh(conn, needed)
+            # The filters only answer for the intervals they cover, younger
+            # ones are looked up
+            if hash_filter.covered >= needed and not any(
+                hash_filter.may_contain(hash_) for hash_ in hashes
+            ):
+                lookup_filtered.inc()
+                raise NotFound("No sealed timestamp with this hash")
+
+        query = (
+            timestamp.select()
+            .where(timestamp.c.hash.in_(hashes), timestamp.c.interval.isnot(None))
+            .limit(1)
+        )
+        async with (await app.ctx.replicas.engine(needed)).begin() as conn:
+            rows = await with_proofs(conn, (await conn.execute(query)).all())
+        if not rows:
+            lookup_not_found.inc()
+            raise NotFound("No sealed timestamp with this hash")
+        lookup_found.inc()
+        return data_to_response(request, TimestampWithId.from_dict(rows[0]))
+
+    @app.route("/ts/hash/<hash_:str>", version=1, methods=["GET"])
+    async def request_timestamp_by_hash(request: Request, hash_: str) -> HTTPResponse:
+        try:
+            value = b64url_decode(hash_)
+        except ValueError as e:
+            raise BadRequest("Expected a base64url encoded hash") from e
+        if len(value) != 32:
+            raise BadRequest("Expected a base64url encoded hash")
+        return await lookup_hashes(request, [value])
+
+    @app.route("/ts/lookup", version=1, methods=["POST"])
+    async def request_timestamp_lookup(request: Request) -> HTTPResponse:
+        try:
+            lookup = data_from_request(request, TimestampLookupRequest)
+            # POST ?compact timestamps the body as bytes, JSON and CBOR
+            # requests timestamp it as text. Bytes in a CBOR lookup can only
+            # have been timestamped as bytes.
+            if isinstance(lookup.data, bytes):
+                candidates = [lookup.data]
+            else:
+                candidates = [lookup.data, lookup.data.encode()]
+            hashes = [
+                TimestampStructure(
+                    data=data, timestamp=lookup.timestamp
+                ).calculate_hash()
+                for data in candidates
+            ]
+        except (TypeError, AttributeError) as e:
+            raise BadRequest("Expected data and the timestamp it was given") from e
+        return await lookup_hashes(request, hashes)
+
     @app.route("/hello")
     async def hello(request: Request) -> HTTPResponse:
         return json_response({"Hello": "World"})
 
+    if app.config.METRICS_ENABLED:
+
+        @app.route("/metrics")
+        async def metrics(request: Request) -> HTTPResponse:
+            return text(render(), content_type=CONTENT_TYPE)
+
     @app.websocket("/mth/live", version=1)
     async def mth_live(request, ws):
+        since = live_cursor(request)
+        replay = True
+        while True:
+            frames = await next_frames(app, since)
+            if not replay:
+                frames = apply_backlog_policy(app, frames)
+                if frames is None:
+                    await ws.close(1008, "Consumer too slow")
+                    return
+            replay = False
+            for frame in frames:
+                try:
+                    await asyncio.wait_for(
+                        ws.send(frame.data), app.config.LIVE_SEND_TIMEOUT
+                    )
+                except asyncio.TimeoutError:
+                    logger.info("Dropping stalled live stream client")
+                    return
+                since = frame.index
+
+    @app.route("/mth/live/events", version=1, methods=["GET"])
+    async def mth_live_events(request):
+        since = live_cursor(request, request.headers.get("last-event-id"))
+        response = await request.respond(
+            content_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+        replay = True
         while True:
-            data = await request.app.ctx.fanout.wait()
-            await ws.send(data)
+            try:
+                frames = await next_frames(app, since, app.config.LIVE_KEEPALIVE)
+            except asyncio.TimeoutError:
+                frames = []
+            if not replay:
+                frames = apply_backlog_policy(app, frames)
+                if frames is None:
+                    break
+            replay = False
+            try:
+                await asyncio.wait_for(
+                    response.send(
+                        b"".join(frame.event for frame in frames) or b":\n\n"
+                    ),
+                    app.config.LIVE_SEND_TIMEOUT,
+                )
+            except asyncio.TimeoutError:
+                logger.info("Dropping stalled event stream client")
+                break
+            if frames:
+                since = frames[-1].index
+        await response.eof()
+
+    @app.route("/mth/live/poll", version=1, methods=["GET"])
+    async def mth_live_poll(request):
+        since = live_cursor(request)
+        try:
+            frames = await next_frames(app, since, app.config.LIVE_POLL_TIMEOUT)
+        except asyncio.TimeoutError:
+            frames = []
+        return HTTPResponse(
+            "[" + ",".join(frame.data for frame in frames) + "]",
+            content_type="application/json",
+            headers={"Cache-Control": "no-cache"},
+        )
 
-    @app.route("/mth/<interval:int>", version=1, methods=["GET"])
-    async def request_mth_one(request, interval):
-        async with app.ctx.engine.begin() as conn, app.ctx.redis.client() as redisconn:
-            tree = MainMerkleTree(redisconn, conn)
+    async def main_head(engine, interval: int) -> MainHeadWithConsistency:
+        async with engine.begin() as conn, app.ctx.redis.client() as redisconn:
+            await refresh_epochs(conn, interval + 1)
+            tree = main_tree(redisconn, conn)
             root_node = await tree.recalculate_root(interval + 1)
-            proof_nodes = await tree.compute_consistency_proof(interval - 1)
             if interval < 2:
                 append_proof = None
             else:
+                proof_nodes = await tree.compute_consistency_proof(interval - 1)
                 append_proof = MainTreeConsistencyProof(
                     interval - 1,
                     interval,
@@ -218,20 +686,46 @@ def setup_routes(app: Sanic):
 
         from unchanging_ink.server import authority_base_url
 
-        response = MainHeadWithConsistency(
+        return MainHeadWithConsistency(
             authority=authority_base_url,
             interval=Interval.from_row(row),
             mth=root_node.value,
             consistency=append_proof,
         )
+
+    @app.route("/mth/<interval:int>", version=1, methods=["GET"])
+    async def request_mth_one(request, interval):
+        engine = await app.ctx.replicas.engine(interval)
+        response = await main_head(engine, interval)
         return data_to_response(request, response, immutable=True)
 
+    @app.route("/mth/at/<when:str>", version=1, methods=["GET"])
+    async def request_mth_at(request, when):
+        """The head of the first interval sealed at or after `when`, or with
+        `?before` of the last one sealed at or before it."""
+        when = parse_time(unquote(when))
+        before = False
+        for (k, v) in request.get_query_args(keep_blank_values=True):
+            if k == "before":
+                before = True
+        latest = app.ctx.mth_history.latest
+        engine = await app.ctx.replicas.engine(None if latest is None else latest.index)
+        async with engine.begin() as conn:
+            interval = await interval_at(conn, when, before)
+        if interval is None:
+            raise NotFound("No interval was sealed then")
+        # Later intervals may still be sealed before a time in the future
+        response = await main_head(engine, interval)
+        return data_to_response(request, response)
+
     @app.route(
         "/mth/<new_interval:int>/from/<old_interval:int>", version=1, methods=["GET"]
     )
     async def request_mth_consistency(request, new_interval, old_interval):
-        async with app.ctx.engine.begin() as conn, app.ctx.redis.client() as redisconn:
-            tree = MainMerkleTree(redisconn, conn, width=new_interval)
+        engine = await app.ctx.replicas.engine(new_interval - 1)
+        async with engine.begin() as conn, app.ctx.redis.client() as redisconn:
+            await refresh_epochs(conn, new_interval)
+            tree = main_tree(redisconn, conn, width=new_interval)
             proof = await tree.compute_consistency_proof(old_interval)
         response = MainTreeConsistencyProof(
             old_interval, new_interval, [node.value for node in proof]
@@ -242,10 +736,45 @@ def setup_routes(app: Sanic):
         "/mth/<old_interval:int>/in/<new_interval:int>", version=1, methods=["GET"]
     )
     async def request_mth_inclusion(request, new_interval, old_interval):
-        async with app.ctx.engine.begin() as conn, app.ctx.redis.client() as redisconn:
-            tree = MainMerkleTree(redisconn, conn, width=new_interval)
+        engine = await app.ctx.replicas.engine(new_interval - 1)
+        async with engine.begin() as conn, app.ctx.redis.client() as redisconn:
+            await refresh_epochs(conn, new_interval)
+            tree = main_tree(redisconn, conn, width=new_interval)
             a, proof = await tree.compute_inclusion_proof(old_interval)
         response = MainTreeInclusionProof(
             old_interval, new_interval, a, [node.value for node in proof]
         )
         return data_to_response(request, response, immutable=True)
+
+    async def complete_epoch(engine, index: int):
+        if app.ctx.epochs is None:
+            raise NotFound("There are no epochs")
+        async with engine.begin() as conn:
+            query = epoch_model.select().where(epoch_model.c.id == index)
+            row = (await conn.execute(query)).first()
+        if row is None:
+            raise NotFound("The epoch is not complete")
+        return Epoch.from_row(row)
+
+    @app.route("/epoch/<index:int>", version=1, methods=["GET"])
+    async def request_epoch(request, index):
+        epochs = app.ctx.epochs
+        last = None if epochs is None else ((index + 1) << epochs.bits) - 1
+        response = await complete_epoch(await app.ctx.replicas.engine(last), index)
+        return data_to_response(request, response, immutable=True)
+
+    @app.route("/epoch/<index:int>/in/<new_interval:int>", version=1, methods=["GET"])
+    async def request_epoch_inclusion(request, index, new_interval):
+        engine = await app.ctx.replicas.engine(new_interval - 1)
+        await complete_epoch(engine, index)
+        bits = app.config.EPOCH_BITS
+        if new_interval < (index + 1) << bits:
+            raise BadRequest("The epoch is not complete in that main tree")
+        async with engine.begin() as conn, app.ctx.redis.client() as redisconn:
+            await refresh_epochs(conn, new_interval)
+            tree = main_tree(redisconn, conn, width=new_interval)
+            a, proof = await epoch_inclusion_proof(tree, bits, new_interval, index)
+        response = EpochInclusionProof(
+            index, new_interval, a, [node.value for node in proof]
+        )
+        return data_to_response(request, response, immutable=True)
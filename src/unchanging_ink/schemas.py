@@ -1,8 +1,9 @@
 import base64
 import uuid
 from dataclasses import asdict, dataclass
+from functools import lru_cache
 from hashlib import sha3_256
-from typing import Optional, TypeVar
+from typing import List, Optional, TypeVar, Union
 
 import cbor2
 import orjson
@@ -11,6 +12,27 @@ ConcreteTime = TypeVar("ConcreteTime", bound=str)
 CompactRepr = TypeVar("CompactRepr", bound=str)
 
 
+def b64url_decode(data: str) -> bytes:
+    """Base64url, as in compact timestamps and URLs, padded or not."""
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+class EncodedCBOR:
+    """A data item that is already CBOR encoded and is copied verbatim into the
+    output."""
+
+    __slots__ = ("data",)
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+
+def write_encoded_cbor(encoder: cbor2.CBOREncoder, value):
+    if not isinstance(value, EncodedCBOR):
+        raise cbor2.CBOREncodeError(f"cannot serialize type {type(value)!r}")
+    encoder.write(value.data)
+
+
 class CBORMixin:
     @classmethod
     def from_cbor(cls, data: bytes):
@@ -59,36 +81,120 @@ class IntervalProofStructure(CBORMixin, JSONMixin):
     path: list[bytes]
     ith: bytes
     mth: CompactRepr
+    # Bundled by the worker since the main tree proof was added: together with
+    # the interval index from `mth` and `ith` these make up the interval, whose
+    # hash `main_a` and `main_path` trace to the main tree hash in `mth`.
+    # Omitted from the encoding if not set.
+    interval_timestamp: Optional[ConcreteTime] = None
+    main_a: Optional[int] = None
+    main_path: Optional[list[bytes]] = None
 
-    def as_json_data(self):
+    BUNDLE_FIELDS = ("interval_timestamp", "main_a", "main_path")
+
+    def as_cbor_data(self):
         data = asdict(self)
+        if self.main_path is None:
+            for field in self.BUNDLE_FIELDS:
+                del data[field]
+        return data
+
+    def to_cbor(self) -> bytes:
+        return cbor2.dumps(self.as_cbor_data(), canonical=True)
+
+    def as_json_data(self):
+        data = self.as_cbor_data()
         data["path"] = [base64.b64encode(x).decode() for x in data["path"]]
         data["ith"] = base64.b64encode(data["ith"]).decode() if data["ith"] else None
+        if "main_path" in data:
+            data["main_path"] = [
+                base64.b64encode(x).decode() for x in data["main_path"]
+            ]
+        return data
+
+
+@dataclass
+class IntervalMultiProofStructure(CBORMixin, JSONMixin):
+    """Proof of several leaves of one interval tree at once.
+
+    `nodes` are the values of the nodes returned by multiproof_node_addresses()
+    for `width` and `positions`, in that order."""
+
+    width: int
+    positions: list[int]
+    nodes: list[bytes]
+    ith: bytes
+    mth: CompactRepr
+
+    def as_json_data(self):
+        data = asdict(self)
+        data["nodes"] = [base64.b64encode(x).decode() for x in data["nodes"]]
+        data["ith"] = base64.b64encode(data["ith"]).decode()
         return data
 
 
+@dataclass
+class MultiProofRequest(CBORMixin, JSONMixin):
+    ids: list[str]
+
+
+@dataclass
+class BulkTimestampRequest(CBORMixin, JSONMixin):
+    ids: list[str]
+
+
+@dataclass
+class TimestampLookupRequest(CBORMixin, JSONMixin):
+    data: str
+    # The timestamp the server gave it, it is part of the hash
+    timestamp: ConcreteTime
+
+
+@lru_cache(maxsize=4096)
+def proof_json_data(proof: bytes) -> dict:
+    # Shared between all callers, must not be modified
+    return IntervalProofStructure.from_cbor(proof).as_json_data()
+
+
 @dataclass
 class Timestamp(CBORMixin, JSONMixin):
     hash: bytes
     timestamp: ConcreteTime
     typ: str = "ts"
     version: str = "1"
-    proof: Optional[IntervalProofStructure] = None
+    # Either decoded, or the CBOR encoding as stored in the database. The
+    # latter is passed through to CBOR responses without being decoded.
+    proof: Optional[Union[IntervalProofStructure, bytes]] = None
 
     def __post_init__(self):
+        if isinstance(self.proof, dict):
+            self.proof = IntervalProofStructure(**self.proof)
+
+    @property
+    def proof_structure(self) -> Optional[IntervalProofStructure]:
+        if isinstance(self.proof, bytes):
+            return IntervalProofStructure.from_cbor(self.proof)
+        return self.proof
+
+    def as_cbor_data(self):
+        data = asdict(self)
         if isinstance(self.proof, bytes):
-            self.proof = IntervalProofStructure.from_cbor(self.proof)
+            data["proof"] = EncodedCBOR(self.proof)
+        elif self.proof:
+            data["proof"] = self.proof.as_cbor_data()
+        return data
+
+    def to_cbor(self) -> bytes:
+        return cbor2.dumps(
+            self.as_cbor_data(), canonical=True, default=write_encoded_cbor
+        )
 
     def as_json_data(self):
         data = asdict(self)
         data["hash"] = base64.b64encode(data["hash"]).decode()
-        if data["proof"]:
-            if "ith" in data["proof"]:
-                data["proof"]["ith"] = base64.b64encode(data["proof"]["ith"]).decode()
-            if "path" in data["proof"]:
-                data["proof"]["path"] = [
-                    base64.b64encode(x).decode() for x in data["proof"]["path"]
-                ]
+        if isinstance(self.proof, bytes):
+            data["proof"] = proof_json_data(self.proof)
+        elif self.proof:
+            data["proof"] = self.proof.as_json_data()
         return data
 
 
@@ -104,7 +210,24 @@ class TimestampWithId(Timestamp):
 
     @classmethod
     def from_dict(cls, row):
-        return cls(**{k: v for (k, v) in row.items() if k not in ("tag",)})
+        return cls(**{k: v for (k, v) in row.items() if k not in ("tag", "position")})
+
+
+@dataclass
+class TimestampList:
+    """Several timestamps, encoded as an array of them."""
+
+    timestamps: List[TimestampWithId]
+
+    def to_cbor(self) -> bytes:
+        return cbor2.dumps(
+            [ts.as_cbor_data() for ts in self.timestamps],
+            canonical=True,
+            default=write_encoded_cbor,
+        )
+
+    def to_json(self) -> bytes:
+        return orjson.dumps([ts.as_json_data() for ts in self.timestamps])
 
 
 @dataclass
@@ -152,6 +275,46 @@ class MainTreeInclusionProof(CBORMixin, JSONMixin):
         return data
 
 
+@dataclass
+class Epoch(CBORMixin, JSONMixin):
+    index: int
+    first_interval: int
+    last_interval: int
+    head: bytes
+    version: str = "1"
+
+    def as_json_data(self):
+        data = asdict(self)
+        data["head"] = base64.b64encode(data["head"]).decode()
+        return data
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(
+            index=row.id,
+            first_interval=row.first_interval,
+            last_interval=row.last_interval,
+            head=row.head,
+        )
+
+
+@dataclass
+class EpochInclusionProof(CBORMixin, JSONMixin):
+    """Inclusion of an epoch head in the main tree of `new_interval` intervals,
+    from the epoch head up."""
+
+    epoch: int
+    new_interval: int
+    a: int
+    nodes: list[bytes]
+    version: str = "1"
+
+    def as_json_data(self):
+        data = asdict(self)
+        data["nodes"] = [base64.b64encode(x).decode() for x in data["nodes"]]
+        return data
+
+
 @dataclass
 class MainHeadBase(CBORMixin, JSONMixin):
     authority: str
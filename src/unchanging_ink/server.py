@@ -1,10 +1,21 @@
+import os
+
 import aioredis
 from sanic import Sanic
-from sqlalchemy.ext.asyncio import create_async_engine
+from sanic.exceptions import ServiceUnavailable
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 
 from .crypto import setup_crypto
-from .fanout import Fanout, redis_fanout
+from .db import ReplicaSet, create_engine, watch_pool
+from .epochs import EpochHeads
+from .fanout import Fanout, HeadHistory, redis_fanout, relay_fanout
+from .hashfilter import HashFilterCache
+from .metrics import FANOUT_WAITERS, REGISTRY
+from .nodestore import NodeStore
+from .relay import relay_main
 from .routes import setup_routes
+from .throttle import (Admission, Overloaded, Throttle, Throttled,
+                       retry_after_header)
 
 app = Sanic(__name__.replace(".", "-"))
 app.config.REAL_IP_HEADER = "X-Real-IP"
@@ -25,27 +36,189 @@ if "AUTHORITY" not in app.config:
 if "SERVER_NAME" not in app.config:
     app.config.update({"SERVER_NAME": "https://" + app.config.AUTHORITY + "/api"})
 
-db_url = f"postgresql+asyncpg://{app.config.DB_USER}:{app.config.DB_PASSWORD}@{app.config.DB_HOST}/{app.config.DB_NAME}"
-redis_url = "redis://redis/0"
-engine = create_async_engine(db_url)
+DEFAULT_CONFIG = {
+    # Number of recent main tree heads kept for replay to live stream clients
+    "MTH_HISTORY_LENGTH": 1200,
+    # Heads a live stream client may fall behind before LIVE_SLOW_CONSUMER applies
+    "LIVE_MAX_BACKLOG": 20,
+    # "drop" skips a slow client ahead to the latest head, "disconnect" closes it
+    "LIVE_SLOW_CONSUMER": "drop",
+    # Seconds a single send to a live stream client may take
+    "LIVE_SEND_TIMEOUT": 10,
+    # Seconds between keep-alive comments on the event stream
+    "LIVE_KEEPALIVE": 15,
+    # Seconds a long-poll request waits for a new head
+    "LIVE_POLL_TIMEOUT": 30,
+    # Unix socket of the host-local relay of mth-live, see relay.py. If set,
+    # the main process starts the relay and worker processes connect to it
+    # instead of subscribing to Redis themselves.
+    "FANOUT_SOCKET": None,
+    # Whether the relay is started by the main process, or runs on its own
+    "FANOUT_RELAY_MANAGED": True,
+    # Serve /metrics in the Prometheus text format from the API
+    "METRICS_ENABLED": True,
+    # Address of the worker's /metrics endpoint, a port of 0 disables it
+    "WORKER_METRICS_HOST": "0.0.0.0",
+    "WORKER_METRICS_PORT": 9100,
+    # Most timestamps a single multiproof request may ask for
+    "MULTIPROOF_MAX_IDS": 1000,
+    # Most timestamps in an interval whose tree a multiproof request rebuilds
+    # from the timestamps, see INTERVAL_PROOF_STORAGE
+    "MULTIPROOF_MAX_INTERVAL": 10_000,
+    # Most timestamps a single bulk request may ask for, or a tag may match
+    "BULK_MAX_TIMESTAMPS": 1000,
+    # Seconds a bulk request with ?wait waits for all of its timestamps to be
+    # sealed before it gets a 503
+    "BULK_WAIT_TIMEOUT": 60,
+    # Seconds the worker waits between sealing intervals
+    "INTERVAL_SECONDS": 3,
+    # Directory the worker writes the main tree tiles to, see tiles.py, None
+    # disables them. TILE_HEIGHT must not change once tiles are written.
+    "TILES_DIRECTORY": None,
+    "TILE_HEIGHT": 8,
+    # Directory of the memory-mapped main tree node store, see nodestore.py,
+    # None disables it. Written by the worker, read by the backend, so both
+    # need to be on the same host.
+    "NODE_STORE_DIRECTORY": None,
+    # Main tree subtrees evaluated concurrently, see AbstractAsyncMerkleTree,
+    # 0 fetches one node after the other
+    "MERKLE_CONCURRENCY": 16,
+    # How main tree nodes are cached in redis, "keys" or "packed", see
+    # AbstractRedisAsyncCachingMerkleTree. Switching starts from an empty cache.
+    "REDIS_NODE_LAYOUT": "keys",
+    # Database connections per process, see db.py. Up to DB_POOL_MAX_OVERFLOW
+    # more than DB_POOL_SIZE are opened under load, and closed again after.
+    "DB_POOL_SIZE": 10,
+    "DB_POOL_MAX_OVERFLOW": 10,
+    # Seconds a request waits for a database connection before it gets a 503
+    "DB_POOL_TIMEOUT": 10,
+    # Prepared statements kept per database connection (asyncpg only)
+    "DB_STATEMENT_CACHE_SIZE": 500,
+    # Comma separated URLs of read-only replicas of the database, used by the
+    # API for lookups and proofs instead of the primary, see ReplicaSet
+    "DB_REPLICA_URLS": None,
+    # How the worker stores the proofs of the timestamps it seals: "rows",
+    # the whole proof in every timestamp row, or "tree", the interval tree
+    # once per interval, see itree.py
+    "INTERVAL_PROOF_STORAGE": "rows",
+    # Bits of each new block of the bloom filters in front of the lookup of
+    # timestamps by hash, see hashfilter.py, e.g. 2**20. 0 disables them,
+    # lookups then always go to the database. Once enabled, the worker first
+    # adds all intervals sealed so far.
+    "HASH_FILTER_BITS": 0,
+    # Token buckets of the clients of POST /v1/ts/ and GET /v1/ts/<id>, see
+    # throttle.py: requests per second and burst per address, or per API key
+    # for clients that send one of the comma separated THROTTLE_API_KEYS in
+    # API_KEY_HEADER. A rate of 0 disables them.
+    "THROTTLE_RATE": 10,
+    "THROTTLE_BURST": 100,
+    "THROTTLE_API_KEYS": None,
+    "THROTTLE_API_KEY_RATE": 100,
+    "THROTTLE_API_KEY_BURST": 1000,
+    "API_KEY_HEADER": "X-API-Key",
+    # Tokens of a bucket every process takes from redis at once
+    "THROTTLE_LEASE": 5,
+    # New timestamps are refused with a 503 while more than this many wait to
+    # be sealed, or after no interval was sealed for this many seconds. 0
+    # disables either.
+    "ADMISSION_MAX_PENDING": 100_000,
+    "ADMISSION_MAX_SEAL_LAG": 60,
+    # Delivery of sealed timestamps to the callback URL given with
+    # POST /v1/ts/?callback=, see webhooks.py: requests in flight at once, in
+    # total and per host, their timeout in seconds, and the most timestamps
+    # per request
+    "WEBHOOK_CONCURRENCY": 32,
+    "WEBHOOK_HOST_CONCURRENCY": 2,
+    "WEBHOOK_TIMEOUT": 10,
+    "WEBHOOK_BATCH": 100,
+    # Failed deliveries are retried after this many seconds, twice as long
+    # after each further attempt, until they failed this many times
+    "WEBHOOK_RETRY_SECONDS": 5,
+    "WEBHOOK_MAX_ATTEMPTS": 8,
+    # Whether callback URLs may point to loopback and private addresses
+    "WEBHOOK_ALLOW_PRIVATE": False,
+    # Epochs of 2**EPOCH_BITS intervals, whose heads are stored once they are
+    # complete, see epochs.py. 20 is about 36 days at 3 second intervals. 0
+    # disables them. Must not change once epochs were stored.
+    "EPOCH_BITS": 0,
+}
+app.config.update({k: v for (k, v) in DEFAULT_CONFIG.items() if k not in app.config})
+
+# DB_URL and REDIS_URL override the docker-compose defaults, e.g. for a local
+# sqlite+aiosqlite database and redis-server
+db_url = (
+    app.config.get("DB_URL")
+    or f"postgresql+asyncpg://{app.config.DB_USER}:{app.config.DB_PASSWORD}@{app.config.DB_HOST}/{app.config.DB_NAME}"
+)
+redis_url = app.config.get("REDIS_URL") or "redis://redis/0"
+
+
+def make_engine(url: str = db_url):
+    return create_engine(
+        url,
+        pool_size=app.config.DB_POOL_SIZE,
+        max_overflow=app.config.DB_POOL_MAX_OVERFLOW,
+        timeout=app.config.DB_POOL_TIMEOUT,
+        statement_cache_size=app.config.DB_STATEMENT_CACHE_SIZE,
+    )
+
+
+engine = make_engine()
+watch_pool(engine)
 authority_base_url = f"{app.config.AUTHORITY}"
 
 
 def setup_database():
     @app.listener("before_server_start")
     async def prepare_db(*args, **kwargs):
-        app.ctx.engine = create_async_engine(db_url, pool_size=0, max_overflow=-1)
+        app.ctx.engine = make_engine()
+        watch_pool(app.ctx.engine)
+        replica_urls = app.config.DB_REPLICA_URLS or ""
+        if isinstance(replica_urls, str):
+            replica_urls = replica_urls.split(",")
+        app.ctx.replicas = ReplicaSet(
+            app.ctx.engine,
+            [make_engine(url.strip()) for url in replica_urls if url.strip()],
+        )
+        app.ctx.hash_filter = HashFilterCache()
+        app.ctx.epochs = (
+            EpochHeads(app.config.EPOCH_BITS) if app.config.EPOCH_BITS else None
+        )
 
     @app.listener("after_server_stop")
     async def stop_db(*args, **kwargs):
+        await app.ctx.replicas.dispose()
         await app.ctx.engine.dispose()
 
+    @app.exception(PoolTimeoutError)
+    async def pool_timeout(request, exception):
+        response = app.error_handler.default(
+            request, ServiceUnavailable("Too many requests waiting for the database")
+        )
+        response.headers["Retry-After"] = "1"
+        return response
+
 
 def setup_fanout(app):
+    @app.listener("main_process_ready")
+    async def start_relay(*args, **kwargs):
+        if app.config.FANOUT_SOCKET and app.config.FANOUT_RELAY_MANAGED:
+            app.manager.manage(
+                "FanoutRelay",
+                relay_main,
+                {
+                    "socket_path": app.config.FANOUT_SOCKET,
+                    "redis_url": redis_url,
+                    "history": app.config.MTH_HISTORY_LENGTH,
+                },
+            )
+
     @app.listener("before_server_start")
     async def create_fanout(*args, **kwargs):
         app.ctx.fanout = Fanout()
-        app.add_task(redis_fanout)
+        FANOUT_WAITERS.set_function(lambda: app.ctx.fanout.waiters)
+        app.ctx.mth_history = HeadHistory(app.config.MTH_HISTORY_LENGTH)
+        app.add_task(relay_fanout if app.config.FANOUT_SOCKET else redis_fanout)
 
 
 def setup_redis(app):
@@ -58,8 +231,52 @@ def setup_redis(app):
         await app.ctx.redis.close()
 
 
+def setup_throttle(app):
+    @app.listener("before_server_start")
+    async def create_throttle(*args, **kwargs):
+        app.ctx.throttle = Throttle(app.ctx.redis, app.config.THROTTLE_LEASE)
+        app.ctx.admission = Admission(
+            app.config.ADMISSION_MAX_PENDING, app.config.ADMISSION_MAX_SEAL_LAG
+        )
+        api_keys = app.config.THROTTLE_API_KEYS or ""
+        if isinstance(api_keys, str):
+            api_keys = api_keys.split(",")
+        app.ctx.api_keys = {key.strip() for key in api_keys if key.strip()}
+
+    @app.exception(Throttled, Overloaded)
+    async def retry_later(request, exception):
+        response = app.error_handler.default(request, exception)
+        response.headers["Retry-After"] = retry_after_header(exception.retry_after)
+        return response
+
+
+def setup_metrics(app):
+    @app.listener("before_server_start")
+    async def label_metrics(*args, **kwargs):
+        # Every worker process renders its own metrics, see metrics.py
+        REGISTRY.set_labels(
+            worker=os.environ.get("SANIC_WORKER_NAME") or str(os.getpid())
+        )
+
+
+def setup_node_store(app):
+    @app.listener("before_server_start")
+    async def open_node_store(*args, **kwargs):
+        app.ctx.node_store = None
+        if app.config.NODE_STORE_DIRECTORY:
+            app.ctx.node_store = NodeStore(app.config.NODE_STORE_DIRECTORY)
+
+    @app.listener("after_server_stop")
+    async def close_node_store(*args, **kwargs):
+        if app.ctx.node_store is not None:
+            app.ctx.node_store.close()
+
+
 setup_database()
 setup_redis(app)
+setup_throttle(app)
+setup_node_store(app)
+setup_metrics(app)
 setup_routes(app)
 setup_crypto(app)
 setup_fanout(app)
@@ -0,0 +1,257 @@
+"""Snapshots of the whole main tree, to bootstrap a node store.
+
+    unchanging-ink_snapshot export main-tree.snap
+    unchanging-ink_snapshot import main-tree.snap [--redis] [--full-check]
+
+A snapshot file is, with integers little endian:
+
+    magic     8 bytes, b"UINKSNP1"
+    width     8 bytes, the number of intervals
+    ihashes   width * 32 bytes, the hash of every interval
+    levels    for every level from 0 up, (width >> level) * 32 bytes: the
+              values of the perfect subtrees of size 2**level, laid out as in
+              the node store
+    mth       32 bytes, the main tree hash at width
+    checksum  32 bytes, SHA3-256 of everything before
+
+Both commands check the tree against the main tree hash in the proofs of the
+newest sealed timestamps in the database. Importing also checks the checksum
+and the mth of the snapshot itself, and then loads the levels into the node
+store in NODE_STORE_DIRECTORY, with --redis also the nodes MainMerkleTree
+caches in Redis. --full-check recomputes every level from the interval hashes
+first. The worker must be stopped while importing.
+"""
+import argparse
+import asyncio
+import struct
+import time
+from dataclasses import dataclass
+from hashlib import sha3_256
+from typing import BinaryIO, List, Optional, Tuple
+
+import aioredis
+import sqlalchemy
+import structlog
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from .cache import (LAYOUT_PACKED, MAX_CACHE_WIDTH, NODE_TTL, PACKED_TILE_BITS,
+                    packed_address)
+from .crypto import MerkleNode, build_levels, leaf_values
+from .models import interval_tree, timestamp
+from .nodestore import HASH_SIZE, NodeStore, interval_rows
+from .schemas import Interval, IntervalProofStructure, b64url_decode
+
+MAGIC = b"UINKSNP1"
+WIDTH_FORMAT = "<Q"
+REDIS_BATCH = 10000
+
+logger = structlog.getLogger(__name__)
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def root_from_levels(levels: List[bytes], width: int) -> bytes:
+    """Main tree hash at `width`, from the perfect subtrees it is made of."""
+    if width == 0:
+        return MerkleNode.hash_function().digest()
+    nodes, start = [], 0
+    for level in reversed(range(width.bit_length())):
+        if width & (1 << level):
+            offset = (start >> level) * HASH_SIZE
+            nodes.append(bytes(levels[level][offset : offset + HASH_SIZE]))
+            start += 1 << level
+    value = nodes.pop()
+    while nodes:
+        value = MerkleNode.combine_digests(nodes.pop(), value)
+    return value
+
+
+@dataclass
+class Snapshot:
+    width: int
+    ihashes: bytes
+    levels: List[bytes]
+    mth: bytes
+
+    def write(self, f: BinaryIO):
+        checksum = sha3_256()
+        for data in (
+            MAGIC,
+            struct.pack(WIDTH_FORMAT, self.width),
+            self.ihashes,
+            *self.levels,
+            self.mth,
+        ):
+            checksum.update(data)
+            f.write(data)
+        f.write(checksum.digest())
+
+    @classmethod
+    def read(cls, f: BinaryIO) -> "Snapshot":
+        data = memoryview(f.read())
+        header = len(MAGIC) + struct.calcsize(WIDTH_FORMAT)
+        if len(data) < header + 2 * HASH_SIZE or data[: len(MAGIC)] != MAGIC:
+            raise SnapshotError("not a main tree snapshot")
+        if sha3_256(data[:-HASH_SIZE]).digest() != data[-HASH_SIZE:]:
+            raise SnapshotError("checksum mismatch")
+
+        (width,) = struct.unpack_from(WIDTH_FORMAT, data, len(MAGIC))
+        sizes = [width] + [width >> level for level in range(width.bit_length())]
+        if header + (sum(sizes) + 2) * HASH_SIZE != len(data):
+            raise SnapshotError("truncated snapshot")
+        parts, offset = [], header
+        for size in sizes:
+            parts.append(data[offset : offset + size * HASH_SIZE])
+            offset += size * HASH_SIZE
+        return cls(
+            width=width,
+            ihashes=parts[0],
+            levels=parts[1:],
+            mth=bytes(data[offset : offset + HASH_SIZE]),
+        )
+
+    def check(self, full: bool = False):
+        if full:
+            levels = build_levels(leaf_values(self.ihashes))[: self.width.bit_length()]
+            if levels != self.levels:
+                raise SnapshotError("levels do not match the interval hashes")
+        if root_from_levels(self.levels, self.width) != self.mth:
+            raise SnapshotError("levels do not match the mth")
+
+
+async def export_snapshot(conn: AsyncConnection) -> Snapshot:
+    ihashes = bytearray()
+    async for rows in interval_rows(conn):
+        for row in rows:
+            ihashes += Interval.from_row(row).calculate_hash()
+    width = len(ihashes) // HASH_SIZE
+    levels = build_levels(leaf_values(ihashes))[: width.bit_length()]
+    return Snapshot(
+        width=width,
+        ihashes=bytes(ihashes),
+        levels=levels,
+        mth=root_from_levels(levels, width),
+    )
+
+
+async def stored_mth(conn: AsyncConnection, width: int) -> Optional[Tuple[int, bytes]]:
+    """Interval index and mth from the proof of the newest timestamp sealed
+    before `width`, if there is one."""
+    query = (
+        timestamp.select()
+        .where(timestamp.c.proof.isnot(None), timestamp.c.interval < width)
+        .order_by(timestamp.c.interval.desc())
+        .limit(1)
+    )
+    row = (await conn.execute(query)).first()
+    stored = None
+    if row is not None:
+        proof = IntervalProofStructure.from_cbor(row.proof)
+        stored = row.interval, proof.mth
+    # Or the newer interval tree, for timestamps without a proof of their own
+    query = (
+        sqlalchemy.select(interval_tree.c.interval, interval_tree.c.mth)
+        .where(interval_tree.c.interval < width)
+        .order_by(interval_tree.c.interval.desc())
+        .limit(1)
+    )
+    row = (await conn.execute(query)).first()
+    if row is not None and (stored is None or row.interval > stored[0]):
+        stored = row.interval, row.mth
+    if stored is None:
+        return None
+    return stored[0], b64url_decode(stored[1].rpartition(":")[2])
+
+
+async def check_stored_mth(conn: AsyncConnection, snapshot: Snapshot):
+    if (stored := await stored_mth(conn, snapshot.width)) is None:
+        logger.warning("No sealed timestamps to check the snapshot against")
+        return
+    index, mth = stored
+    if root_from_levels(snapshot.levels, index + 1) != mth:
+        raise SnapshotError(f"snapshot does not match the mth of interval {index}")
+
+
+async def load_redis(redis, snapshot: Snapshot, layout: str):
+    """Set all perfect subtrees that MainMerkleTree caches in Redis."""
+    pipe = redis.pipeline(transaction=False)
+    queued = 0
+    for level, data in enumerate(snapshot.levels):
+        size = 1 << level
+        if size <= MAX_CACHE_WIDTH:
+            continue
+        # In the packed layout, a whole string of neighbouring nodes at once
+        step = 1 << PACKED_TILE_BITS if layout == LAYOUT_PACKED else 1
+        for index in range(0, len(data) // HASH_SIZE, step):
+            value = bytes(data[index * HASH_SIZE : (index + step) * HASH_SIZE])
+            if layout == LAYOUT_PACKED:
+                key, _ = packed_address(index * size, (index + 1) * size)
+            else:
+                key = f"{index * size},{(index + 1) * size}".encode()
+            pipe.set(key, value, ex=NODE_TTL)
+            queued += 1
+            if queued % REDIS_BATCH == 0:
+                await pipe.execute()
+    await pipe.execute()
+    return queued
+
+
+async def main_inner(args):
+    from .server import app, engine, redis_url
+
+    start = time.perf_counter()
+    try:
+        async with engine.connect() as conn:
+            if args.command == "export":
+                snapshot = await export_snapshot(conn)
+                await check_stored_mth(conn, snapshot)
+                with open(args.file, "wb") as f:
+                    snapshot.write(f)
+            else:
+                if not app.config.NODE_STORE_DIRECTORY:
+                    raise SystemExit("NODE_STORE_DIRECTORY is not set")
+                with open(args.file, "rb") as f:
+                    snapshot = Snapshot.read(f)
+                snapshot.check(full=args.full_check)
+                await check_stored_mth(conn, snapshot)
+                store = NodeStore(app.config.NODE_STORE_DIRECTORY, writable=True)
+                store.load(snapshot.width, snapshot.levels)
+                store.close()
+                if args.redis:
+                    async with aioredis.from_url(redis_url) as redis:
+                        await load_redis(redis, snapshot, app.config.REDIS_NODE_LAYOUT)
+    finally:
+        await engine.dispose()
+    logger.info(
+        f"Snapshot {args.command}ed",
+        width=snapshot.width,
+        seconds=time.perf_counter() - start,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="write a snapshot of the database")
+    export.add_argument("file")
+    import_ = commands.add_parser("import", help="load a snapshot into the node store")
+    import_.add_argument("file")
+    import_.add_argument(
+        "--redis", action="store_true", help="also fill the Redis node cache"
+    )
+    import_.add_argument(
+        "--full-check",
+        action="store_true",
+        help="recompute all levels from the interval hashes",
+    )
+    args = parser.parse_args()
+    try:
+        asyncio.run(main_inner(args))
+    except SnapshotError as e:
+        raise SystemExit(f"Invalid snapshot: {e}")
+
+
+if __name__ == "__main__":
+    main()
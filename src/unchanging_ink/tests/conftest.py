@@ -2,6 +2,10 @@ import asyncio
 import sys
 
 import pytest
+from sanic_testing import TestManager
+from sqlalchemy.ext.asyncio import create_async_engine
+
+API_POOL_SIZE = 2
 
 
 @pytest.fixture(scope="session")
@@ -30,3 +34,116 @@ def init_database():
     from unchanging_ink.models import metadata
 
     return metadata.create_all
+
+
+@pytest.fixture
+async def engine(_database_url, init_database):
+    """A database of its own for each test, with all tables."""
+    engine = create_async_engine(_database_url)
+    async with engine.begin() as conn:
+        await conn.run_sync(init_database)
+    yield engine
+    await engine.dispose()
+
+
+@pytest.fixture
+async def conn(engine):
+    async with engine.connect() as conn:
+        yield conn
+
+
+@pytest.fixture
+def app():
+    from ..server import app
+
+    # Once for all tests, it adds listeners to the app
+    if not hasattr(app, "asgi_client"):
+        TestManager(app)
+
+    return app
+
+
+@pytest.fixture
+def api_redis_url():
+    """Where the app of `api` finds redis: nowhere, unless a test module
+    overrides this."""
+    return "redis://127.0.0.1:1"
+
+
+@pytest.fixture
+def api_config():
+    """Configuration of the app of `api`, for tests to override."""
+    return {}
+
+
+@pytest.fixture
+async def api(app, tmp_path, monkeypatch, api_redis_url, api_config):
+    """app.asgi_client, with a database of its own and a pool of API_POOL_SIZE
+    connections.
+
+    The client starts and stops the app around every request, so the engine,
+    fanout, head history and admission control are shared between those runs:
+    concurrent requests and the test see the same app.ctx."""
+    from .. import server
+    from ..db import MeteredPool
+    from ..models import metadata
+
+    url = f"sqlite+aiosqlite:///{tmp_path / 'api.sqlite'}"
+    engines = {}
+
+    def make_engine(url=url):
+        if url not in engines:
+            engines[url] = create_async_engine(
+                url,
+                poolclass=MeteredPool,
+                pool_size=API_POOL_SIZE,
+                max_overflow=0,
+                pool_timeout=1,
+            )
+        return engines[url]
+
+    for (key, value) in {
+        "THROTTLE_RATE": 0,
+        "ADMISSION_MAX_PENDING": 0,
+        "ADMISSION_MAX_SEAL_LAG": 0,
+        **api_config,
+    }.items():
+        monkeypatch.setitem(app.config, key, value)
+
+    instances = {}
+
+    def shared(cls):
+        def factory(*args):
+            if cls not in instances:
+                instances[cls] = cls(*args)
+            return instances[cls]
+
+        return factory
+
+    subscriptions = []
+    redis_fanout = server.redis_fanout
+
+    async def subscribe_once(app):
+        # One subscription for all runs of the app, as in a worker process
+        if not subscriptions:
+            subscriptions.append(asyncio.current_task())
+            await redis_fanout(app)
+
+    monkeypatch.setattr(server, "make_engine", make_engine)
+    for name in ("Fanout", "HeadHistory", "HashFilterCache", "Throttle", "Admission"):
+        monkeypatch.setattr(server, name, shared(getattr(server, name)))
+    monkeypatch.setattr(server, "redis_fanout", subscribe_once)
+    monkeypatch.setattr(server, "redis_url", api_redis_url)
+
+    async with make_engine().begin() as conn:
+        await conn.run_sync(metadata.create_all)
+    # Once before the test, so that app.ctx is its own from the start
+    await app.asgi_client.get("/hello")
+    try:
+        yield app.asgi_client
+    finally:
+        for task in subscriptions:
+            task.cancel()
+        await asyncio.gather(*subscriptions, return_exceptions=True)
+        for engine in engines.values():
+            await engine.dispose()
@@ -1,14 +1,50 @@
+import asyncio
+import base64
+import uuid
+from urllib.parse import quote
+
+import cbor2
+import orjson
 import pytest
-from sanic_testing import TestManager
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from .conftest import API_POOL_SIZE
+
+JSON = {"accept": "application/json"}
+
 
+async def request_timestamp(api, data, **params) -> str:
+    _, response = await api.post(
+        "/v1/ts/", params=params, json={"data": data}, headers=JSON
+    )
+    assert response.status == 200
+    return response.json["id"]
 
-@pytest.fixture
-def app():
-    from ..server import app
 
-    TestManager(app)
+async def seal(app, index, ids):
+    """Seal the timestamps `ids` into interval `index`, as the worker would,
+    and announce it."""
+    from ..models import interval, timestamp
+    from ..schemas import IntervalProofStructure
 
-    return app
+    proof = IntervalProofStructure(
+        a=0, path=[], ith=bytes(32), mth=f"test/{index}#v1:AAAA"
+    ).to_cbor()
+    async with app.ctx.engine.begin() as conn:
+        await conn.execute(
+            interval.insert(),
+            {
+                "id": index,
+                "timestamp": f"2022-01-01T00:00:{index:02}.000000Z",
+                "ith": b"",
+            },
+        )
+        await conn.execute(
+            timestamp.update()
+            .where(timestamp.c.id.in_([uuid.UUID(id_) for id_ in ids]))
+            .values(interval=index, proof=proof)
+        )
+    await app.ctx.fanout.trigger()
 
 
 @pytest.mark.asyncio
@@ -17,3 +53,581 @@ async def test_api_hello(app):
 
     assert response.status == 200
     assert response.json == {"Hello": "World"}
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    [
+        ("2022-03-04T05:06:07.123456Z", "2022-03-04T05:06:07.123456Z"),
+        ("2022-03-04T05:06:07Z", "2022-03-04T05:06:07.000000Z"),
+        ("2022-03-04T07:06:07+02:00", "2022-03-04T05:06:07.000000Z"),
+        ("2022-03-04 05:06", "2022-03-04T05:06:00.000000Z"),
+        ("2022-03-04", "2022-03-04T00:00:00.000000Z"),
+    ],
+)
+def test_parse_time(value, expected):
+    from ..routes import parse_time
+
+    assert parse_time(value) == expected
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        "yesterday",
+        # Not in the range of datetime once in UTC
+        "0001-01-01T00:30:00+01:00",
+        "9999-12-31T23:59:59-01:00",
+    ],
+)
+def test_parse_time_invalid(value):
+    from sanic.exceptions import BadRequest
+
+    from ..routes import parse_time
+
+    with pytest.raises(BadRequest):
+        parse_time(value)
+
+
+@pytest.mark.asyncio
+async def test_interval_at(conn):
+    from ..models import interval
+    from ..routes import interval_at
+
+    await conn.execute(
+        interval.insert(),
+        [
+            {"id": i, "timestamp": f"2022-01-01T00:00:{i:02}.000000Z", "ith": b""}
+            for i in range(0, 60, 10)
+        ],
+    )
+    assert await interval_at(conn, "2021-12-31T00:00:00.000000Z") == 0
+    assert await interval_at(conn, "2022-01-01T00:00:10.000000Z") == 10
+    assert await interval_at(conn, "2022-01-01T00:00:10.000001Z") == 20
+    assert await interval_at(conn, "2022-01-01T00:00:51.000000Z") is None
+
+    assert await interval_at(conn, "2022-01-01T00:00:19.999999Z", True) == 10
+    assert await interval_at(conn, "2022-01-01T00:00:20.000000Z", True) == 20
+    assert await interval_at(conn, "2021-12-31T00:00:00.000000Z", True) is None
+
+
+async def test_timestamp_wait(app, api):
+    id_ = await request_timestamp(api, "wait")
+    # More than there are connections
+    waiters = [
+        asyncio.ensure_future(api.get(f"/v1/ts/{id_}?wait", headers=JSON))
+        for _ in range(API_POOL_SIZE * 3)
+    ]
+
+    async def waiting():
+        while app.ctx.fanout.waiters < len(waiters):
+            await asyncio.sleep(0.01)
+
+    async def other():
+        other = await request_timestamp(api, "other")
+        _, response = await api.get(f"/v1/ts/{other}", headers=JSON)
+        return response
+
+    try:
+        await asyncio.wait_for(waiting(), 5)
+        # Other requests are still served
+        response = await asyncio.wait_for(other(), 5)
+        assert response.status == 200 and response.json["proof"] is None
+
+        await asyncio.wait_for(seal(app, 0, [id_]), 5)
+        for (_, response) in await asyncio.wait_for(asyncio.gather(*waiters), 5):
+            assert response.status == 200
+            assert response.json["interval"] == 0 and response.json["proof"]
+    finally:
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+
+    _, response = await api.get(f"/v1/ts/{uuid.uuid4()}?wait", headers=JSON)
+    assert response.status == 404
+
+
+async def bulk(api, ids, **params):
+    _, response = await api.post(
+        "/v1/ts/bulk", params=params, json={"ids": ids}, headers=JSON
+    )
+    return response
+
+
+def listed(response):
+    assert response.status == 200
+    return [ts["id"] for ts in response.json]
+
+
+async def test_bulk_timestamps(app, api, monkeypatch):
+    ids = [await request_timestamp(api, f"bulk {i}") for i in range(3)]
+    await seal(app, 0, ids[1:])
+
+    # In the order of the request, sealed or not
+    response = await bulk(api, ids[::-1])
+    assert listed(response) == ids[::-1]
+    assert [ts["interval"] for ts in response.json] == [0, 0, None]
+
+    response = await bulk(api, [ids[0], str(uuid.uuid4())])
+    assert response.status == 404
+    for malformed in ([], [ids[0], ids[0]], ["nope"], "nope"):
+        assert (await bulk(api, malformed)).status == 400
+
+    monkeypatch.setitem(app.config, "BULK_MAX_TIMESTAMPS", 2)
+    assert (await bulk(api, ids)).status == 413
+
+
+async def test_bulk_timestamps_wait(app, api):
+    ids = [await request_timestamp(api, f"bulk {i}") for i in range(2)]
+
+    async def waiting():
+        while app.ctx.fanout.waiters < 1:
+            await asyncio.sleep(0.01)
+
+    request = asyncio.ensure_future(bulk(api, ids, wait=""))
+    try:
+        await asyncio.wait_for(waiting(), 5)
+        # Not all of them yet
+        await seal(app, 0, ids[:1])
+        await asyncio.wait_for(waiting(), 5)
+        assert not request.done()
+
+        await seal(app, 1, ids[1:])
+        response = await asyncio.wait_for(request, 5)
+    finally:
+        request.cancel()
+    assert listed(response) == ids
+    assert [ts["interval"] for ts in response.json] == [0, 1]
+
+
+async def test_bulk_timestamps_wait_timeout(app, api, monkeypatch):
+    ids = [await request_timestamp(api, f"bulk {i}") for i in range(2)]
+    await seal(app, 0, ids[:1])
+    monkeypatch.setitem(app.config, "BULK_WAIT_TIMEOUT", 0.1)
+
+    request = asyncio.ensure_future(bulk(api, ids, wait=""))
+    try:
+        # In total, even while other intervals keep being sealed
+        for index in range(1, 50):
+            if request.done():
+                break
+            await asyncio.sleep(0.02)
+            await seal(app, index, [])
+        assert request.done() and request.result().status == 503
+    finally:
+        request.cancel()
+
+
+async def test_bulk_timestamps_replica(app, api, tmp_path, monkeypatch):
+    from ..models import metadata, timestamp
+
+    ids = [await request_timestamp(api, f"bulk {i}", tag="replica") for i in range(2)]
+    await seal(app, 0, ids)
+    replica_url = f"sqlite+aiosqlite:///{tmp_path / 'replica.sqlite'}"
+    replica = create_async_engine(replica_url)
+    async with replica.begin() as conn:
+        await conn.run_sync(metadata.create_all)
+    monkeypatch.setitem(app.config, "DB_REPLICA_URLS", replica_url)
+
+    async def replay(ids, interval):
+        async with app.ctx.engine.begin() as conn:
+            rows = (
+                await conn.execute(
+                    timestamp.select().where(
+                        timestamp.c.id.in_([uuid.UUID(id_) for id_ in ids])
+                    )
+                )
+            ).all()
+        async with replica.begin() as conn:
+            await conn.execute(timestamp.delete())
+            await conn.execute(
+                timestamp.insert(),
+                [dict(row._asdict(), interval=interval) for row in rows],
+            )
+
+    try:
+        # Not all of them replayed, or not sealed yet: from the primary
+        await replay(ids[:1], 7)
+        assert [ts["interval"] for ts in (await bulk(api, ids)).json] == [0, 0]
+        await replay(ids, None)
+        assert [ts["interval"] for ts in (await bulk(api, ids)).json] == [0, 0]
+
+        await replay(ids, 7)
+        assert [ts["interval"] for ts in (await bulk(api, ids)).json] == [7, 7]
+        # Tags from the primary, a replica could miss some without notice
+        await replay(ids[:1], 7)
+        _, response = await api.get("/v1/ts/tag/replica", headers=JSON)
+        assert [ts["interval"] for ts in response.json] == [0, 0]
+        # Always from the primary with ?wait
+        response = await bulk(api, ids, wait="")
+        assert [ts["interval"] for ts in response.json] == [0, 0]
+    finally:
+        await replica.dispose()
+
+
+async def test_timestamp_tag(app, api, monkeypatch):
+    ids = [await request_timestamp(api, f"tag {i}", tag="a tag") for i in range(3)]
+    await request_timestamp(api, "other", tag="a tag too")
+    await request_timestamp(api, "other", tag="A tag")
+
+    # In the order they were requested
+    async def tagged(tag):
+        _, response = await api.get(f"/v1/ts/tag/{quote(tag)}", headers=JSON)
+        return response
+
+    assert listed(await tagged("a tag")) == ids
+    assert listed(await tagged("none")) == []
+
+    monkeypatch.setitem(app.config, "BULK_MAX_TIMESTAMPS", 3)
+    assert (await tagged("a tag")).status == 200
+    monkeypatch.setitem(app.config, "BULK_MAX_TIMESTAMPS", 2)
+    assert (await tagged("a tag")).status == 400
+
+
+async def test_timestamp_tag_prefix(app, api):
+    tags = ["case-a", "Case-b", "case%c", "case_d", "casexd", "cas"]
+    ids = {tag: await request_timestamp(api, tag, tag=tag) for tag in tags}
+
+    async def prefixed(prefix):
+        _, response = await api.get(f"/v1/ts/tag-prefix/{quote(prefix)}", headers=JSON)
+        return [tag for (tag, id_) in ids.items() if id_ in listed(response)]
+
+    # Not ignoring case, like LIKE does in SQLite
+    assert await prefixed("case") == ["case-a", "case%c", "case_d", "casexd"]
+    assert await prefixed("Case") == ["Case-b"]
+    # No wildcards
+    assert await prefixed("case%") == ["case%c"]
+    assert await prefixed("case_") == ["case_d"]
+    assert await prefixed("%") == []
+
+
+def lookups():
+    from ..metrics import HASH_LOOKUPS
+
+    return {
+        result: HASH_LOOKUPS.labels(result=result).value
+        for result in ("filtered", "found", "not_found")
+    }
+
+
+def b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+async def test_timestamp_lookup(app, api):
+    from ..models import timestamp
+    from ..schemas import TimestampStructure
+
+    _, response = await api.post("/v1/ts/", json={"data": "text"}, headers=JSON)
+    text = response.json
+    text_hash = TimestampStructure(
+        data="text", timestamp=text["timestamp"]
+    ).calculate_hash()
+    # As POST ?compact stores it
+    as_bytes = {"id": str(uuid.uuid4()), "timestamp": text["timestamp"]}
+    async with app.ctx.engine.begin() as conn:
+        await conn.execute(
+            timestamp.insert(),
+            {
+                "id": uuid.UUID(as_bytes["id"]),
+                "timestamp": as_bytes["timestamp"],
+                "hash": TimestampStructure(
+                    data=b"bytes", timestamp=as_bytes["timestamp"]
+                ).calculate_hash(),
+            },
+        )
+
+    async def lookup(data, ts):
+        _, response = await api.post(
+            "/v1/ts/lookup",
+            json={"data": data, "timestamp": ts["timestamp"]},
+            headers=JSON,
+        )
+        return response
+
+    async def by_hash(hash_):
+        _, response = await api.get(f"/v1/ts/hash/{hash_}", headers=JSON)
+        return response
+
+    # Only sealed timestamps
+    assert (await lookup("text", text)).status == 404
+    assert (await by_hash(b64url(text_hash))).status == 404
+    await seal(app, 0, [text["id"], as_bytes["id"]])
+
+    for (data, ts) in (("text", text), ("bytes", as_bytes)):
+        response = await lookup(data, ts)
+        assert response.status == 200 and response.json["id"] == ts["id"]
+        assert response.json["interval"] == 0
+    assert (await lookup("other", text)).status == 404
+    # Bytes in CBOR, only as bytes
+    _, response = await api.post(
+        "/v1/ts/lookup",
+        content=cbor2.dumps({"data": b"bytes", "timestamp": as_bytes["timestamp"]}),
+        headers={"content-type": "application/cbor", **JSON},
+    )
+    assert response.status == 200 and response.json["id"] == as_bytes["id"]
+    _, response = await api.post(
+        "/v1/ts/lookup",
+        content=cbor2.dumps({"data": b"text", "timestamp": text["timestamp"]}),
+        headers={"content-type": "application/cbor", **JSON},
+    )
+    assert response.status == 404
+    response = await by_hash(b64url(text_hash))
+    assert response.status == 200 and response.json["id"] == text["id"]
+
+    _, response = await api.post("/v1/ts/lookup", json={"data": "text"})
+    assert response.status == 400
+    for malformed in ("not*base64", "AAAA", b64url(bytes(33)), "A"):
+        assert (await by_hash(malformed)).status == 400
+
+
+@pytest.mark.parametrize("api_config", [{"HASH_FILTER_BITS": 2**12}])
+async def test_timestamp_lookup_hash_filter(app, api):
+    from ..hashfilter import add_interval
+    from ..models import timestamp
+
+    def announce(index):
+        app.ctx.mth_history.append(orjson.dumps({"interval": {"index": index}}))
+
+    async def add_hashes(index):
+        async with app.ctx.engine.begin() as conn:
+            hashes = [
+                row.hash
+                for row in await conn.execute(
+                    timestamp.select().where(timestamp.c.interval == index)
+                )
+            ]
+            await add_interval(conn, index, hashes, app.config.HASH_FILTER_BITS)
+
+    async def by_hash(hash_):
+        _, response = await api.get(f"/v1/ts/hash/{b64url(hash_)}", headers=JSON)
+        return response.status
+
+    async def hash_of(id_):
+        _, response = await api.get(f"/v1/ts/{id_}", headers=JSON)
+        return response.json["hash"]
+
+    first = await request_timestamp(api, "first")
+    await seal(app, 0, [first])
+    await add_hashes(0)
+    announce(0)
+
+    before = lookups()
+    assert await by_hash(bytes(32)) == 404
+    assert lookups()["filtered"] == before["filtered"] + 1
+
+    # Interval 1 is sealed and announced, but not in the filters yet: the
+    # filters cannot tell that a hash is not in it
+    second = await request_timestamp(api, "second")
+    await seal(app, 1, [second])
+    announce(1)
+    before = lookups()
+    assert await by_hash(base64.b64decode(await hash_of(second))) == 200
+    assert await by_hash(bytes(32)) == 404
+    assert lookups() == dict(
+        before, found=before["found"] + 1, not_found=before["not_found"] + 1
+    )
+    assert app.ctx.hash_filter.covered == 0
+
+    # Once they cover it, they answer again
+    await add_hashes(1)
+    before = lookups()
+    assert await by_hash(base64.b64decode(await hash_of(second))) == 200
+    assert await by_hash(bytes(32)) == 404
+    assert lookups() == dict(
+        before, found=before["found"] + 1, filtered=before["filtered"] + 1
+    )
+
+
+async def test_epoch_disabled(api):
+    for path in ("/v1/epoch/0", "/v1/epoch/0/in/8"):
+        _, response = await api.get(path, headers=JSON)
+        assert response.status == 404
+
+
+@pytest.mark.parametrize("api_config", [{"EPOCH_BITS": 2}])
+async def test_epoch(app, api):
+    from ..models import epoch
+
+    async with app.ctx.engine.begin() as conn:
+        await conn.execute(
+            epoch.insert(),
+            {"id": 0, "first_interval": 0, "last_interval": 3, "head": bytes(32)},
+        )
+
+    async def status(path):
+        _, response = await api.get(path, headers=JSON)
+        return response.status
+
+    _, response = await api.get("/v1/epoch/0", headers=JSON)
+    assert response.status == 200
+    assert response.json["first_interval"] == 0
+    assert response.json["last_interval"] == 3
+    assert await status("/v1/epoch/1") == 404
+    assert await status("/v1/epoch/1/in/8") == 404
+    # Not all of the epoch is in a main tree of 3 intervals
+    assert await status("/v1/epoch/0/in/3") == 400
+
+
+@pytest.mark.parametrize("api_config", [{"THROTTLE_RATE": 1, "THROTTLE_BURST": 1}])
+async def test_throttled(api):
+    # Without redis, from the bucket of this process
+    id_ = await request_timestamp(api, "throttled")
+    _, response = await api.get(f"/v1/ts/{id_}", headers=JSON)
+    assert response.status == 429
+    assert response.headers["retry-after"] == "1"
+
+
+@pytest.mark.parametrize("api_config", [{"ADMISSION_MAX_PENDING": 1}])
+async def test_overloaded_pending(app, api):
+    for i in range(2):
+        await request_timestamp(api, f"pending {i}")
+    _, response = await api.post("/v1/ts/", json={"data": "more"}, headers=JSON)
+    assert response.status == 503
+    assert response.headers["retry-after"] == str(app.config.INTERVAL_SECONDS)
+
+
+@pytest.mark.parametrize("api_config", [{"ADMISSION_MAX_SEAL_LAG": 60}])
+async def test_overloaded_seal_lag(app, api):
+    await request_timestamp(api, "in time")
+    app.ctx.mth_history.updated -= 61
+    _, response = await api.post("/v1/ts/", json={"data": "late"}, headers=JSON)
+    assert response.status == 503
+    assert response.headers["retry-after"] == str(app.config.INTERVAL_SECONDS)
+
+    # Until the next interval is sealed
+    app.ctx.mth_history.append(orjson.dumps({"interval": {"index": 0}}))
+    await request_timestamp(api, "sealed again")
+
+
+def head(index):
+    return orjson.dumps({"interval": {"index": index}}).decode()
+
+
+async def test_live_poll(app, api, monkeypatch):
+    from ..fanout import announce
+
+    for index in range(3):
+        await announce(app, head(index))
+
+    # Replayed from the history
+    _, response = await api.get("/v1/mth/live/poll?since=0")
+    assert response.json == [{"interval": {"index": i}} for i in (1, 2)]
+    _, response = await api.get("/v1/mth/live/poll?since=yesterday")
+    assert response.status == 400
+
+    # From the current head on, nothing new within the timeout
+    monkeypatch.setitem(app.config, "LIVE_POLL_TIMEOUT", 0.05)
+    _, response = await api.get("/v1/mth/live/poll")
+    assert response.status == 200 and response.json == []
+
+
+async def test_live_events_resume(app, api, monkeypatch):
+    from ..fanout import announce
+
+    monkeypatch.setitem(app.config, "LIVE_MAX_BACKLOG", 1)
+    monkeypatch.setitem(app.config, "LIVE_SLOW_CONSUMER", "disconnect")
+    for index in range(3):
+        await announce(app, head(index))
+
+    async def waiting():
+        while app.ctx.fanout.waiters < 1:
+            await asyncio.sleep(0.01)
+
+    request = asyncio.ensure_future(
+        api.get("/v1/mth/live/events", headers={"last-event-id": "0"})
+    )
+    try:
+        # The replay is sent whole, however long
+        await asyncio.wait_for(waiting(), 5)
+        # More new heads at once than the client may fall behind
+        app.ctx.mth_history.append(head(3))
+        app.ctx.mth_history.append(head(4))
+        await app.ctx.fanout.trigger()
+        _, response = await asyncio.wait_for(request, 5)
+    finally:
+        request.cancel()
+    assert response.headers["content-type"] == "text/event-stream"
+    assert response.content == b"".join(
+        f"id: {i}\ndata: {head(i)}\n\n".encode() for i in (1, 2)
+    )
+
+
+def test_apply_backlog_policy(app, monkeypatch):
+    from ..fanout import HeadHistory
+    from ..routes import apply_backlog_policy
+
+    history = HeadHistory(10)
+    for index in range(3):
+        history.append(head(index))
+    frames = history.since(-1)
+
+    monkeypatch.setitem(app.config, "LIVE_MAX_BACKLOG", 3)
+    assert apply_backlog_policy(app, frames) == frames
+    monkeypatch.setitem(app.config, "LIVE_MAX_BACKLOG", 2)
+    monkeypatch.setitem(app.config, "LIVE_SLOW_CONSUMER", "drop")
+    assert apply_backlog_policy(app, frames) == frames[-1:]
+    monkeypatch.setitem(app.config, "LIVE_SLOW_CONSUMER", "disconnect")
+    assert apply_backlog_policy(app, frames) is None
+
+
+async def test_multiproof(app, api, monkeypatch):
+    from ..crypto import DictCachingMerkleTree, MerkleNode
+    from ..models import interval, timestamp
+    from ..schemas import IntervalMultiProofStructure, IntervalProofStructure
+
+    ids = [await request_timestamp(api, f"multi {i}") for i in range(5)]
+    async with app.ctx.engine.begin() as conn:
+        rows = (
+            await conn.execute(
+                timestamp.select().order_by(timestamp.c.timestamp, timestamp.c.hash)
+            )
+        ).all()
+        tree = await DictCachingMerkleTree.from_sequence(row.hash for row in rows)
+        # Sealed as the worker does with the "rows" storage
+        await conn.execute(
+            interval.insert(),
+            {
+                "id": 0,
+                "timestamp": "2022-01-01T00:00:00.000000Z",
+                "ith": tree.root.value,
+            },
+        )
+        proof = IntervalProofStructure(
+            a=0, path=[], ith=tree.root.value, mth="test/0#v1:AAAA"
+        ).to_cbor()
+        await conn.execute(timestamp.update().values(interval=0, proof=proof))
+        ith = (await conn.execute(interval.select())).first().ith
+    position_of = {str(row.id): i for (i, row) in enumerate(rows)}
+
+    async def multiproof(ids):
+        _, response = await api.post(
+            "/v1/ts/multiproof",
+            json={"ids": ids},
+            headers={"accept": "application/cbor"},
+        )
+        return response
+
+    response = await multiproof([ids[3], ids[0]])
+    assert response.status == 200
+    multi = IntervalMultiProofStructure.from_cbor(response.content)
+    assert multi.width == 5 and multi.ith == ith
+    assert multi.positions == [position_of[ids[3]], position_of[ids[0]]]
+    leaves = [
+        MerkleNode.from_leaf(position_of[id_], rows[position_of[id_]].hash)
+        for id_ in (ids[3], ids[0])
+    ]
+    nodes = [
+        MerkleNode(*address, value)
+        for (address, value) in zip(
+            DictCachingMerkleTree.multiproof_node_addresses(5, multi.positions),
+            multi.nodes,
+        )
+    ]
+    verifier = DictCachingMerkleTree.from_root_value(5, ith)
+    assert verifier.verify_multiproof(leaves, nodes)
+    assert not verifier.verify_multiproof(leaves[:1], nodes)
+
+    # Too large an interval to rebuild its tree from the timestamps
+    monkeypatch.setitem(app.config, "MULTIPROOF_MAX_INTERVAL", 4)
+    assert (await multiproof(ids[:2])).status == 400
@@ -0,0 +1,72 @@
+import pytest
+from sqlalchemy import exc, text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from unchanging_ink.db import MeteredPool, ReplicaSet, watch_pool
+from unchanging_ink.metrics import (DB_POOL_CAPACITY, DB_POOL_CONNECTIONS,
+                                    DB_POOL_TIMEOUTS, DB_POOL_WAIT_SECONDS)
+from unchanging_ink.models import interval, metadata
+
+
+async def test_metered_pool(tmp_path):
+    engine = create_async_engine(
+        f"sqlite+aiosqlite:///{tmp_path / 'db.sqlite'}",
+        poolclass=MeteredPool,
+        pool_size=1,
+        max_overflow=0,
+        pool_timeout=0.1,
+    )
+    watch_pool(engine)
+    in_use = DB_POOL_CONNECTIONS.labels(state="checked_out")
+    waits = sum(DB_POOL_WAIT_SECONDS.labels().counts)
+    timeouts = DB_POOL_TIMEOUTS.labels().value
+    try:
+        assert DB_POOL_CAPACITY.labels().get() == 1
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+            assert in_use.get() == 1
+            with pytest.raises(exc.TimeoutError):
+                async with engine.connect():
+                    pass
+        assert in_use.get() == 0
+        assert DB_POOL_CONNECTIONS.labels(state="idle").get() == 1
+        assert sum(DB_POOL_WAIT_SECONDS.labels().counts) == waits + 2
+        assert DB_POOL_TIMEOUTS.labels().value == timeouts + 1
+    finally:
+        await engine.dispose()
+
+
+async def test_replica_set(tmp_path):
+    def intervals(start, end):
+        return [
+            {"id": i, "timestamp": "2022-01-01T00:00:00.000000Z", "ith": bytes(32)}
+            for i in range(start, end)
+        ]
+
+    engines = [
+        create_async_engine(f"sqlite+aiosqlite:///{tmp_path / name}")
+        for name in ("primary", "a", "b")
+    ]
+    primary, a, b = engines
+    try:
+        for engine, count in zip(engines, (10, 5, 0)):
+            async with engine.begin() as conn:
+                await conn.run_sync(metadata.create_all)
+                if count:
+                    await conn.execute(interval.insert(), intervals(0, count))
+
+        assert await ReplicaSet(primary).engine(3) is primary
+        replicas = ReplicaSet(primary, [a, b])
+        assert [await replicas.engine() for _ in range(3)] == [a, b, a]
+        # b has not replayed any interval, a only up to 4
+        assert await replicas.engine(0) is primary
+        assert await replicas.engine(4) is a
+        assert await replicas.engine(0) is primary
+        assert await replicas.engine(5) is primary
+
+        async with b.begin() as conn:
+            await conn.execute(interval.insert(), intervals(0, 10))
+        assert await replicas.engine(9) is b
+    finally:
+        for engine in engines:
+            await engine.dispose()
@@ -0,0 +1,74 @@
+import pytest
+
+from unchanging_ink.crypto import MerkleNode
+from unchanging_ink.epochs import (EpochError, EpochHeads,
+                                   epoch_inclusion_proof, store_epochs)
+from unchanging_ink.models import epoch
+
+from .test_merkle import StandardMerkleTreeUncached
+
+
+async def test_get_node():
+    tree = StandardMerkleTreeUncached(width=20)
+    epochs = EpochHeads(2)
+    epochs.heads = [
+        (await tree.calculate_node(first, first + 4)).value for first in range(0, 20, 4)
+    ]
+    assert epochs.covered == 20
+
+    for (start, end) in [(0, 4), (4, 8), (0, 8), (0, 16), (16, 20), (0, 20)]:
+        assert (
+            epochs.get_node(start, end) == (await tree.calculate_node(start, end)).value
+        )
+
+    # Not made of complete epochs
+    for (start, end) in [(0, 2), (2, 4), (4, 6), (16, 24), (20, 24)]:
+        assert epochs.get_node(start, end) is None
+
+
+@pytest.mark.parametrize("width", [4, 16, 17, 35])
+async def test_epoch_inclusion_proof(width):
+    tree = StandardMerkleTreeUncached(width=width)
+    root = await tree.calculate_node(0, width)
+
+    verifier = StandardMerkleTreeUncached(
+        root=MerkleNode(0, -(-width // 4), root.value)
+    )
+    for index in range(width // 4):
+        head = await tree.calculate_node(index * 4, index * 4 + 4)
+        a, path = await epoch_inclusion_proof(tree, 2, width, index)
+        assert verifier.verify_inclusion_proof(
+            MerkleNode(index, index + 1, head.value), a, path
+        )
+
+        # The rest of the proof of any interval in the epoch
+        leaf_a, leaf_path = await tree.compute_inclusion_proof(index * 4 + 1)
+        assert leaf_a >> 2 == a
+        assert [node.value for node in leaf_path[2:]] == [node.value for node in path]
+
+
+async def test_store_epochs(conn):
+    tree = StandardMerkleTreeUncached(width=22)
+    epochs = EpochHeads(2)
+    await store_epochs(conn, tree, epochs, 3)
+    assert (await conn.execute(epoch.select())).all() == []
+
+    await store_epochs(conn, tree, epochs, 9)
+    await store_epochs(conn, tree, epochs, 22)
+    rows = (await conn.execute(epoch.select().order_by(epoch.c.id))).all()
+    assert [(row.first_interval, row.last_interval) for row in rows] == [
+        (0, 3),
+        (4, 7),
+        (8, 11),
+        (12, 15),
+        (16, 19),
+    ]
+
+    await epochs.refresh(conn)
+    assert epochs.covered == 20
+    assert epochs.heads[1] == (await tree.calculate_node(4, 8)).value
+    # Nothing new
+    await epochs.refresh(conn, 22)
+
+    with pytest.raises(EpochError):
+        await EpochHeads(3).refresh(conn)
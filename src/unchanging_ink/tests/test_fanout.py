@@ -0,0 +1,142 @@
+import asyncio
+from types import SimpleNamespace
+
+import orjson
+import pytest
+
+from unchanging_ink.fanout import Fanout, HeadHistory, relay_fanout
+from unchanging_ink.relay import Relay
+
+
+async def test_fanout_wait():
+    fanout = Fanout()
+    waiters = [asyncio.ensure_future(fanout.wait()) for _ in range(100)]
+    await asyncio.sleep(0)
+    await fanout.trigger("a")
+    assert await asyncio.gather(*waiters) == ["a"] * 100
+    assert fanout.seq == 1
+
+
+async def test_fanout_wait_after_catches_up():
+    fanout = Fanout(history=3)
+    seq = fanout.seq
+    for data in "abcd":
+        await fanout.trigger(data)
+
+    # Nothing is missed by not waiting at the time of the trigger
+    assert await fanout.wait_after(seq + 2) == [(3, "c"), (4, "d")]
+    # The history does not reach back far enough
+    assert await fanout.wait_after(seq) == [(2, "b"), (3, "c"), (4, "d")]
+
+
+async def test_fanout_wait_timeout():
+    fanout = Fanout()
+    waiter = asyncio.ensure_future(fanout.wait())
+    with pytest.raises(asyncio.TimeoutError):
+        await fanout.wait(timeout=0.01)
+    # The timed out waiter did not cancel the generation shared with the others
+    await fanout.trigger("a")
+    assert await waiter == "a"
+
+
+def _head(index: int) -> str:
+    return orjson.dumps({"interval": {"index": index}, "mth": "AAAA"}).decode()
+
+
+def test_head_history_since():
+    history = HeadHistory(4)
+    for i in range(10):
+        history.append(_head(i))
+
+    assert history.latest.index == 9
+    assert [frame.index for frame in history.since(7)] == [8, 9]
+    assert history.since(9) == []
+    # Does not reach back far enough, starts with the oldest retained head
+    assert [frame.index for frame in history.since(2)] == [6, 7, 8, 9]
+
+
+def test_head_history_ignores_replayed_heads():
+    history = HeadHistory(4)
+    history.append(_head(3))
+    assert history.append(_head(3)) is None
+    assert history.append(_head(2)) is None
+    assert [frame.index for frame in history.since(-1)] == [3]
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        "not json",
+        b"\xff",
+        "[]",
+        '{"interval": null}',
+        '{"interval": {"index": "5"}}',
+    ],
+)
+def test_head_history_skips_malformed_heads(data):
+    history = HeadHistory(4)
+    history.append(_head(3))
+    assert history.append(data) is None
+    assert history.append(_head(4).encode()).index == 4
+    assert [frame.index for frame in history.since(-1)] == [3, 4]
+
+
+def test_head_history_frames():
+    history = HeadHistory(4)
+    frame = history.append(_head(5))
+    assert frame.data == _head(5)
+    assert frame.event == b"id: 5\ndata: " + _head(5).encode() + b"\n\n"
+
+
+async def test_relay(tmp_path):
+    socket_path = str(tmp_path / "fanout.sock")
+    relay = Relay("redis://unused", 10)
+    for i in range(3):
+        relay._publish(_head(i))
+    server = await asyncio.start_unix_server(relay.handle_client, socket_path)
+
+    app = SimpleNamespace(
+        config=SimpleNamespace(FANOUT_SOCKET=socket_path),
+        ctx=SimpleNamespace(fanout=Fanout(), mth_history=HeadHistory(10)),
+    )
+    app.ctx.mth_history.append(_head(0))
+    client = asyncio.ensure_future(relay_fanout(app))
+    try:
+        # Replays what the worker process is missing
+        await app.ctx.fanout.wait_after(0, timeout=5)
+        assert [frame.index for frame in app.ctx.mth_history.since(-1)] == [0, 1, 2]
+
+        seq = app.ctx.fanout.seq
+        # Not relayed, and the relay goes on
+        relay._publish(b"not json")
+        relay._publish(_head(3))
+        assert await app.ctx.fanout.wait_after(seq, timeout=5) == [(seq + 1, _head(3))]
+    finally:
+        client.cancel()
+        await asyncio.gather(client, return_exceptions=True)
+        server.close()
+        await server.wait_closed()
+
+
+async def test_relay_fanout_skips_malformed_heads(tmp_path):
+    socket_path = str(tmp_path / "fanout.sock")
+
+    async def handle_client(reader, writer):
+        await reader.readline()
+        writer.write(b"not json\n" + _head(1).encode() + b"\n")
+        await writer.drain()
+        await reader.read()
+
+    server = await asyncio.start_unix_server(handle_client, socket_path)
+    app = SimpleNamespace(
+        config=SimpleNamespace(FANOUT_SOCKET=socket_path),
+        ctx=SimpleNamespace(fanout=Fanout(), mth_history=HeadHistory(10)),
+    )
+    client = asyncio.ensure_future(relay_fanout(app))
+    try:
+        assert await app.ctx.fanout.wait_after(0, timeout=5) == [(1, _head(1))]
+    finally:
+        client.cancel()
+        await asyncio.gather(client, return_exceptions=True)
+        server.close()
+        await server.wait_closed()
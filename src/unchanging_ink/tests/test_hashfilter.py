@@ -0,0 +1,125 @@
+import hashlib
+import uuid
+
+import pytest
+
+from unchanging_ink.hashfilter import (BITS_PER_ENTRY, BloomFilter,
+                                       HashFilterCache, add_interval, extend,
+                                       open_block, sync_hash_filter)
+from unchanging_ink.models import hash_filter, interval, timestamp
+
+
+def hashes(start, count):
+    return [
+        hashlib.sha3_256(str(i).encode()).digest() for i in range(start, start + count)
+    ]
+
+
+async def seal(conn, index, interval_hashes):
+    await conn.execute(
+        interval.insert(), {"id": index, "timestamp": "", "ith": bytes(32)}
+    )
+    if interval_hashes:
+        await conn.execute(
+            timestamp.insert(),
+            [
+                {"id": uuid.uuid4(), "timestamp": "", "hash": hash_, "interval": index}
+                for hash_ in interval_hashes
+            ],
+        )
+
+
+def test_bloom_filter():
+    bloom = BloomFilter.empty(1000 * BITS_PER_ENTRY)
+    members = hashes(0, 1000)
+    for hash_ in members:
+        bloom.add(hash_)
+    assert all(hash_ in bloom for hash_ in members)
+    false_positives = sum(hash_ in bloom for hash_ in hashes(1000, 10000))
+    assert false_positives < 200
+
+    assert BloomFilter.from_bytes(bloom.to_bytes()).bits == bloom.bits
+
+
+def test_fit():
+    bloom = BloomFilter.empty(2**16)
+    members = hashes(0, 100)
+    for hash_ in members:
+        bloom.add(hash_)
+    folded = bloom.fit(len(members))
+    assert len(folded.bits) * 8 >= len(members) * BITS_PER_ENTRY
+    assert len(folded.bits) < len(bloom.bits) // 32
+    assert all(hash_ in folded for hash_ in members)
+    assert sum(hash_ in folded for hash_ in hashes(100, 10000)) < 500
+
+
+def test_extend():
+    (block,) = extend(None, 0, hashes(0, 10), 1024)
+    assert (block.first_interval, block.last_interval, block.entries) == (0, 0, 10)
+    assert not block.closed and block.filter.capacity == 102
+
+    (same,) = extend(block, 1, hashes(10, 90), 1024)
+    assert same is block and block.entries == 100
+
+    # Full, it is closed and the next one starts after it
+    closed, new = extend(block, 2, hashes(100, 10), 1024)
+    assert closed is block and closed.closed and closed.last_interval == 1
+    assert all(hash_ in closed.filter for hash_ in hashes(0, 100))
+    assert (new.first_interval, new.last_interval, new.entries) == (2, 2, 10)
+
+    # Intervals larger than a block get a block of their own, large enough
+    _, large = extend(new, 3, hashes(0, 1000), 1024)
+    assert large.filter.capacity >= 1000
+
+
+async def test_add_interval(conn):
+    for index in range(20):
+        await add_interval(conn, index, hashes(index * 10, 10), 512)
+    rows = (await conn.execute(hash_filter.select())).all()
+    assert [row.closed for row in rows] == [True] * (len(rows) - 1) + [False]
+    assert [row.first_interval for row in rows][0] == 0
+    for row, next_row in zip(rows, rows[1:]):
+        assert next_row.first_interval == row.last_interval + 1
+
+    block = await open_block(conn)
+    assert block.last_interval == 19 and block.stored and not block.dirty
+    assert hashes(195, 1)[0] in block.filter
+
+
+async def test_sync_hash_filter(conn):
+    # Intervals 0 and 3 have no timestamps
+    for index in range(1, 3):
+        await seal(conn, index, hashes(index * 10, 10))
+    await sync_hash_filter(conn, 3, 1024)
+    block = await open_block(conn)
+    assert (block.first_interval, block.last_interval, block.entries) == (0, 3, 20)
+
+    await seal(conn, 5, hashes(50, 10))
+    await sync_hash_filter(conn, 5, 1024)
+    block = await open_block(conn)
+    assert (block.first_interval, block.last_interval, block.entries) == (0, 5, 30)
+    assert all(hash_ in block.filter for hash_ in hashes(10, 20) + hashes(50, 10))
+
+    # Covered already
+    await sync_hash_filter(conn, 4, 1024)
+    assert (await open_block(conn)).entries == 30
+
+
+async def test_cache(conn):
+    cache = HashFilterCache()
+    await cache.refresh(conn, 0)
+    assert cache.covered == -1 and not cache.may_contain(hashes(0, 1)[0])
+
+    for index in range(10):
+        await add_interval(conn, index, hashes(index * 10, 10), 512)
+    await cache.refresh(conn, 9)
+    assert cache.covered == 9
+    assert all(cache.may_contain(hash_) for hash_ in hashes(0, 100))
+
+    # The open block changed, and new ones were added
+    for index in range(10, 20):
+        await add_interval(conn, index, hashes(index * 10, 10), 512)
+    await cache.refresh(conn, 19)
+    assert cache.covered == 19
+    assert all(cache.may_contain(hash_) for hash_ in hashes(0, 200))
+    assert sum(cache.may_contain(hash_) for hash_ in hashes(1000, 1000)) < 100
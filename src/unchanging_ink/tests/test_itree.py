@@ -0,0 +1,119 @@
+import uuid
+
+import pytest
+
+from unchanging_ink.crypto.merkle import DictCachingMerkleTree
+from unchanging_ink.itree import (StoredIntervalTree, interval_tree_row,
+                                  tile_rows, tree_levels, with_proofs)
+from unchanging_ink.models import (interval, interval_tile, interval_tree,
+                                   timestamp)
+from unchanging_ink.schemas import (Interval, IntervalProofStructure,
+                                    MainTreeInclusionProof)
+from unchanging_ink.tiles import TileWriter, tile_path
+
+WIDTHS = list(range(1, 18)) + [100]
+MTH = "dev.unchanging.ink/{}#v1:AAAA"
+INCLUSION = MainTreeInclusionProof(head=0, leaf=None, a=1, nodes=[b"m" * 32] * 2)
+
+
+def hashes(width):
+    return [bytes([i % 256, i // 256]) * 16 for i in range(width)]
+
+
+@pytest.fixture
+async def conn(conn):
+    for index, width in enumerate(WIDTHS):
+        sealed = Interval(index, "2022-01-01T00:00:00.000000Z", bytes([index]) * 32)
+        await conn.execute(
+            interval.insert(),
+            {"id": index, "timestamp": sealed.timestamp, "ith": sealed.ith},
+        )
+        await conn.execute(
+            interval_tree.insert(),
+            interval_tree_row(sealed, width, MTH.format(index), INCLUSION, 2),
+        )
+        await conn.execute(
+            interval_tile.insert(),
+            tile_rows(sealed, tree_levels(hashes(width)), 2),
+        )
+        await conn.execute(
+            timestamp.insert(),
+            [
+                {
+                    "id": uuid.UUID(int=index << 32 | position),
+                    "timestamp": sealed.timestamp,
+                    "hash": hash_,
+                    "interval": index,
+                    "position": position,
+                }
+                for position, hash_ in enumerate(hashes(width))
+            ],
+        )
+    return conn
+
+
+@pytest.mark.parametrize("width", WIDTHS)
+async def test_tile_rows(width, tmp_path):
+    # The same tiles as those of a main tree of that width
+    writer = TileWriter(str(tmp_path), height=2)
+    await writer.update(await DictCachingMerkleTree.from_sequence(hashes(width)), width)
+    rows = tile_rows(Interval(0, "", b""), tree_levels(hashes(width)), 2)
+    assert rows
+    for row in rows:
+        path = tile_path(row["level"], row["index"], len(row["nodes"]) < 4 * 32)
+        assert (tmp_path / path).read_bytes() == row["nodes"]
+
+
+@pytest.mark.parametrize("index,width", list(enumerate(WIDTHS)))
+async def test_proofs(conn, index, width):
+    reference = await DictCachingMerkleTree.from_sequence(hashes(width))
+    stored = await StoredIntervalTree.load(conn, index)
+    proofs = await stored.proofs(conn, range(width))
+    for position in range(width):
+        a, path = await reference.compute_inclusion_proof(position)
+        assert proofs[position] == IntervalProofStructure(
+            a=a,
+            path=[node.value for node in path],
+            ith=bytes([index]) * 32,
+            mth=MTH.format(index),
+            interval_timestamp="2022-01-01T00:00:00.000000Z",
+            main_a=INCLUSION.a,
+            main_path=INCLUSION.nodes,
+        )
+
+    # Only the tiles the proof needs
+    tree = await StoredIntervalTree.load(conn, index)
+    await tree.proofs(conn, [width // 2])
+    assert len(tree.tiles) <= 2 * width.bit_length()
+
+    positions = list(range(0, width, 3))
+    nodes = await (await StoredIntervalTree.load(conn, index)).multiproof(
+        conn, positions
+    )
+    assert nodes == [
+        node.value for node in await reference.compute_multiproof(positions)
+    ]
+
+
+async def test_with_proofs(conn):
+    rows = list(
+        await conn.execute(timestamp.select().where(timestamp.c.interval >= 16))
+    )
+    derived = await with_proofs(conn, rows)
+    assert {row["interval"] for row in derived} == {16, 17}
+    for row in derived:
+        proof = IntervalProofStructure.from_cbor(row["proof"])
+        assert proof.mth == MTH.format(row["interval"])
+
+    # Timestamps with a proof of their own, or none yet, are passed through
+    await conn.execute(
+        timestamp.insert(),
+        [
+            {"id": uuid.UUID(int=1), "timestamp": "", "hash": b"", "proof": b"p"},
+            {"id": uuid.UUID(int=2), "timestamp": "", "hash": b"", "proof": None},
+        ],
+    )
+    rows = await conn.execute(
+        timestamp.select().where(timestamp.c.id.in_([uuid.UUID(int=i) for i in (1, 2)]))
+    )
+    assert [row["proof"] for row in await with_proofs(conn, rows)] == [b"p", None]
@@ -1,3 +1,5 @@
+import asyncio
+
 import pytest
 
 from unchanging_ink.crypto.merkle import (AbstractAsyncMerkleTree,
@@ -75,6 +77,15 @@ async def test_tree_four_content():
     assert t._d[(0, 4)] == t.root
 
 
+def test_node_digests():
+    a, b = MerkleNode.from_leaf(0, b"A"), MerkleNode.from_leaf(1, b"BB")
+    assert a.value == MerkleNode.leaf_digest(b"A")
+    assert (a + b).value == MerkleNode.combine_digests(a.value, b.value)
+    assert not hasattr(a, "__dict__")
+    for size, height in [(1, 1), (2, 2), (3, 3), (4, 3), (5, 4), (1 << 40, 41)]:
+        assert MerkleNode(8, 8 + size, b"").height == height
+
+
 async def test_proof_simple_7_0(merkle_tree_7):
     path, proof = await merkle_tree_7.compute_inclusion_proof(0)
     assert path == 0
@@ -183,3 +194,144 @@ async def test_consistency_proof_verify(old_width, new_width):
         EmptyMerkleTreeUncached.from_root_value(width=old_width, root_value=old_head),
         proof,
     )
+
+
+async def test_multiproof_nodes():
+    assert list(AbstractAsyncMerkleTree.multiproof_node_addresses(7, [0])) == [
+        (1, 2),
+        (2, 4),
+        (4, 7),
+    ]
+    # (2, 4) and (4, 7) are shared, and only listed once
+    assert list(AbstractAsyncMerkleTree.multiproof_node_addresses(7, [0, 1])) == [
+        (2, 4),
+        (4, 7),
+    ]
+    assert list(AbstractAsyncMerkleTree.multiproof_node_addresses(7, [6, 2])) == [
+        (0, 2),
+        (3, 4),
+        (4, 6),
+    ]
+
+
+@pytest.mark.parametrize(
+    "width,positions",
+    [
+        (n, positions)
+        for n in range(1, 12)
+        for positions in ([0], [n - 1], list(range(0, n, 2)), list(range(n)))
+    ],
+)
+async def test_multiproof_verify(width, positions):
+    tree = StandardMerkleTreeUncached(width=width)
+    root = await tree.calculate_node(0, width)
+    proof = await tree.compute_multiproof(positions)
+    leaves = [MerkleNode.from_leaf(p, str(p).encode()) for p in positions]
+
+    verifier = EmptyMerkleTreeUncached.from_root_value(width, root.value)
+    assert verifier.verify_multiproof(leaves, proof)
+
+    # The nodes shared between the leaves are only included once
+    single = set()
+    for p in positions:
+        single.update(
+            (node.start, node.end)
+            for node in (await tree.compute_inclusion_proof(p))[1]
+        )
+    assert len(proof) <= len(single)
+
+
+async def test_multiproof_verify_invalid(merkle_tree_11):
+    root = await merkle_tree_11.calculate_node(0, 11)
+    verifier = EmptyMerkleTreeUncached.from_root_value(11, root.value)
+    proof = await merkle_tree_11.compute_multiproof([2, 9])
+    leaves = [MerkleNode.from_leaf(p, str(p).encode()) for p in (2, 9)]
+
+    assert verifier.verify_multiproof(leaves, proof)
+    assert not verifier.verify_multiproof(leaves, proof[:-1])
+    assert not verifier.verify_multiproof(leaves, proof + proof[:1])
+    assert not verifier.verify_multiproof(leaves, list(reversed(proof)))
+    assert not verifier.verify_multiproof(leaves[:1], proof)
+    assert not verifier.verify_multiproof(
+        [leaves[0], MerkleNode.from_leaf(9, b"x")], proof
+    )
+    assert not verifier.verify_multiproof([leaves[0], leaves[0]], proof)
+
+
+class SlowMerkleTree(DictCachingMerkleTree):
+    """Every cache lookup and leaf a round trip, counting the ones running at once."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fetched = []
+        self.running = self.max_running = 0
+
+    async def _round_trip(self):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(0.001)
+        self.running -= 1
+
+    async def _getc(self, key):
+        await self._round_trip()
+        return await super()._getc(key)
+
+    async def fetch_leaf_data(self, position: int) -> bytes:
+        self.fetched.append(position)
+        await self._round_trip()
+        return str(position).encode()
+
+
+@pytest.mark.parametrize("concurrency", [1, 4, 64])
+async def test_concurrent_evaluation(concurrency):
+    sequential = SlowMerkleTree(width=37)
+    concurrent = SlowMerkleTree(width=37, concurrency=concurrency)
+
+    assert await concurrent.recalculate_root(37) == await sequential.recalculate_root(
+        37
+    )
+    assert sequential.max_running == 1
+    assert 1 < concurrent.max_running <= concurrency + 1
+    assert sorted(concurrent.fetched) == list(range(37))
+
+    for old_width in (1, 5, 36):
+        assert await concurrent.compute_consistency_proof(
+            old_width
+        ) == await sequential.compute_consistency_proof(old_width)
+    assert await concurrent.compute_inclusion_proof(
+        20
+    ) == await sequential.compute_inclusion_proof(20)
+
+
+async def test_concurrent_deduplication():
+    tree = SlowMerkleTree(width=16, concurrency=8)
+    results = await asyncio.gather(
+        tree.calculate_node(0, 16),
+        tree.calculate_node(0, 8),
+        tree.calculate_node(8, 12),
+    )
+    reference = StandardMerkleTreeUncached(width=16)
+    assert results == [
+        await reference.calculate_node(0, 16),
+        await reference.calculate_node(0, 8),
+        await reference.calculate_node(8, 12),
+    ]
+    # Every leaf only once, even though the requests overlap
+    assert sorted(tree.fetched) == list(range(16))
+    assert tree._inflight == {}
+
+
+async def test_concurrent_failure():
+    class FailingMerkleTree(SlowMerkleTree):
+        async def fetch_leaf_data(self, position: int) -> bytes:
+            await super().fetch_leaf_data(position)
+            if position == 5:
+                raise KeyError(position)
+            return str(position).encode()
+
+    tree = FailingMerkleTree(width=8, concurrency=4)
+    results = await asyncio.gather(
+        tree.calculate_node(0, 8), tree.calculate_node(4, 8), return_exceptions=True
+    )
+    assert [type(r) for r in results] == [KeyError, KeyError]
+    assert tree._inflight == {}
@@ -0,0 +1,90 @@
+import asyncio
+
+from unchanging_ink.crypto import DictCachingMerkleTree
+from unchanging_ink.metrics import (NODE_CACHE, Counter, Gauge, Histogram,
+                                    Registry, serve_metrics)
+
+
+def test_render():
+    registry = Registry()
+    requests = Counter("requests_total", "Requests", ["method"], registry=registry)
+    size = Gauge("size", "Size", registry=registry)
+    latency = Histogram(
+        "latency_seconds", "Latency", buckets=(0.1, 1), registry=registry
+    )
+
+    requests.labels(method="GET").inc()
+    requests.labels(method="GET").inc(2)
+    size.set(5)
+    latency.observe(0.05)
+    latency.observe(0.5)
+    latency.observe(0.5)
+    latency.observe(7)
+
+    assert registry.render().splitlines() == [
+        "# HELP requests_total Requests",
+        "# TYPE requests_total counter",
+        'requests_total{method="GET"} 3',
+        "# HELP size Size",
+        "# TYPE size gauge",
+        "size 5",
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="1.0"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        "latency_seconds_sum 8.05",
+        "latency_seconds_count 4",
+    ]
+
+
+def test_registry_labels():
+    registry = Registry()
+    requests = Counter("requests_total", "Requests", ["method"], registry=registry)
+    Gauge("size", "Size", registry=registry).set(5)
+    requests.labels(method="GET").inc()
+
+    registry.set_labels(worker="Sanic-Server-0-0")
+    assert registry.render().splitlines()[2::3] == [
+        'requests_total{worker="Sanic-Server-0-0",method="GET"} 1',
+        'size{worker="Sanic-Server-0-0"} 5',
+    ]
+
+
+def test_gauge_function():
+    registry = Registry()
+    gauge = Gauge("waiters", "Waiters", registry=registry)
+    values = [1, 2]
+    gauge.set_function(lambda: len(values))
+    values.append(3)
+    assert "waiters 3" in registry.render()
+
+
+async def test_node_cache_counters():
+    hit = NODE_CACHE.labels(tier="memory", result="hit")
+    miss = NODE_CACHE.labels(tier="memory", result="miss")
+    hits, misses = hit.value, miss.value
+
+    tree = await DictCachingMerkleTree.from_sequence([b"a", b"b", b"c"])
+    await tree.recalculate_root(3)
+
+    assert hit.value == hits + 1
+    assert miss.value == misses
+
+
+async def test_serve_metrics():
+    registry = Registry()
+    Counter("ticks_total", "Ticks", registry=registry).inc()
+    server = await serve_metrics("127.0.0.1", 0, registry)
+    port = server.sockets[0].getsockname()[1]
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        response = await reader.read()
+        writer.close()
+    finally:
+        server.close()
+        await server.wait_closed()
+
+    assert response.startswith(b"HTTP/1.1 200 OK\r\n")
+    assert response.endswith(b"\r\n\r\n" + registry.render().encode())
@@ -0,0 +1,111 @@
+import pytest
+
+from unchanging_ink.crypto.merkle import DictCachingMerkleTree, MerkleNode
+from unchanging_ink.models import interval
+from unchanging_ink.nodestore import (AbstractMmapCachingMerkleTree, NodeStore,
+                                      leaf_value, sync_node_store)
+
+
+class StandardMerkleTree(DictCachingMerkleTree):
+    async def fetch_leaf_data(self, position: int) -> bytes:
+        return str(position).encode()
+
+
+class MmapMerkleTree(AbstractMmapCachingMerkleTree):
+    async def fetch_leaf_data(self, position: int) -> bytes:
+        return str(position).encode()
+
+
+def leaves(start, end):
+    return [MerkleNode.from_leaf(i, str(i).encode()).value for i in range(start, end)]
+
+
+async def test_append_and_read(tmp_path):
+    writer = NodeStore(str(tmp_path), writable=True)
+    reader = NodeStore(str(tmp_path))
+    reference = StandardMerkleTree(width=37)
+
+    assert reader.get_node(0, 1) is None
+    writer.append_leaves(leaves(0, 20))
+    assert reader.width == 20
+    assert reader.get_node(0, 16) == (await reference.calculate_node(0, 16)).value
+    assert reader.get_node(16, 20) == (await reference.calculate_node(16, 20)).value
+    # Not perfect subtrees, or not complete yet
+    assert reader.get_node(0, 20) is None
+    assert reader.get_node(2, 6) is None
+    assert reader.get_node(16, 32) is None
+
+    writer.append_leaves(leaves(20, 37))
+    for size in (1, 2, 4, 8, 16, 32):
+        for start in range(0, 37 - size + 1, size):
+            assert (
+                reader.get_node(start, start + size)
+                == (await reference.calculate_node(start, start + size)).value
+            )
+
+    with pytest.raises(RuntimeError):
+        NodeStore(str(tmp_path), writable=True)
+    writer.close()
+    reader.close()
+
+
+async def test_crash_tail(tmp_path):
+    store = NodeStore(str(tmp_path), writable=True)
+    store.append_leaves(leaves(0, 5))
+    # Nodes written, but the width not yet
+    with open(tmp_path / "level-0", "ab") as f:
+        f.write(b"\xff" * 40)
+    store.close()
+
+    store = NodeStore(str(tmp_path), writable=True)
+    assert store.width == 5
+    assert store.get(0, 5) is None
+    store.append_leaves(leaves(5, 8))
+    reference = StandardMerkleTree(width=8)
+    assert store.get_node(0, 8) == (await reference.calculate_node(0, 8)).value
+    assert store.get(0, 5) == leaves(5, 6)[0]
+
+
+async def test_mmap_tree(tmp_path):
+    store = NodeStore(str(tmp_path), writable=True)
+    tree = MmapMerkleTree(store)
+    reference = StandardMerkleTree()
+    for width in (1, 2, 7, 33):
+        assert await tree.recalculate_root(width) == await reference.recalculate_root(
+            width
+        )
+        assert store.width == width
+        assert await tree.compute_inclusion_proof(
+            width // 2
+        ) == await reference.compute_inclusion_proof(width // 2)
+        assert await tree.compute_consistency_proof(
+            1
+        ) == await reference.compute_consistency_proof(1)
+
+    reader = MmapMerkleTree(NodeStore(str(tmp_path)), width=33)
+    assert (await reader.calculate_node(0, 33)).value == reference.root.value
+
+
+async def test_sync_node_store(conn, tmp_path):
+    rows = [
+        {"id": i, "timestamp": "2022-01-01T00:00:00.000000Z", "ith": bytes(32)}
+        for i in range(25)
+    ]
+    await conn.execute(interval.insert(), rows[:10])
+
+    store = NodeStore(str(tmp_path), writable=True)
+    await sync_node_store(store, conn, batch=3)
+    assert store.width == 10
+    await conn.execute(interval.insert(), rows[10:])
+    await sync_node_store(store, conn, check=False)
+    assert store.width == 25
+
+    result = await conn.execute(interval.select().order_by(interval.c.id))
+    expected = [leaf_value(row) for row in result]
+    assert [store.get(0, i) for i in range(25)] == expected
+
+    # A store that belongs to another database is rebuilt
+    store.truncate(20)
+    store.append_leaves([bytes(32)] * 5)
+    await sync_node_store(store, conn)
+    assert [store.get(0, i) for i in range(25)] == expected
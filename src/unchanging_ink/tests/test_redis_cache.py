@@ -3,9 +3,19 @@ import sys
 from functools import wraps
 
 import aioredis
+import cbor2
 import pytest
 
-from unchanging_ink.cache import AbstractRedisAsyncCachingMerkleTree
+from unchanging_ink.cache import (LAYOUT_KEYS, LAYOUT_PACKED,
+                                  AbstractRedisAsyncCachingMerkleTree,
+                                  MainMerkleTree)
+from unchanging_ink.crypto import MerkleNode
+from unchanging_ink.epochs import EpochHeads, store_epochs
+from unchanging_ink.fanout import HeadHistory
+from unchanging_ink.models import interval
+from unchanging_ink.schemas import Epoch, EpochInclusionProof
+from unchanging_ink.throttle import (PENDING_KEY, Admission, Overloaded,
+                                     Throttle)
 
 from .test_merkle import StandardMerkleTreeUncached
 
@@ -66,3 +76,121 @@ async def test_redis_merkle_2(aioredisconn):
     tree_b = StandardMerkleTreeRedisCached(aioredisconn, width=23)
 
     assert (await tree_a.calculate_node(0, 23)) == (await tree_b.calculate_node(0, 23))
+
+
+@pytest.mark.parametrize("layout", [LAYOUT_KEYS, LAYOUT_PACKED])
+async def test_redis_merkle_layout(aioredisconn, layout):
+    reference = StandardMerkleTreeUncached(width=1000)
+    tree = StandardMerkleTreeRedisCached(aioredisconn, width=1000, layout=layout)
+    assert (await tree.calculate_node(0, 1000)) == (
+        await reference.calculate_node(0, 1000)
+    )
+
+    # The proofs only need perfect subtrees, which both layouts cache
+    tree = StandardMerkleTreeRedisCached(aioredisconn, width=1000, layout=layout)
+    for position in (0, 517, 999):
+        assert await tree.compute_inclusion_proof(
+            position
+        ) == await reference.compute_inclusion_proof(position)
+    assert tree.nodes_generated == 0
+
+
+async def test_redis_packed_keys(aioredisconn):
+    tree = StandardMerkleTreeRedisCached(aioredisconn, width=600, layout=LAYOUT_PACKED)
+    await tree.calculate_node(0, 600)
+
+    # 3 strings of leaves, 2 of nodes of size 2, 1 each for the 8 larger sizes
+    assert len(await aioredisconn.keys()) == 13
+    assert len(await aioredisconn.get(b"n0:2")) == (600 - 512) * 32
+    assert await aioredisconn.ttl(b"n0:2") > 0
+
+
+async def test_redis_main_tree_epochs(aioredisconn, conn):
+    await conn.execute(
+        interval.insert(),
+        [
+            {"id": i, "timestamp": "2022-01-01T00:00:00.000000Z", "ith": bytes(32)}
+            for i in range(300)
+        ],
+    )
+    tree = MainMerkleTree(aioredisconn, conn)
+    root = await tree.recalculate_root(300)
+    epochs = EpochHeads(7)
+    await store_epochs(conn, tree, epochs, 300)
+    await epochs.refresh(conn)
+    assert epochs.covered == 256
+
+    # The complete epochs are not needed any more
+    await aioredisconn.flushdb()
+    await conn.execute(interval.delete().where(interval.c.id < 256))
+    tree = MainMerkleTree(aioredisconn, conn, epochs=epochs)
+    assert await tree.recalculate_root(300) == root
+
+
+async def test_redis_throttle(aioredisconn):
+    # Two processes, leasing two tokens at a time
+    throttles = [Throttle(aioredisconn, lease=2) for _ in range(2)]
+    waits = [await throttles[i % 2].take("a", 1, 4) for i in range(3)]
+    assert waits == [0] * 3
+    assert 0 < await throttles[0].take("a", 1, 4) <= 1
+    # Left in the lease of the other one
+    assert await throttles[1].take("a", 1, 4) == 0
+    assert await throttles[1].take("a", 1, 4) > 0
+
+    assert await throttles[0].take("b", 1, 4) == 0
+    assert 0 < await aioredisconn.pttl("throttle:a") <= 5000
+
+
+async def test_redis_admission_pending(aioredisconn):
+    history = HeadHistory(10)
+    admission = Admission(max_pending=2, max_seal_lag=0)
+    for _ in range(3):
+        await admission.check(aioredisconn, history, 0)
+        await admission.added(aioredisconn)
+    with pytest.raises(Overloaded):
+        await admission.check(aioredisconn, history, 0)
+
+    # Sealed by the worker
+    await aioredisconn.set(PENDING_KEY, 1)
+    await admission.check(aioredisconn, history, 0)
+    assert admission.pending == 1
+
+
+@pytest.fixture
+def api_redis_url(redis_proc):
+    return f"redis://{redis_proc.host}:{redis_proc.port}"
+
+
+@pytest.mark.parametrize("api_config", [{"EPOCH_BITS": 2}])
+async def test_redis_epoch_inclusion(app, api, aioredisconn):
+    async with app.ctx.engine.begin() as conn:
+        await conn.execute(
+            interval.insert(),
+            [
+                {"id": i, "timestamp": "2022-01-01T00:00:00.000000Z", "ith": bytes(32)}
+                for i in range(11)
+            ],
+        )
+        await store_epochs(conn, MainMerkleTree(aioredisconn, conn), EpochHeads(2), 11)
+
+    async def get(path):
+        _, response = await api.get(path, headers={"accept": "application/cbor"})
+        assert response.status == 200
+        return response.content
+
+    for index in range(2):
+        head = Epoch.from_cbor(await get(f"/v1/epoch/{index}")).head
+        for width in range((index + 1) * 4, 12):
+            proof = EpochInclusionProof.from_cbor(
+                await get(f"/v1/epoch/{index}/in/{width}")
+            )
+            mth = cbor2.loads(await get(f"/v1/mth/{width - 1}"))["mth"]
+            # From the epoch head up
+            value, a = head, proof.a
+            for node in proof.nodes:
+                if a & 1:
+                    value = MerkleNode.combine_digests(node, value)
+                else:
+                    value = MerkleNode.combine_digests(value, node)
+                a >>= 1
+            assert value == mth
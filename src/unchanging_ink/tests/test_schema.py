@@ -1,8 +1,15 @@
+import base64
+import dataclasses
 import datetime
+import uuid
 
+import cbor2
 import dateutil.parser
+import orjson
 
-from unchanging_ink.schemas import TimestampRequest, TimestampStructure
+from unchanging_ink.schemas import (IntervalProofStructure, TimestampList,
+                                    TimestampRequest, TimestampStructure,
+                                    TimestampWithId)
 
 
 def test_parse_timestamp_request_cbor():
@@ -37,3 +44,71 @@ def test_roundtrip_timestamp_structure():
     assert ts2 == ts1
     ts2_encoded = ts2.to_cbor()
     assert ts1_encoded == ts2_encoded
+
+
+def _stored_timestamp(**kwargs):
+    proof = IntervalProofStructure(
+        a=5,
+        path=[bytes(range(32)), bytes(range(32, 64))],
+        ith=bytes(range(64, 96)),
+        mth="dev.unchanging.ink/23#v1:AAAA",
+    )
+    return (
+        proof,
+        TimestampWithId(
+            hash=bytes(range(96, 128)),
+            timestamp="2021-04-05T23:39:42.944682Z",
+            proof=proof.to_cbor(),
+            id=uuid.UUID("154084e6-9573-41a1-9ab4-f2724dae23b3"),
+            interval=23,
+            **kwargs,
+        ),
+    )
+
+
+def test_stored_proof_passthrough_cbor():
+    proof, stored = _stored_timestamp()
+    decoded = dataclasses.replace(stored, proof=proof)
+    assert stored.to_cbor() == decoded.to_cbor()
+    assert TimestampWithId.from_cbor(stored.to_cbor()).proof == proof
+
+
+def test_stored_proof_transcode_json():
+    proof, stored = _stored_timestamp()
+    decoded = dataclasses.replace(stored, proof=proof)
+    assert stored.to_json() == decoded.to_json()
+    assert stored.proof_structure == proof
+
+
+def test_proof_bundle_encoding():
+    proof, _ = _stored_timestamp()
+    assert "main_path" not in cbor2.loads(proof.to_cbor())
+    assert "main_path" not in proof.as_json_data()
+
+    bundled = dataclasses.replace(
+        proof,
+        interval_timestamp="2021-04-05T23:39:45.000000Z",
+        main_a=3,
+        main_path=[bytes(range(128, 160))],
+    )
+    assert IntervalProofStructure.from_cbor(bundled.to_cbor()) == bundled
+    assert bundled.as_json_data()["main_path"] == [
+        base64.b64encode(bytes(range(128, 160))).decode()
+    ]
+
+
+def test_timestamp_list():
+    _, stored = _stored_timestamp()
+    pending = TimestampWithId(
+        hash=bytes(32), timestamp="2021-04-05T23:39:43.000000Z", id=uuid.uuid4()
+    )
+    timestamps = TimestampList([stored, pending])
+    assert cbor2.loads(timestamps.to_cbor()) == [
+        cbor2.loads(stored.to_cbor()),
+        cbor2.loads(pending.to_cbor()),
+    ]
+    assert orjson.loads(timestamps.to_json()) == [
+        orjson.loads(stored.to_json()),
+        orjson.loads(pending.to_json()),
+    ]
+    assert TimestampList([]).to_json() == b"[]"
@@ -0,0 +1,113 @@
+import base64
+import io
+from hashlib import sha3_256
+
+import pytest
+
+from unchanging_ink.crypto.merkle import DictCachingMerkleTree
+from unchanging_ink.models import interval, interval_tree, timestamp
+from unchanging_ink.nodestore import NodeStore
+from unchanging_ink.schemas import Interval, IntervalProofStructure
+from unchanging_ink.snapshot import (Snapshot, SnapshotError, check_stored_mth,
+                                     export_snapshot, stored_mth)
+
+WIDTH = 45
+
+
+@pytest.fixture
+async def conn(conn):
+    intervals = [
+        Interval(i, "2022-01-01T00:00:00.000000Z", bytes([i]) * 32)
+        for i in range(WIDTH)
+    ]
+    await conn.execute(
+        interval.insert(),
+        [{"id": i.index, "timestamp": i.timestamp, "ith": i.ith} for i in intervals],
+    )
+    reference = await DictCachingMerkleTree.from_sequence(
+        i.calculate_hash() for i in intervals[:40]
+    )
+    mth = "dev.unchanging.ink/39#v1:" + b64url(reference.root.value)
+    await conn.execute(
+        timestamp.insert().values(
+            id="00000000-0000-0000-0000-000000000000",
+            timestamp="2022-01-01T00:00:00.000000Z",
+            hash=bytes(32),
+            interval=39,
+            proof=IntervalProofStructure(0, [], bytes(32), mth).to_cbor(),
+        )
+    )
+    return conn
+
+
+def b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+async def test_snapshot_roundtrip(conn, tmp_path):
+    snapshot = await export_snapshot(conn)
+    await check_stored_mth(conn, snapshot)
+    f = io.BytesIO()
+    snapshot.write(f)
+
+    f.seek(0)
+    loaded = Snapshot.read(f)
+    loaded.check(full=True)
+    assert loaded.width == WIDTH and loaded.mth == snapshot.mth
+
+    store = NodeStore(str(tmp_path), writable=True)
+    store.load(loaded.width, loaded.levels)
+    result = await conn.execute(interval.select().order_by(interval.c.id))
+    reference = await DictCachingMerkleTree.from_sequence(
+        Interval.from_row(row).calculate_hash() for row in result
+    )
+    assert reference.root.value == snapshot.mth
+    for start, end in ((0, 32), (32, 40), (40, 44), (44, 45)):
+        assert (
+            store.get_node(start, end)
+            == (await reference.calculate_node(start, end)).value
+        )
+
+
+async def test_snapshot_corrupt(conn):
+    snapshot = await export_snapshot(conn)
+    f = io.BytesIO()
+    snapshot.write(f)
+    data = bytearray(f.getvalue())
+
+    data[100] ^= 1
+    with pytest.raises(SnapshotError, match="checksum"):
+        Snapshot.read(io.BytesIO(data))
+    truncated = f.getvalue()[:-64]
+    with pytest.raises(SnapshotError, match="truncated"):
+        Snapshot.read(io.BytesIO(truncated + sha3_256(truncated).digest()))
+
+    # The mth at 40 is made of the nodes (0, 32) and (32, 40)
+    snapshot.levels[3] = bytes(len(snapshot.levels[3]))
+    with pytest.raises(SnapshotError, match="interval hashes"):
+        snapshot.check(full=True)
+    with pytest.raises(SnapshotError, match="interval 39"):
+        await check_stored_mth(conn, snapshot)
+
+
+async def test_stored_mth_interval_tree(conn):
+    intervals = [
+        Interval.from_row(row) for row in await conn.execute(interval.select())
+    ]
+    reference = await DictCachingMerkleTree.from_sequence(
+        i.calculate_hash() for i in intervals[:43]
+    )
+    await conn.execute(
+        interval_tree.insert().values(
+            interval=42,
+            width=0,
+            tile_height=4,
+            mth="dev.unchanging.ink/42#v1:" + b64url(reference.root.value),
+            main_a=0,
+            main_path=b"",
+        )
+    )
+    # The interval tree is newer than the proof of interval 39
+    assert await stored_mth(conn, WIDTH) == (42, reference.root.value)
+    assert (await stored_mth(conn, 42))[0] == 39
+    assert await stored_mth(conn, 39) is None
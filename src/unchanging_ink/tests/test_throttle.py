@@ -0,0 +1,60 @@
+import aioredis
+import pytest
+
+from unchanging_ink.fanout import HeadHistory
+from unchanging_ink.throttle import (Admission, Overloaded, Throttle,
+                                     TokenBucket, retry_after_header)
+
+
+def test_token_bucket():
+    bucket = TokenBucket(burst=3, now=0)
+    assert [bucket.take(2, 3, 0) for _ in range(3)] == [(1, 0.0)] * 3
+    assert bucket.take(2, 3, 0) == (0, 0.5)
+    assert bucket.take(2, 3, 0.5) == (1, 0.0)
+
+    # Refilled up to the burst only
+    assert bucket.take(2, 3, 100, requested=5) == (3, 0.0)
+    assert bucket.take(2, 3, 100.25) == (0, 0.25)
+
+
+def test_retry_after_header():
+    assert retry_after_header(0.01) == "1"
+    assert retry_after_header(2.5) == "3"
+
+
+async def test_throttle_without_redis():
+    # Nothing listens there, every process keeps its own buckets
+    redis = aioredis.from_url("redis://127.0.0.1:1")
+    throttle = Throttle(redis, lease=5)
+    assert [await throttle.take("a", 1, 2) for _ in range(2)] == [0, 0]
+    assert await throttle.take("a", 1, 2) > 0
+    assert await throttle.take("b", 1, 2) == 0
+    await redis.close()
+
+
+async def test_admission_seal_lag():
+    history = HeadHistory(10)
+    admission = Admission(max_pending=0, max_seal_lag=60)
+    await admission.check(None, history, 3)
+
+    history.updated -= 61
+    with pytest.raises(Overloaded) as e:
+        await admission.check(None, history, 3)
+    assert e.value.retry_after == 3
+
+    history.append('{"interval": {"index": 0}}')
+    await admission.check(None, history, 3)
+
+
+async def test_admission_without_redis():
+    redis = aioredis.from_url("redis://127.0.0.1:1")
+    history = HeadHistory(10)
+    admission = Admission(max_pending=1, max_seal_lag=0)
+    for _ in range(2):
+        await admission.check(redis, history, 0)
+        await admission.added(redis)
+    # Counted by this process alone
+    assert admission.pending == 2
+    with pytest.raises(Overloaded):
+        await admission.check(redis, history, 0)
+    await redis.close()
@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+from unchanging_ink.crypto.merkle import DictCachingMerkleTree
+from unchanging_ink.tiles import (DirectoryTileMerkleTree, TileNotFound,
+                                  TileWriter)
+
+
+class StandardMerkleTree(DictCachingMerkleTree):
+    async def fetch_leaf_data(self, position: int) -> bytes:
+        return str(position).encode()
+
+
+async def check_tiles(directory, width, height):
+    reference = StandardMerkleTree(width=width)
+    await reference.recalculate_root(width)
+    tiles = DirectoryTileMerkleTree(directory, width=width, height=height)
+
+    assert (await tiles.calculate_node(0, width)).value == reference.root.value
+    for position in {0, width // 3, width - 1}:
+        assert await tiles.compute_inclusion_proof(
+            position
+        ) == await reference.compute_inclusion_proof(position)
+    for old_width in {1, width // 2 or 1, width - 1 or 1}:
+        assert await tiles.compute_consistency_proof(
+            old_width
+        ) == await reference.compute_consistency_proof(old_width)
+
+
+async def test_tiles_incremental(tmp_path):
+    tree = StandardMerkleTree()
+    writer = TileWriter(str(tmp_path), height=2)
+    for width in range(1, 70):
+        await writer.update(tree, width)
+        assert writer.width == width
+        await check_tiles(str(tmp_path), width, 2)
+
+    # 69 leaves, 17 nodes of size 4, 4 of size 16 and 1 of size 64
+    assert set(os.listdir(tmp_path / "0")) == {str(i) for i in range(17)} | {"17.p"}
+    assert set(os.listdir(tmp_path / "1")) == {"0", "1", "2", "3", "4.p"}
+    assert set(os.listdir(tmp_path / "2")) == {"0"}
+    assert (tmp_path / "3" / "0.p").stat().st_size == 32
+
+
+async def test_tiles_catch_up(tmp_path):
+    tree = StandardMerkleTree()
+    writer = TileWriter(str(tmp_path), height=3)
+    for width in (5, 6, 300, 301, 1000):
+        await writer.update(tree, width)
+        await check_tiles(str(tmp_path), width, 3)
+
+
+async def test_tiles_filled_since(tmp_path):
+    tree = StandardMerkleTree()
+    writer = TileWriter(str(tmp_path), height=2)
+    await writer.update(tree, 10)
+    tiles = DirectoryTileMerkleTree(str(tmp_path), width=10, height=2)
+    await writer.update(tree, 12)
+
+    reference = StandardMerkleTree(width=10)
+    assert await tiles.calculate_node(0, 10) == await reference.calculate_node(0, 10)
+    with pytest.raises(TileNotFound):
+        await DirectoryTileMerkleTree(str(tmp_path), width=20, height=2).calculate_node(
+            0, 20
+        )
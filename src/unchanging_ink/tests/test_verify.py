@@ -0,0 +1,221 @@
+import base64
+import re
+import socket
+
+import cbor2
+import pytest
+
+from unchanging_ink.crypto import DictCachingMerkleTree
+from unchanging_ink.schemas import (Interval, MainHeadWithConsistency,
+                                    MainTreeConsistencyProof,
+                                    MainTreeInclusionProof, TimestampStructure)
+from unchanging_ink.verify import (CachingSource, ExportSource, HeadStore,
+                                   HTTPSource, Receipt, Source,
+                                   VerificationError, verify_batch)
+
+AUTHORITY = "dev.unchanging.ink"
+
+
+class DictSource(Source):
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def get(self, path: str) -> bytes:
+        self.requests.append(path)
+        try:
+            return self.responses[path]
+        except KeyError:
+            raise VerificationError(f"{path} not found")
+
+
+def b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+@pytest.fixture
+async def log():
+    """API responses and receipts for 5 intervals of 3 timestamps each."""
+    responses, receipts, intervals = {}, [], []
+    for index in range(5):
+        timestamp = f"2022-01-01T00:00:0{index}.000000Z"
+        data = [f"data {index} {i}" for i in range(3)]
+        hashes = [
+            TimestampStructure(data=d, timestamp=timestamp).calculate_hash()
+            for d in data
+        ]
+        interval_tree = await DictCachingMerkleTree.from_sequence(hashes)
+        interval = Interval(index, timestamp, interval_tree.root.value)
+        intervals.append(interval)
+        main_tree = await DictCachingMerkleTree.from_sequence(
+            i.calculate_hash() for i in intervals
+        )
+        responses[f"v1/mth/{index}"] = MainHeadWithConsistency(
+            authority=AUTHORITY, interval=interval, mth=main_tree.root.value
+        ).to_cbor()
+        main_a, main_path = await main_tree.compute_inclusion_proof(index)
+        responses[f"v1/mth/{index}/in/{index + 1}"] = MainTreeInclusionProof(
+            index, index + 1, main_a, [node.value for node in main_path]
+        ).to_cbor()
+        for old_width in range(1, index + 1):
+            proof = await main_tree.compute_consistency_proof(old_width)
+            responses[
+                f"v1/mth/{index + 1}/from/{old_width}"
+            ] = MainTreeConsistencyProof(
+                old_width, index + 1, [node.value for node in proof]
+            ).to_cbor()
+
+        for i, d in enumerate(data):
+            a, path = await interval_tree.compute_inclusion_proof(i)
+            items = [a, [node.value for node in path]]
+            head = ""
+            if i == 0:
+                # With a proof bundle
+                items += [timestamp, main_a, [node.value for node in main_path]]
+                head = ":" + b64url(main_tree.root.value)
+            receipts.append(
+                (
+                    f"{AUTHORITY}/{index}#v1{head},{timestamp},"
+                    + b64url(cbor2.dumps(items)),
+                    d,
+                )
+            )
+    return responses, receipts
+
+
+def test_parse_receipt():
+    receipt = Receipt.parse(
+        f"{AUTHORITY}/5#v1,2022-01-01T00:00:00.000000Z,"
+        + b64url(cbor2.dumps([3, [b"a" * 32, b"b" * 32]]))
+    )
+    assert (receipt.interval, receipt.a, receipt.path) == (5, 3, [b"a" * 32, b"b" * 32])
+    assert receipt.mth is None and receipt.main_path is None
+
+    with pytest.raises(VerificationError):
+        Receipt.parse(f"{AUTHORITY}/5#v1:AAAA")
+    with pytest.raises(VerificationError):
+        Receipt.parse(f"{AUTHORITY}/5#v1,2022-01-01T00:00:00.000000Z,AAAA")
+
+
+async def test_verify_receipts(log):
+    responses, receipts = log
+    source = DictSource(responses)
+    store = HeadStore(source)
+
+    for index in range(5):
+        lines = [r for r in receipts if r[0].startswith(f"{AUTHORITY}/{index}#")]
+        assert verify_batch(store.head(index), lines) == (3, [])
+    # Each head is only fetched once
+    store.head(2)
+    assert len(source.requests) == 10
+
+    assert store.check_consistency(4) == []
+
+
+async def test_verify_receipts_invalid(log):
+    responses, receipts = log
+    store = HeadStore(DictSource(responses))
+    receipt, data = receipts[3]
+    other_mth = receipts[6][0].split(":", 1)[1].split(",", 1)[0]
+    wrong_mth = re.sub(r":[^,]+,", f":{other_mth},", receipt, count=1)
+
+    verified, failures = verify_batch(
+        store.head(1),
+        [(receipt, data + "x"), (receipt, data), (wrong_mth, data), receipts[6]],
+    )
+    assert verified == 1
+    assert [reason for _, reason in failures] == [
+        "hash not in the interval tree",
+        "mth differs from the interval head",
+        "hash not in the interval tree",
+    ]
+
+
+@pytest.mark.parametrize(
+    "items",
+    [
+        [0, 5],
+        ["0", []],
+        [-1, []],
+        [0, [b"a"]],
+        [0, ["a" * 32]],
+        [0, [], "2022-01-01T00:00:01.000000Z", 1, None],
+        [0, [], "2022-01-01T00:00:01.000000Z", None, []],
+        [0, [], 5, 1, []],
+        {"a": 0},
+    ],
+)
+async def test_verify_receipts_malformed(log, items):
+    responses, receipts = log
+    store = HeadStore(DictSource(responses))
+    malformed = f"{AUTHORITY}/1#v1,2022-01-01T00:00:01.000000Z," + b64url(
+        cbor2.dumps(items)
+    )
+    with pytest.raises(VerificationError):
+        Receipt.parse(malformed)
+
+    # Does not stop the batch
+    verified, failures = verify_batch(
+        store.head(1), [(malformed, "data 1 0"), receipts[3]]
+    )
+    assert verified == 1
+    assert failures == [(malformed, "malformed proof")]
+
+
+async def test_verify_inconsistent_head(log):
+    responses, _ = log
+    head = cbor2.loads(responses["v1/mth/4"])
+    head["mth"] = bytes(32)
+    responses["v1/mth/4"] = cbor2.dumps(head)
+    store = HeadStore(DictSource(responses))
+
+    store.head(1)
+    with pytest.raises(VerificationError):
+        store.head(4)
+    assert store.check_consistency(3) == []
+
+
+@pytest.mark.parametrize(
+    "path,malformed",
+    [
+        ("v1/mth/2", b"\xff"),
+        ("v1/mth/2", cbor2.dumps({"mth": bytes(32)})),
+        ("v1/mth/2", cbor2.dumps([1, 2])),
+        ("v1/mth/2/in/3", cbor2.dumps({"a": 0})),
+        ("v1/mth/2/in/3", cbor2.dumps({"a": 0, "b": 1, "nodes": 5})),
+    ],
+)
+async def test_verify_malformed_head(log, path, malformed):
+    responses, _ = log
+    responses[path] = malformed
+    store = HeadStore(DictSource(responses))
+    with pytest.raises(VerificationError):
+        store.head(2)
+    store.head(1)
+
+
+def test_http_source_timeout():
+    # Accepts connections, but never answers
+    with socket.socket() as server:
+        server.bind(("127.0.0.1", 0))
+        server.listen()
+        source = HTTPSource(f"http://127.0.0.1:{server.getsockname()[1]}", 0.1)
+        with pytest.raises(VerificationError):
+            source.get("v1/mth/0")
+
+
+async def test_caching_source(log, tmp_path):
+    responses, receipts = log
+    source = DictSource(responses)
+    cached = CachingSource(source, str(tmp_path / "cache.db"), str(tmp_path / "export"))
+    cached.get("v1/mth/3")
+    cached.get("v1/mth/3")
+    assert source.requests == ["v1/mth/3"]
+
+    cached = CachingSource(DictSource({}), str(tmp_path / "cache.db"))
+    assert cached.get("v1/mth/3") == responses["v1/mth/3"]
+
+    export = ExportSource(str(tmp_path / "export"))
+    assert export.get("v1/mth/3") == responses["v1/mth/3"]
+    with pytest.raises(VerificationError):
+        export.get("v1/mth/4")
@@ -0,0 +1,223 @@
+"""Admission control on the ingest path.
+
+Every client has a token bucket in redis, refilled at THROTTLE_RATE tokens a
+second up to THROTTLE_BURST, and every request for a timestamp takes a token.
+Clients are told apart by their address, as the proxy passes it in
+REAL_IP_HEADER, or by their API key if they send one of THROTTLE_API_KEYS in
+API_KEY_HEADER, which gets a bucket with limits of its own.
+
+Asking redis for every request would add a round trip to each, so every
+process takes up to THROTTLE_LEASE tokens of a bucket at once and hands them
+out on its own until they are used up or LEASE_SECONDS old. A client can
+exceed its burst by that many tokens per process. If redis cannot be reached,
+every process keeps buckets of its own instead.
+
+Independent of the clients, new timestamps are refused while more than
+ADMISSION_MAX_PENDING wait to be sealed, or no interval was sealed for
+ADMISSION_MAX_SEAL_LAG seconds. The worker sets PENDING_KEY to the number of
+timestamps still waiting after every interval it seals, and the API processes
+increment it for every timestamp they add, which also tells them the count. If
+redis cannot be reached, every process counts the timestamps it added since it
+last could.
+"""
+import hashlib
+import math
+import time
+from collections import OrderedDict
+from typing import Tuple
+
+import structlog
+from aioredis import Redis
+from aioredis.exceptions import ConnectionError as RedisConnectionError
+from aioredis.exceptions import TimeoutError as RedisTimeoutError
+from sanic.exceptions import SanicException, ServiceUnavailable
+
+from .fanout import HeadHistory
+from .metrics import THROTTLED
+
+logger = structlog.getLogger(__name__)
+
+PENDING_KEY = "pending-timestamps"
+LEASE_SECONDS = 1.0
+# Clients per process that have a lease or a local bucket
+MAX_CLIENTS = 10000
+
+# KEYS[1]: the bucket, ARGV: rate, burst, now, tokens requested
+# Returns the tokens granted and, if none, the seconds until there is one
+BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local granted = math.min(tonumber(ARGV[4]), math.floor(tokens))
+tokens = tokens - granted
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "updated", tostring(now))
+redis.call("PEXPIRE", KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+local wait = 0
+if granted == 0 then
+    wait = (1 - tokens) / rate
+end
+return {granted, tostring(wait)}
+"""
+
+_throttled_client = THROTTLED.labels(reason="client")
+_throttled_pending = THROTTLED.labels(reason="pending")
+_throttled_lag = THROTTLED.labels(reason="seal_lag")
+
+
+class Throttled(SanicException):
+    status_code = 429
+    quiet = True
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Overloaded(ServiceUnavailable):
+    quiet = True
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def retry_after_header(seconds: float) -> str:
+    return str(max(1, math.ceil(seconds)))
+
+
+class TokenBucket:
+    """A bucket of this process only, the same as BUCKET_SCRIPT."""
+
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, burst: float, now: float):
+        self.tokens = burst
+        self.updated = now
+
+    def take(
+        self, rate: float, burst: float, now: float, requested: int = 1
+    ) -> Tuple[int, float]:
+        tokens = min(burst, self.tokens + max(0.0, now - self.updated) * rate)
+        granted = min(requested, math.floor(tokens))
+        self.tokens, self.updated = tokens - granted, now
+        return granted, 0.0 if granted else (1 - self.tokens) / rate
+
+
+def remember(clients: OrderedDict, key: str, value):
+    clients[key] = value
+    clients.move_to_end(key)
+    if len(clients) > MAX_CLIENTS:
+        clients.popitem(last=False)
+
+
+class Throttle:
+    """The token buckets of all clients, as seen by one process."""
+
+    def __init__(self, redis: Redis, lease: int):
+        self.lease = lease
+        self._script = redis.register_script(BUCKET_SCRIPT)
+        # key: (tokens, monotonic time they expire)
+        self._leases: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()
+        self._local: "OrderedDict[str, TokenBucket]" = OrderedDict()
+
+    async def take(self, key: str, rate: float, burst: float) -> float:
+        """Take a token of the bucket `key`. Returns 0 if there was one,
+        otherwise the seconds until there will be."""
+        now = time.monotonic()
+        tokens, expires = self._leases.get(key, (0, now))
+        if tokens and now < expires:
+            self._leases[key] = (tokens - 1, expires)
+            return 0.0
+        try:
+            granted, wait = await self._script(
+                keys=[f"throttle:{key}"], args=[rate, burst, time.time(), self.lease]
+            )
+            wait = float(wait)
+        except (RedisConnectionError, RedisTimeoutError) as e:
+            logger.warning("Throttling without redis", error=str(e))
+            bucket = self._local.get(key) or TokenBucket(burst, now)
+            granted, wait = bucket.take(rate, burst, now)
+            remember(self._local, key, bucket)
+        if not granted:
+            return wait
+        remember(self._leases, key, (granted - 1, now + LEASE_SECONDS))
+        return 0.0
+
+
+class Admission:
+    """Whether new timestamps are accepted, as seen by one process."""
+
+    def __init__(self, max_pending: int, max_seal_lag: float):
+        self.max_pending = max_pending
+        self.max_seal_lag = max_seal_lag
+        # As of the last time this process asked redis
+        self.pending = 0
+        self._pending_updated = -math.inf
+
+    async def check(self, redis: Redis, history: HeadHistory, retry_after: float):
+        """Raise Overloaded if the worker is too far behind."""
+        if self.max_seal_lag:
+            lag = time.monotonic() - history.updated
+            if lag > self.max_seal_lag:
+                _throttled_lag.inc()
+                raise Overloaded(
+                    f"No interval was sealed for {lag:.0f} seconds", retry_after
+                )
+        if self.max_pending and self.pending > self.max_pending:
+            if time.monotonic() - self._pending_updated > retry_after:
+                try:
+                    self._update(await redis.get(PENDING_KEY))
+                except (RedisConnectionError, RedisTimeoutError) as e:
+                    logger.warning("Admission without redis", error=str(e))
+                    self._pending_updated = time.monotonic()
+            if self.pending > self.max_pending:
+                _throttled_pending.inc()
+                raise Overloaded(
+                    "Too many timestamps waiting to be sealed", retry_after
+                )
+
+    async def added(self, redis: Redis):
+        """Count a timestamp that is waiting to be sealed."""
+        if self.max_pending:
+            try:
+                self._update(await redis.incr(PENDING_KEY))
+            except (RedisConnectionError, RedisTimeoutError) as e:
+                logger.warning("Admission without redis", error=str(e))
+                self.pending += 1
+
+    def _update(self, pending):
+        # The count as GET or INCR returned it
+        self.pending = int(pending or 0)
+        self._pending_updated = time.monotonic()
+
+
+def client_key(request) -> Tuple[str, float, float]:
+    """The bucket of the client of `request`, and its rate and burst."""
+    config = request.app.config
+    api_key = request.headers.get(config.API_KEY_HEADER)
+    if api_key and api_key in request.app.ctx.api_keys:
+        return (
+            "key:" + hashlib.sha256(api_key.encode()).hexdigest()[:32],
+            config.THROTTLE_API_KEY_RATE,
+            config.THROTTLE_API_KEY_BURST,
+        )
+    return (
+        f"addr:{request.remote_addr or request.ip}",
+        config.THROTTLE_RATE,
+        config.THROTTLE_BURST,
+    )
+
+
+async def throttle(request):
+    """Take a token of the client's bucket, or raise Throttled."""
+    key, rate, burst = client_key(request)
+    if not rate:
+        return
+    wait = await request.app.ctx.throttle.take(key, rate, burst)
+    if wait:
+        _throttled_client.inc()
+        raise Throttled("Too many requests", wait)
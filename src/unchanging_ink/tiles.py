@@ -0,0 +1,193 @@
+"""Static export of the main tree as tiles.
+
+A tile holds the hashes of 2**height consecutive perfect subtrees of the same
+size, concatenated: tile `<level>/<n>` holds the nodes of size 2**(level *
+height) with indices n * 2**height up to (n + 1) * 2**height. The nodes
+between two tile levels are not stored, they are recomputed from the level
+below. Full tiles never change and can be served and cached as static files.
+The tile at the right edge of each level is written as `<level>/<n>.p` with
+the nodes there are so far, and rewritten every time the tree grows, until it
+is full.
+
+TileWriter keeps a tile directory up to date with a tree, the TileMerkleTree
+subclasses compute nodes and proofs of the main tree from tiles alone.
+"""
+import asyncio
+import os
+import urllib.error
+import urllib.request
+from abc import abstractmethod
+from typing import Dict, Optional
+
+from .crypto import AbstractAsyncMerkleTree, MerkleNode
+
+HASH_SIZE = 32
+DEFAULT_HEIGHT = 8
+WIDTH_FILE = "width"
+
+
+class TileNotFound(Exception):
+    pass
+
+
+def tile_path(level: int, index: int, partial: bool = False) -> str:
+    return f"{level}/{index}" + (".p" if partial else "")
+
+
+class TileWriter:
+    def __init__(self, directory: str, height: int = DEFAULT_HEIGHT):
+        self.directory = directory
+        self.height = height
+
+    def _write(self, path: str, data: bytes):
+        filename = os.path.join(self.directory, path)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(filename + ".tmp", filename)
+
+    def _read(self, path: str) -> Optional[bytes]:
+        try:
+            with open(os.path.join(self.directory, path), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    @property
+    def width(self) -> int:
+        """Width of the tree the tiles were last written for."""
+        data = self._read(WIDTH_FILE)
+        return int(data) if data else 0
+
+    async def update(self, tree: AbstractAsyncMerkleTree, width: int):
+        """Write all tiles that changed since the last update, for `tree` at `width`.
+
+        Nodes already in a partial tile are not computed again, so after the
+        first update of a directory only the new nodes are taken from `tree`."""
+        old_width = self.width
+        tile_width = 1 << self.height
+        level = 0
+        while (count := width >> (level * self.height)) > 0:
+            old_count = old_width >> (level * self.height)
+            size = 1 << (level * self.height)
+            if count == old_count:
+                level += 1
+                continue
+            for index in range(
+                old_count >> self.height, ((count - 1) >> self.height) + 1
+            ):
+                first, last = index * tile_width, min(count, (index + 1) * tile_width)
+                data = self._read(tile_path(level, index, partial=True)) or b""
+                if len(data) != (max(old_count, first) - first) * HASH_SIZE:
+                    data = b""
+                for i in range(first + len(data) // HASH_SIZE, last):
+                    data += (await tree.calculate_node(i * size, (i + 1) * size)).value
+                if last - first == tile_width:
+                    self._write(tile_path(level, index), data)
+                    try:
+                        os.unlink(
+                            os.path.join(self.directory, tile_path(level, index, True))
+                        )
+                    except FileNotFoundError:
+                        pass
+                else:
+                    self._write(tile_path(level, index, partial=True), data)
+            level += 1
+        self._write(WIDTH_FILE, str(width).encode())
+
+
+class TileMerkleTree(AbstractAsyncMerkleTree):
+    """The main tree at a given width, with all nodes computed from tiles."""
+
+    def __init__(self, *args, height: int = DEFAULT_HEIGHT, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.height = height
+        self._tiles: Dict[str, bytes] = {}
+
+    @abstractmethod
+    async def fetch_tile(self, path: str) -> bytes:
+        raise NotImplementedError()  # pragma: no cover
+
+    async def fetch_leaf_data(self, position: int) -> bytes:
+        raise NotImplementedError()  # pragma: no cover
+
+    async def _tile(self, level: int, index: int, needed: int) -> bytes:
+        """Tile `index` of `level`, with at least `needed` hashes."""
+        available = self.width >> (level * self.height)
+        partial = available < (index + 1) << self.height
+        for path in [tile_path(level, index, partial)] + (
+            [tile_path(level, index)] if partial else []
+        ):
+            if len(self._tiles.get(path, b"")) >= needed * HASH_SIZE:
+                return self._tiles[path]
+            try:
+                data = await self.fetch_tile(path)
+            except TileNotFound:
+                # The partial tile filled up since
+                continue
+            if len(data) >= needed * HASH_SIZE:
+                self._tiles[path] = data
+                return data
+        raise TileNotFound(tile_path(level, index, partial))
+
+    async def calculate_node(self, start: int, end: int) -> MerkleNode:
+        assert start < end <= self.width
+        size = end - start
+        if size & (size - 1) or start % size:
+            # Not a perfect subtree, made up of ones that are
+            return await super().calculate_node(start, end)
+
+        node_level = size.bit_length() - 1
+        level = node_level // self.height
+        base = level * self.height
+        first = start >> base
+        index = first >> self.height
+        offset = first - (index << self.height)
+        tile = await self._tile(level, index, offset + (1 << (node_level - base)))
+
+        values = [
+            tile[(offset + i) * HASH_SIZE : (offset + i + 1) * HASH_SIZE]
+            for i in range(1 << (node_level - base))
+        ]
+        while len(values) > 1:
+            values = [
+                MerkleNode.combine_digests(values[i], values[i + 1])
+                for i in range(0, len(values), 2)
+            ]
+        return MerkleNode(start, end, values[0])
+
+
+class DirectoryTileMerkleTree(TileMerkleTree):
+    def __init__(self, directory: str, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.directory = directory
+
+    async def fetch_tile(self, path: str) -> bytes:
+        try:
+            with open(os.path.join(self.directory, path), "rb") as f:
+                return f.read()
+        except FileNotFoundError as e:
+            raise TileNotFound(path) from e
+
+
+class HTTPTileMerkleTree(TileMerkleTree):
+    """Tiles from e.g. https://<authority>/api/v1/tiles"""
+
+    def __init__(self, base_url: str, *args, timeout: float = 30, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def _get(self, path: str) -> bytes:
+        try:
+            with urllib.request.urlopen(
+                f"{self.base_url}/{path}", timeout=self.timeout
+            ) as response:
+                return response.read()
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                raise TileNotFound(path) from e
+            raise
+
+    async def fetch_tile(self, path: str) -> bytes:
+        return await asyncio.get_running_loop().run_in_executor(None, self._get, path)
@@ -0,0 +1,441 @@
+"""Offline bulk verification of compact timestamp receipts.
+
+Receipts are read as lines of `<receipt>\\t<data>`, where the receipt is the
+output of `POST /v1/ts/?compact` and data is what was timestamped. Receipts
+are grouped by interval, and the head of every interval (its interval data,
+main tree hash and the inclusion of the interval in it) is fetched once and
+shared by all receipts of that interval. At the end, every head that was used
+is checked to be consistent with one reference head, the newest one seen
+unless --head is given.
+
+Heads are fetched from the API, or read from a local export: a directory with
+the API responses stored as `<path>.cbor`, as written by --save-export. An
+on-disk cache (--cache) keeps all responses between runs; they are immutable.
+"""
+import argparse
+import http.client
+import os
+import re
+import sqlite3
+import sys
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from hashlib import sha3_256
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import cbor2
+import orjson
+
+from .crypto.merkle import AbstractAsyncMerkleTree, MerkleNode
+from .schemas import (Interval, MainHeadWithConsistency,
+                      MainTreeConsistencyProof, MainTreeInclusionProof,
+                      TimestampStructure, b64url_decode)
+
+# Same as COMPACT_TS_RE in the web client
+COMPACT_RE = re.compile(
+    r"^(?P<authority>(?:[hH][tT][tT][pP][sS]?://)?[\[\]0-9a-z_.:-]+(?::[0-9]+)?)"
+    r"/(?P<interval>[0-9]+)#v1(?=[:,])(?::(?P<mth>[a-zA-Z0-9_-]+))?"
+    r"(?:,(?P<timestamp>[^,]+),(?P<proof>[a-zA-Z0-9_-]+))?$"
+)
+
+
+class VerificationError(Exception):
+    pass
+
+
+def root_from_path(leaf_data: bytes, a: int, path: Sequence[bytes]) -> bytes:
+    """Root hash reached from a leaf with the node address and path of an
+    inclusion proof, see the protocol documentation."""
+    current = sha3_256(b"\x00" + leaf_data).digest()
+    for node in path:
+        if a & 1:
+            current = sha3_256(b"\x01" + node + current).digest()
+        else:
+            current = sha3_256(b"\x01" + current + node).digest()
+        a >>= 1
+    return current
+
+
+def _is_proof(a, path) -> bool:
+    """Whether a and path can be the node address and path of an inclusion
+    proof."""
+    return (
+        type(a) is int
+        and a >= 0
+        and type(path) is list
+        and all(type(node) is bytes and len(node) == 32 for node in path)
+    )
+
+
+@dataclass
+class Receipt:
+    authority: str
+    interval: int
+    timestamp: str
+    a: int
+    path: List[bytes]
+    mth: Optional[bytes] = None
+    interval_timestamp: Optional[str] = None
+    main_a: Optional[int] = None
+    main_path: Optional[List[bytes]] = None
+
+    @classmethod
+    def parse(cls, receipt: str) -> "Receipt":
+        match = COMPACT_RE.match(receipt)
+        if not match or not match["proof"]:
+            raise VerificationError("not a compact timestamp")
+        try:
+            items = cbor2.loads(b64url_decode(match["proof"]))
+            if type(items) is not list:
+                raise ValueError()
+            bundle = items[2:] if len(items) == 5 else (None, None, None)
+            # Checked here, so that verify_receipt only fails with
+            # VerificationError
+            if not _is_proof(items[0], items[1]) or (
+                len(items) == 5
+                and not (_is_proof(bundle[1], bundle[2]) and type(bundle[0]) is str)
+            ):
+                raise ValueError()
+            return cls(
+                authority=match["authority"],
+                interval=int(match["interval"]),
+                timestamp=match["timestamp"],
+                a=items[0],
+                path=items[1],
+                mth=b64url_decode(match["mth"]) if match["mth"] else None,
+                interval_timestamp=bundle[0],
+                main_a=bundle[1],
+                main_path=bundle[2],
+            )
+        except (ValueError, TypeError, IndexError, cbor2.CBORDecodeError) as e:
+            raise VerificationError("malformed proof") from e
+
+
+@dataclass
+class IntervalHead:
+    """What is needed to verify all receipts of one interval."""
+
+    interval: Interval
+    mth: bytes
+    main_a: int
+    main_path: List[bytes]
+
+    def check(self):
+        ihash = self.interval.calculate_hash()
+        if root_from_path(ihash, self.main_a, self.main_path) != self.mth:
+            raise VerificationError(f"interval {self.interval.index} not in its mth")
+
+
+def verify_receipt(receipt: Receipt, data: str, head: IntervalHead):
+    # POST ?compact timestamps the request body as bytes, JSON and CBOR
+    # requests timestamp it as text
+    for value in (data, data.encode()):
+        hash_ = TimestampStructure(
+            data=value, timestamp=receipt.timestamp
+        ).calculate_hash()
+        ith = root_from_path(hash_, receipt.a, receipt.path)
+        if ith == head.interval.ith:
+            break
+    else:
+        raise VerificationError("hash not in the interval tree")
+    if receipt.mth is not None and receipt.mth != head.mth:
+        raise VerificationError("mth differs from the interval head")
+    if receipt.main_path is not None:
+        interval = Interval(receipt.interval, receipt.interval_timestamp, ith)
+        if (
+            root_from_path(interval.calculate_hash(), receipt.main_a, receipt.main_path)
+            != head.mth
+        ):
+            raise VerificationError("bundled main tree proof does not match the mth")
+
+
+def verify_batch(
+    head: IntervalHead, lines: List[Tuple[str, str]]
+) -> Tuple[int, List[Tuple[str, str]]]:
+    """Verify (receipt, data) pairs of one interval, in a pool process.
+
+    Returns the number verified and (line, reason) for every failure."""
+    verified, failures = 0, []
+    for receipt, data in lines:
+        try:
+            verify_receipt(Receipt.parse(receipt), data, head)
+        except VerificationError as e:
+            failures.append((receipt, str(e)))
+        else:
+            verified += 1
+    return verified, failures
+
+
+class Source:
+    def get(self, path: str) -> bytes:
+        raise NotImplementedError()  # pragma: no cover
+
+
+class HTTPSource(Source):
+    def __init__(self, base_url: str, timeout: float = 30):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def get(self, path: str) -> bytes:
+        request = urllib.request.Request(
+            f"{self.base_url}/{path}", headers={"Accept": "application/cbor"}
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.read()
+        # URLError, timeouts and connection resets are OSErrors, a response cut
+        # short is an HTTPException
+        except (OSError, http.client.HTTPException) as e:
+            raise VerificationError(f"fetching {path} failed: {e}") from e
+
+
+class ExportSource(Source):
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def get(self, path: str) -> bytes:
+        try:
+            with open(os.path.join(self.directory, path + ".cbor"), "rb") as f:
+                return f.read()
+        except FileNotFoundError as e:
+            raise VerificationError(f"{path} missing from the export") from e
+
+
+class CachingSource(Source):
+    """Keeps all responses of `source` in an SQLite database, and optionally
+    writes them out as an export."""
+
+    def __init__(
+        self,
+        source: Source,
+        cache_path: Optional[str] = None,
+        export_directory: Optional[str] = None,
+    ):
+        self.source = source
+        self.export_directory = export_directory
+        self.db = None
+        if cache_path:
+            self.db = sqlite3.connect(cache_path)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS response (path TEXT PRIMARY KEY, body BLOB)"
+            )
+
+    def get(self, path: str) -> bytes:
+        body = None
+        if self.db is not None:
+            row = self.db.execute(
+                "SELECT body FROM response WHERE path = ?", (path,)
+            ).fetchone()
+            body = row and row[0]
+        if body is None:
+            body = self.source.get(path)
+            if self.db is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO response VALUES (?, ?)", (path, body)
+                )
+                self.db.commit()
+        if self.export_directory:
+            filename = os.path.join(self.export_directory, path + ".cbor")
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, "wb") as f:
+                f.write(body)
+        return body
+
+
+class _Verifier(AbstractAsyncMerkleTree):
+    """A tree that only knows its root, for verifying proofs against it."""
+
+    async def fetch_leaf_data(self, position: int) -> bytes:
+        raise NotImplementedError()  # pragma: no cover
+
+
+class HeadStore:
+    def __init__(self, source: Source):
+        self.source = source
+        self.heads: Dict[int, IntervalHead] = {}
+
+    def head(self, index: int) -> IntervalHead:
+        if (head := self.heads.get(index)) is None:
+            try:
+                data = cbor2.loads(self.source.get(f"v1/mth/{index}"))
+                data["interval"] = Interval(**data["interval"])
+                main_head = MainHeadWithConsistency(**data)
+                inclusion = MainTreeInclusionProof.from_cbor(
+                    self.source.get(f"v1/mth/{index}/in/{index + 1}")
+                )
+                head = IntervalHead(
+                    interval=main_head.interval,
+                    mth=main_head.mth,
+                    main_a=inclusion.a,
+                    main_path=inclusion.nodes,
+                )
+                if head.interval.index != index:
+                    raise VerificationError(
+                        f"head for interval {index} has wrong index"
+                    )
+                head.check()
+            except (cbor2.CBORDecodeError, ValueError, LookupError, TypeError) as e:
+                raise VerificationError(
+                    f"malformed head for interval {index}: {e!r}"
+                ) from e
+            self.heads[index] = head
+        return head
+
+    def check_consistency(self, reference: int) -> List[Tuple[int, str]]:
+        """Check that every head fetched so far is a prefix of the `reference` head."""
+        failures = []
+        new_head = self.head(reference)
+        new_width = reference + 1
+        new_tree = _Verifier.from_root_value(new_width, new_head.mth)
+        for index, head in sorted(self.heads.items()):
+            if index == reference:
+                continue
+            old_width = index + 1
+            try:
+                if index > reference:
+                    raise VerificationError(
+                        f"newer than the reference head {reference}"
+                    )
+                proof = MainTreeConsistencyProof.from_cbor(
+                    self.source.get(f"v1/mth/{new_width}/from/{old_width}")
+                )
+                nodes = [
+                    MerkleNode(start, end, value)
+                    for ((start, end), value) in zip(
+                        AbstractAsyncMerkleTree.consistency_proof_node_addresses(
+                            old_width, new_width
+                        ),
+                        proof.nodes,
+                    )
+                ]
+                if not new_tree.verify_consistency_proof(
+                    _Verifier.from_root_value(old_width, head.mth), nodes
+                ):
+                    raise VerificationError(
+                        f"not consistent with the reference head {reference}"
+                    )
+            except VerificationError as e:
+                failures.append((index, str(e)))
+        return failures
+
+
+def read_receipts(paths: Iterable[str]) -> Iterator[Tuple[str, str]]:
+    for path in paths:
+        with (sys.stdin if path == "-" else open(path)) as f:
+            for line in f:
+                receipt, _, data = line.rstrip("\n").partition("\t")
+                if receipt:
+                    yield receipt, data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("files", nargs="+", help="receipt files, - for stdin")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument(
+        "--server", help="API base URL, default https://<authority>/api"
+    )
+    source.add_argument("--export", help="read heads from this export directory")
+    parser.add_argument("--cache", help="SQLite file caching fetched heads")
+    parser.add_argument("--save-export", help="write fetched heads to this directory")
+    parser.add_argument(
+        "--head", type=int, help="reference interval, default the newest seen"
+    )
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--batch", type=int, default=1000, help="receipts per task")
+    parser.add_argument("--failures", help="write failed receipts here, default stderr")
+    args = parser.parse_args()
+
+    failure_file = open(args.failures, "w") if args.failures else sys.stderr
+    store: Optional[HeadStore] = None
+    authority: Optional[str] = None
+    buckets: Dict[int, List[Tuple[str, str]]] = {}
+    pending = []
+    verified = failed = total = 0
+    start = time.perf_counter()
+
+    def fail(line: str, reason: str):
+        nonlocal failed
+        failed += 1
+        failure_file.write(f"{reason}\t{line}\n")
+
+    def collect(done_only: bool):
+        nonlocal verified
+        for future in [f for f in pending if f.done() or not done_only]:
+            pending.remove(future)
+            ok, failures = future.result()
+            verified += ok
+            for line, reason in failures:
+                fail(line, reason)
+
+    with ProcessPoolExecutor(args.processes) as pool:
+
+        def submit(index: int):
+            lines = buckets.pop(index)
+            try:
+                head = store.head(index)
+            except VerificationError as e:
+                for receipt, _ in lines:
+                    fail(receipt, str(e))
+                return
+            pending.append(pool.submit(verify_batch, head, lines))
+
+        for receipt, data in read_receipts(args.files):
+            total += 1
+            match = COMPACT_RE.match(receipt)
+            if not match:
+                fail(receipt, "not a compact timestamp")
+                continue
+            if store is None:
+                authority = match["authority"]
+                if args.export:
+                    source = ExportSource(args.export)
+                else:
+                    source = HTTPSource(args.server or f"https://{authority}/api")
+                store = HeadStore(CachingSource(source, args.cache, args.save_export))
+            if match["authority"] != authority:
+                fail(receipt, f"authority is not {authority}")
+                continue
+            index = int(match["interval"])
+            buckets.setdefault(index, []).append((receipt, data))
+            if len(buckets[index]) >= args.batch:
+                submit(index)
+                collect(done_only=True)
+
+        for index in list(buckets):
+            submit(index)
+        collect(done_only=False)
+
+    inconsistent = []
+    if store is not None and store.heads:
+        reference = args.head if args.head is not None else max(store.heads)
+        try:
+            inconsistent = store.check_consistency(reference)
+        except VerificationError as e:
+            inconsistent = [(reference, str(e))]
+        for index, reason in inconsistent:
+            failure_file.write(f"interval {index}: {reason}\n")
+
+    seconds = time.perf_counter() - start
+    print(
+        orjson.dumps(
+            {
+                "receipts": total,
+                "verified": verified,
+                "failed": failed,
+                "intervals": len(store.heads) if store else 0,
+                "inconsistent_intervals": len(inconsistent),
+                "seconds": seconds,
+                "per_second": total / seconds if seconds else None,
+            }
+        ).decode()
+    )
+    if failed or inconsistent:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""Delivery of proofs to callback URLs, instead of clients waiting for them.
+
+A timestamp requested with ?callback=<url> gets a row in the webhook table.
+Woken by the worker after every interval it seals, WebhookDelivery fetches
+the sealed timestamps that have one, groups them by URL and POSTs each group
+as a JSON array of timestamps, the same as POST /v1/ts/bulk returns, in
+requests of at most WEBHOOK_BATCH. At most WEBHOOK_CONCURRENCY requests are
+in flight, and at most WEBHOOK_HOST_CONCURRENCY to the same host.
+
+A delivery succeeds with any 2xx response, and the rows are deleted. After
+any other outcome it is retried, WEBHOOK_RETRY_SECONDS later and twice as
+long after each further attempt, and given up after WEBHOOK_MAX_ATTEMPTS.
+
+Callback URLs must be http or https. Unless WEBHOOK_ALLOW_PRIVATE is set,
+they are only delivered to if their host resolves to global addresses only,
+and the request goes to the address that was checked. Redirects are not
+followed.
+"""
+import asyncio
+import ipaddress
+import socket
+import ssl
+import time
+import urllib.parse
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import sqlalchemy
+import structlog
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from .itree import with_proofs
+from .metrics import WEBHOOK_DELIVERIES
+from .models import timestamp, webhook
+from .schemas import TimestampList, TimestampWithId
+
+logger = structlog.getLogger(__name__)
+
+MAX_URL_LENGTH = 2048
+# Timestamps fetched for delivery at once
+ROUND_SIZE = 1000
+MAX_RETRY_SECONDS = 3600
+
+_delivered = WEBHOOK_DELIVERIES.labels(result="delivered")
+_failed = WEBHOOK_DELIVERIES.labels(result="failed")
+_dropped = WEBHOOK_DELIVERIES.labels(result="dropped")
+
+
+class WebhookError(Exception):
+    pass
+
+
+def check_url(url: str, allow_private: bool = False):
+    """Raise WebhookError unless `url` can be a callback URL. Host names are
+    only resolved when delivering."""
+    if len(url) > MAX_URL_LENGTH:
+        raise WebhookError("callback URL too long")
+    try:
+        parts = urllib.parse.urlsplit(url)
+        parts.port
+    except ValueError as e:
+        raise WebhookError(f"invalid callback URL: {e}") from e
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise WebhookError("callback URL must be http or https")
+    if parts.username is not None or parts.password is not None:
+        raise WebhookError("callback URL must not contain credentials")
+    try:
+        address = ipaddress.ip_address(parts.hostname)
+    except ValueError:
+        return
+    if not (allow_private or address.is_global):
+        raise WebhookError("callback URL must not point to a private address")
+
+
+async def resolve(host: str, port: int, allow_private: bool = False) -> str:
+    """An address of `host`, if all of them are global."""
+    infos = await asyncio.get_running_loop().getaddrinfo(
+        host, port, type=socket.SOCK_STREAM
+    )
+    if not infos:
+        raise WebhookError(f"{host} does not resolve")
+    addresses = [info[4][0] for info in infos]
+    if not allow_private:
+        for address in addresses:
+            if not ipaddress.ip_address(address.partition("%")[0]).is_global:
+                raise WebhookError(f"{host} resolves to the private {address}")
+    return addresses[0]
+
+
+async def post_json(
+    url: str, body: bytes, timeout: float, allow_private: bool = False
+) -> int:
+    """POST `body` to `url`, and return the response status."""
+    parts = urllib.parse.urlsplit(url)
+    tls = parts.scheme == "https"
+    port = parts.port or (443 if tls else 80)
+    target = urllib.parse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+    host = parts.hostname.encode("idna").decode()
+    if ":" in host:
+        host = f"[{host}]"
+    if parts.port:
+        host = f"{host}:{parts.port}"
+
+    async def exchange() -> int:
+        address = await resolve(parts.hostname, port, allow_private)
+        reader, writer = await asyncio.open_connection(
+            address,
+            port,
+            ssl=ssl.create_default_context() if tls else None,
+            server_hostname=parts.hostname if tls else None,
+        )
+        try:
+            writer.write(
+                b"POST %s HTTP/1.1\r\nHost: %s\r\nUser-Agent: unchanging-ink\r\n"
+                b"Content-Type: application/json\r\nContent-Length: %d\r\n"
+                b"Connection: close\r\n\r\n%s"
+                % (target.encode(), host.encode(), len(body), body)
+            )
+            await writer.drain()
+            status_line = await reader.readline()
+        finally:
+            writer.close()
+        try:
+            return int(status_line.split(b" ")[1])
+        except (IndexError, ValueError):
+            raise WebhookError(f"invalid response {status_line[:64]!r}")
+
+    return await asyncio.wait_for(exchange(), timeout)
+
+
+class WebhookDelivery:
+    def __init__(self, engine: AsyncEngine, config):
+        self.engine = engine
+        self.batch = config.WEBHOOK_BATCH
+        self.timeout = config.WEBHOOK_TIMEOUT
+        self.max_attempts = config.WEBHOOK_MAX_ATTEMPTS
+        self.retry_seconds = config.WEBHOOK_RETRY_SECONDS
+        self.allow_private = config.WEBHOOK_ALLOW_PRIVATE
+        self.host_concurrency = config.WEBHOOK_HOST_CONCURRENCY
+        self._requests = asyncio.Semaphore(config.WEBHOOK_CONCURRENCY)
+        self._wake = asyncio.Event()
+
+    def wake(self):
+        """Deliver now, e.g. after an interval was sealed."""
+        self._wake.set()
+
+    async def run(self):
+        while True:
+            try:
+                # Also every now and then, for the retries
+                await asyncio.wait_for(self._wake.wait(), self.retry_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                while await self.deliver() == ROUND_SIZE:
+                    pass
+            except Exception:
+                logger.exception("Delivering webhooks failed")
+
+    async def deliver(self, now: Optional[float] = None) -> int:
+        """Deliver a round of the sealed timestamps that are due, and return
+        how many there were."""
+        now = time.time() if now is None else now
+        query = (
+            sqlalchemy.select(timestamp, webhook.c.url, webhook.c.attempts)
+            .select_from(webhook.join(timestamp))
+            .where(timestamp.c.interval.isnot(None), webhook.c.next_attempt <= now)
+            .order_by(webhook.c.next_attempt)
+            .limit(ROUND_SIZE)
+        )
+        async with self.engine.begin() as conn:
+            rows = await with_proofs(conn, (await conn.execute(query)).all())
+        if not rows:
+            return 0
+
+        requests = defaultdict(list)
+        for row in rows:
+            requests[row.pop("url")].append(row)
+        hosts: Dict[str, asyncio.Semaphore] = defaultdict(
+            lambda: asyncio.Semaphore(self.host_concurrency)
+        )
+        outcomes = await asyncio.gather(
+            *(
+                self._post(hosts, url, group[i : i + self.batch])
+                for (url, group) in requests.items()
+                for i in range(0, len(group), self.batch)
+            )
+        )
+
+        delivered, failed = [], []
+        for (group, ok) in outcomes:
+            (delivered if ok else failed).extend(group)
+        dropped = [row for row in failed if row["attempts"] + 1 >= self.max_attempts]
+        async with self.engine.begin() as conn:
+            if delivered or dropped:
+                done = [row["id"] for row in delivered + dropped]
+                await conn.execute(webhook.delete().where(webhook.c.id.in_(done)))
+            for row in failed:
+                if row["attempts"] + 1 >= self.max_attempts:
+                    continue
+                delay = self.retry_seconds * 2 ** row["attempts"]
+                await conn.execute(
+                    webhook.update()
+                    .where(webhook.c.id == row["id"])
+                    .values(
+                        attempts=row["attempts"] + 1,
+                        next_attempt=now + min(delay, MAX_RETRY_SECONDS),
+                    )
+                )
+        _delivered.inc(len(delivered))
+        _failed.inc(len(failed) - len(dropped))
+        _dropped.inc(len(dropped))
+        if dropped:
+            logger.warning("Gave up delivering webhooks", timestamps=len(dropped))
+        return len(rows)
+
+    async def _post(
+        self, hosts: Dict[str, asyncio.Semaphore], url: str, rows: List[dict]
+    ):
+        body = TimestampList(
+            [
+                TimestampWithId.from_dict(
+                    {k: v for (k, v) in row.items() if k != "attempts"}
+                )
+                for row in rows
+            ]
+        ).to_json()
+        async with hosts[urllib.parse.urlsplit(url).hostname], self._requests:
+            try:
+                status = await post_json(url, body, self.timeout, self.allow_private)
+                ok = 200 <= status < 300
+                if not ok:
+                    logger.info("Webhook refused", url=url, status=status)
+            except (OSError, asyncio.TimeoutError, WebhookError) as e:
+                logger.info("Webhook failed", url=url, error=repr(e))
+                ok = False
+        return rows, ok
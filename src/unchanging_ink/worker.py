@@ -21,20 +21,36 @@ from unchanging_ink.schemas import (CompactRepr, ConcreteTime, Interval,
                                     MainTreeConsistencyProof, MainHeadWithConsistency, MainTreeInclusionProof)
 
 from .crypto import AbstractAsyncMerkleTree, DictCachingMerkleTree
+from .epochs import EpochHeads, store_epochs
+from .hashfilter import add_interval, sync_hash_filter
+from .itree import STORAGE_TREE, interval_tree_row, tile_rows, tree_levels
+from .metrics import (INTERVALS_SEALED, PENDING_TIMESTAMPS, SEAL_STAGE_SECONDS,
+                      serve_metrics)
 from .models import interval as interval_model
+from .models import interval_tile
+from .models import interval_tree as interval_tree_model
 from .models import timestamp
-from .server import authority_base_url, engine, redis_url
+from .nodestore import NodeStore, sync_node_store
+from .server import app, authority_base_url, engine, redis_url
+from .throttle import PENDING_KEY
+from .tiles import TileWriter
+from .webhooks import WebhookDelivery
 
 logger = structlog.getLogger(__name__)
 
-
-sentry_sdk.init(
-    "https://67428a387e6f4703afd14b4b7fe92936@sentry.digitalwolff.de/10",
-    # Set traces_sample_rate to 1.0 to capture 100%
-    # of transactions for performance monitoring.
-    # We recommend adjusting this value in production.
-    traces_sample_rate=1.0,
-)
+stage_timers = {
+    stage: SEAL_STAGE_SECONDS.labels(stage=stage)
+    for stage in (
+        "select",
+        "tree_build",
+        "mth_recalc",
+        "proof_build",
+        "proof_write",
+        "publish",
+        "tile_write",
+        "hash_filter",
+    )
+}
 
 
 async def formulate_proof(
@@ -43,6 +59,7 @@ async def formulate_proof(
     i: int,
     row: dict,
     mth: CompactRepr,
+    inclusion_proof: MainTreeInclusionProof,
 ) -> dict:
     a, path = await interval_tree.compute_inclusion_proof(i)
     return {
@@ -53,13 +70,89 @@ async def formulate_proof(
             path=[node.value for node in path],
             mth=mth,
             ith=interval.ith,
+            interval_timestamp=interval.timestamp,
+            main_a=inclusion_proof.a,
+            main_path=inclusion_proof.nodes,
         ).to_cbor(),
     }
 
 
+async def store_proofs(
+    conn: sqlalchemy.ext.asyncio.AsyncConnection,
+    rows: list,
+    interval_tree: AbstractAsyncMerkleTree,
+    interval: Interval,
+    mth: CompactRepr,
+    inclusion_proof: MainTreeInclusionProof,
+):
+    proofs = []
+    with stage_timers["proof_build"].time():
+        for i, row in enumerate(rows):
+            proofs.append(
+                await formulate_proof(
+                    interval_tree,
+                    interval,
+                    i,
+                    row,
+                    mth,
+                    inclusion_proof,
+                )
+            )
+
+    logger.info("Inserting %i proofs", len(proofs))
+    if proofs:
+        with stage_timers["proof_write"].time():
+            await conn.execute(
+                timestamp.update()
+                .where(timestamp.c.id == bindparam("id_"))
+                .values(
+                    interval=bindparam("interval"),
+                    proof=bindparam("proof"),
+                ),
+                proofs,
+            )
+
+
+async def store_interval_tree(
+    conn: sqlalchemy.ext.asyncio.AsyncConnection,
+    rows: list,
+    interval: Interval,
+    mth: CompactRepr,
+    inclusion_proof: MainTreeInclusionProof,
+):
+    """The interval tree once, and only the position in every row, see itree.py"""
+    if not rows:
+        return
+    with stage_timers["proof_build"].time():
+        levels = tree_levels(row["hash"] for row in rows)
+        positions = [
+            {"id_": row["id"], "interval": interval.index, "position": i}
+            for i, row in enumerate(rows)
+        ]
+
+    logger.info("Inserting interval tree of %i timestamps", len(rows))
+    with stage_timers["proof_write"].time():
+        await conn.execute(
+            interval_tree_model.insert(),
+            interval_tree_row(interval, len(rows), mth, inclusion_proof),
+        )
+        await conn.execute(interval_tile.insert(), tile_rows(interval, levels))
+        await conn.execute(
+            timestamp.update()
+            .where(timestamp.c.id == bindparam("id_"))
+            .values(
+                interval=bindparam("interval"),
+                position=bindparam("position"),
+            ),
+            positions,
+        )
+
+
 async def calculate_interval(
     conn: sqlalchemy.ext.asyncio.AsyncConnection,
     redisconn: Redis,
+    node_store: Optional[NodeStore] = None,
+    epochs: Optional[EpochHeads] = None,
 ) -> MainHeadWithConsistency:
     logger.info("Starting calculate_interval()")
     start_time = time.time()
@@ -74,14 +167,16 @@ async def calculate_interval(
             .with_for_update()
             .order_by("timestamp", "hash")
         )
-        result = await conn.execute(s)
-
-        rows = list(result)
+        with stage_timers["select"].time():
+            result = await conn.execute(s)
+            rows = list(result)
+        PENDING_TIMESTAMPS.set(len(rows))
         logger.debug("Have %i new rows", len(rows), time=time.time()-start_time)
 
-        interval_tree = await DictCachingMerkleTree.from_sequence(
-            row["hash"] for row in rows
-        )
+        with stage_timers["tree_build"].time():
+            interval_tree = await DictCachingMerkleTree.from_sequence(
+                row["hash"] for row in rows
+            )
         print("New head", interval_tree.root)
 
         max_id = (
@@ -108,41 +203,57 @@ async def calculate_interval(
                 ith=interval.ith,
             )
         )
-        await conn.execute(text("SET CONSTRAINTS ALL DEFERRED"))
+        if conn.dialect.name == "postgresql":
+            await conn.execute(text("SET CONSTRAINTS ALL DEFERRED"))
         logger.info("Interval inserted", interval=interval, time=time.time()-start_time)
 
         tree_start_time = time.time()
-        tree = MainMerkleTree(redisconn, conn)
-        tree_root = await tree.recalculate_root(interval.index + 1)
+        if epochs is not None:
+            await epochs.refresh(conn, interval.index + 1)
+        tree = MainMerkleTree(
+            redisconn,
+            conn,
+            node_store=node_store,
+            epochs=epochs,
+            concurrency=app.config.MERKLE_CONCURRENCY,
+            layout=app.config.REDIS_NODE_LAYOUT,
+        )
+        with stage_timers["mth_recalc"].time():
+            tree_root = await tree.recalculate_root(interval.index + 1)
         logger.info("New tree root", new_root=tree_root, time=time.time()-start_time, delta=time.time()-tree_start_time)
+        if epochs is not None:
+            # If this interval completes an epoch, its head is fixed from now on
+            await store_epochs(conn, tree, epochs, interval.index + 1)
 
         mth_b64url = base64.urlsafe_b64encode(tree_root.value).decode().rstrip("=")
         mth = f"{authority_base_url}/{interval.index}#v1:{mth_b64url}"
 
-        proofs = []
-        for i, row in enumerate(rows):
-            proofs.append(
-                await formulate_proof(
-                    interval_tree,
-                    interval,
-                    i,
-                    row,
-                    mth,
-                )
-            )
+        # Bundled into every proof, so that it can be verified up to the mth
+        # without further requests
+        a, path = await tree.compute_inclusion_proof(interval.index)
+        inclusion_proof = MainTreeInclusionProof(
+            head=interval.index,
+            leaf=None,
+            a=a,
+            nodes=[node.value for node in path],
+        )
 
-        logger.info("Inserting %i proofs", len(proofs), time=time.time()-start_time)
-        if proofs:
-            await conn.execute(
-                timestamp.update()
-                .where(timestamp.c.id == bindparam("id_"))
-                .values(
-                    interval=bindparam("interval"),
-                    proof=bindparam("proof"),
-                ),
-                proofs,
+        if app.config.INTERVAL_PROOF_STORAGE == STORAGE_TREE:
+            await store_interval_tree(conn, rows, interval, mth, inclusion_proof)
+        else:
+            await store_proofs(
+                conn, rows, interval_tree, interval, mth, inclusion_proof
             )
 
+        if app.config.HASH_FILTER_BITS:
+            with stage_timers["hash_filter"].time():
+                await add_interval(
+                    conn,
+                    interval.index,
+                    [row["hash"] for row in rows],
+                    app.config.HASH_FILTER_BITS,
+                )
+
         if interval.index < 2:
             append_proof = None
         else:
@@ -153,16 +264,6 @@ async def calculate_interval(
                 nodes=[node.value for node in proof_nodes],
             )
 
-        logger.info("Computing current inclusion proof", time=time.time()-start_time)
-        incp_start_time = time.time()
-        a, path = await tree.compute_inclusion_proof(interval.index)
-        inclusion_proof = MainTreeInclusionProof(
-            head=interval.index,
-            leaf=None,
-            a=a,
-            nodes=[node.value for node in path],
-        )
-
         retval = MainHeadWithConsistency(
             authority=authority_base_url,
             interval=interval,
@@ -170,10 +271,34 @@ async def calculate_interval(
             inclusion=inclusion_proof,
             consistency=append_proof,
         )
-        logger.info("calculate_interval() done", retval=retval, time=time.time()-start_time, delta=time.time()-incp_start_time)
+        logger.info(
+            "calculate_interval() done", retval=retval, time=time.time() - start_time
+        )
     return retval
 
 
+async def sync_epochs(
+    redisconn: Redis, node_store: Optional[NodeStore], epochs: EpochHeads
+):
+    """Store the heads of the epochs completed before they were enabled, or
+    raise EpochError if they were stored with other EPOCH_BITS."""
+    async with engine.connect() as conn:
+        width = await conn.scalar(
+            sqlalchemy.select(sqlalchemy.func.count()).select_from(interval_model)
+        )
+        tree = MainMerkleTree(
+            redisconn,
+            conn,
+            node_store=node_store,
+            concurrency=app.config.MERKLE_CONCURRENCY,
+            layout=app.config.REDIS_NODE_LAYOUT,
+        )
+        await store_epochs(conn, tree, epochs, width)
+        await conn.commit()
+        await epochs.refresh(conn)
+    logger.info("Epochs ready", epochs=len(epochs.heads))
+
+
 def run_upgrade(connection, cfg):
     cfg.attributes["connection"] = connection
     command.upgrade(cfg, "head")
@@ -185,26 +310,100 @@ async def async_main():
         await conn.run_sync(run_upgrade, config.Config("alembic.ini"))
         await conn.commit()
 
-    logger.info("Worker ready")
+    if app.config.HASH_FILTER_BITS:
+        async with engine.connect() as conn:
+            max_id = await conn.scalar(
+                sqlalchemy.select(sqlalchemy.func.max(interval_model.c.id))
+            )
+            if max_id is not None:
+                await sync_hash_filter(conn, max_id, app.config.HASH_FILTER_BITS)
+                await conn.commit()
+        logger.info("Hash filter ready")
+
+    if app.config.WORKER_METRICS_PORT:
+        await serve_metrics(
+            app.config.WORKER_METRICS_HOST, app.config.WORKER_METRICS_PORT
+        )
+
+    node_store = None
+    if app.config.NODE_STORE_DIRECTORY:
+        node_store = NodeStore(app.config.NODE_STORE_DIRECTORY, writable=True)
+        async with engine.connect() as conn:
+            await sync_node_store(node_store, conn)
+        logger.info("Node store ready", width=node_store.width)
+
+    tile_writer = None
+    if app.config.TILES_DIRECTORY:
+        tile_writer = TileWriter(app.config.TILES_DIRECTORY, app.config.TILE_HEIGHT)
+
     queue = []
+    # One client for the whole run, it keeps its connections open
+    redisconn = aioredis.from_url(redis_url)
+    delivery = WebhookDelivery(engine, app.config)
+    delivery_task = asyncio.create_task(delivery.run())
     try:
+        epochs = None
+        if app.config.EPOCH_BITS:
+            epochs = EpochHeads(app.config.EPOCH_BITS)
+            await sync_epochs(redisconn, node_store, epochs)
+        logger.info("Worker ready")
         while True:
-            await asyncio.sleep(3)  # Time between intervals
-            async with aioredis.from_url(redis_url) as redisconn:
-                async with engine.connect() as conn:
-                    mth = await calculate_interval(conn, redisconn)
-                    await conn.commit()
-                live_data = mth.as_json_data()
-                await redisconn.publish("mth-live", orjson.dumps(live_data))
-                queue.append(live_data)
-                if len(queue) > 5:
-                    queue.pop(0)
-                await redisconn.set("recent-mth", orjson.dumps(queue))
+            await asyncio.sleep(app.config.INTERVAL_SECONDS)
+            async with engine.connect() as conn:
+                mth = await calculate_interval(conn, redisconn, node_store, epochs)
+                await conn.commit()
+                # Including those added while the interval was being sealed
+                pending = await conn.scalar(
+                    sqlalchemy.select(sqlalchemy.func.count())
+                    .select_from(timestamp)
+                    .where(timestamp.c.interval.is_(None))
+                )
+                if node_store is not None:
+                    await sync_node_store(node_store, conn, check=False)
+                if tile_writer is not None:
+                    with stage_timers["tile_write"].time():
+                        await tile_writer.update(
+                            MainMerkleTree(
+                                redisconn,
+                                conn,
+                                node_store=node_store,
+                                epochs=epochs,
+                                layout=app.config.REDIS_NODE_LAYOUT,
+                            ),
+                            mth.interval.index + 1,
+                        )
+            INTERVALS_SEALED.inc()
+            live_data = mth.as_json_data()
+            frame = orjson.dumps(live_data)
+            queue.append(live_data)
+            if len(queue) > 5:
+                queue.pop(0)
+            with stage_timers["publish"].time():
+                async with redisconn.pipeline(transaction=True) as pipe:
+                    # History first, so that subscribers seeding from it on
+                    # reconnect cannot miss the announced head
+                    pipe.rpush("mth-history", frame)
+                    pipe.ltrim("mth-history", -app.config.MTH_HISTORY_LENGTH, -1)
+                    pipe.publish("mth-live", frame)
+                    pipe.set("recent-mth", orjson.dumps(queue))
+                    pipe.set(PENDING_KEY, pending)
+                    await pipe.execute()
+            # Announced first, clients may also be waiting for the proofs
+            delivery.wake()
     finally:
+        delivery_task.cancel()
+        await redisconn.close()
         await engine.dispose()
 
 
 def main():
+    sentry_sdk.init(
+        "https://67428a387e6f4703afd14b4b7fe92936@sentry.digitalwolff.de/10",
+        # Set traces_sample_rate to 1.0 to capture 100%
+        # of transactions for performance monitoring.
+        # We recommend adjusting this value in production.
+        traces_sample_rate=1.0,
+    )
     structlog.configure(wrapper_class=structlog.make_filtering_bound_logger(logging.INFO))
     asyncio.run(async_main())
 
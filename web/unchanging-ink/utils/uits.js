@@ -48,6 +48,17 @@ export function createTimestampHash(data, timestamp) {
   return new SHA3(256).update(encodeCanonical(tsStruct)).digest()
 }
 
+export function createIntervalHash(index, timestamp, ith) {
+  const itStruct = {
+    index,
+    timestamp,
+    ith,
+    version: '1',
+    typ: 'it',
+  }
+  return new SHA3(256).update(encodeCanonical(itStruct)).digest()
+}
+
 function _verifyInclusionProof({ hash, head, a, path }) {
   let current = new SHA3(256)
     .update(Buffer.from([0]))
@@ -178,8 +189,11 @@ export class TimestampService {
     if (this.ws) {
       this.closeLiveConnection()
     }
+    const since = this.knownHead?.interval ?? null
     this.ws = new WebSocket(
-      this.baseUrl.replace(/^http/i, 'ws') + 'v1/mth/live'
+      this.baseUrl.replace(/^http/i, 'ws') +
+        'v1/mth/live' +
+        (since === null ? '' : '?since=' + since)
     )
     this.ws.onmessage = (event) => this._wsmessage(event)
     this.ws.onclose = (event) => this._wsclose(event)
@@ -340,6 +354,22 @@ export class TimestampService {
         return false
       }
     }
-    return verifyTsProof(hash, ts.proof)
+    if (!verifyTsProof(hash, ts.proof)) {
+      return false
+    }
+    if (ts.proof.main_path) {
+      // The proof bundles the interval and its inclusion in the mth
+      const components = parseCompactTs(ts.proof.mth)
+      const ihash = createIntervalHash(
+        Number(components.interval),
+        ts.proof.interval_timestamp,
+        Buffer.from(ts.proof.ith, 'base64')
+      )
+      return verifyIntervalProof(ihash, components.mth, {
+        a: ts.proof.main_a,
+        path: ts.proof.main_path,
+      })
+    }
+    return true
   }
 }